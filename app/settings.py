@@ -118,6 +118,40 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Number of worker processes used to build per-Dataset backup workbooks (default: number of CPUs)
+BACKUP_MAX_WORKERS = int(os.environ.get('BACKUP_MAX_WORKERS', 0)) or None
+
+# Directory of the backups made by the Dataset admin action (not served as media, only through the admin),
+# which must be outside of the source tree (eg. /var/lib/asavi/backups), the action is unavailable until it is set
+BACKUP_ROOT = os.environ.get('BACKUP_ROOT')
+
+# The cache holds the rendered rows, changelist pages, counts and filter choices (see database/admin/).
+# The default in-memory cache is per process, so a write only invalidates the worker that made it (the
+# others see the new data version in their keys instead); set CACHE_BACKEND to share it between workers,
+# eg. 'django.core.cache.backends.db.DatabaseCache' with CACHE_LOCATION='cache_table' (after running
+# `manage.py createcachetable`), or a Redis/Memcached backend with its server URL.
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+if CACHE_BACKEND.split('.')[-1] in ('LocMemCache', 'DatabaseCache', 'FileBasedCache'):
+    # These cull a third of their entries once full (300 by default), which the row cache alone would fill
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 20000))}
+
+# Seconds to keep rendered changelist row cells in the cache (0 disables the row cache)
+ROW_CACHE_TIMEOUT = int(os.environ.get('ROW_CACHE_TIMEOUT', 24 * 60 * 60))
+
+# Answer the Studies/Results changelist filters from an in-memory columnar index (see database/columnar.py)
+COLUMNAR_FILTERS = bool(int(os.environ.get('COLUMNAR_FILTERS', 0)))
+
+# Identifies the deployed build (eg. the git commit), which is part of the ETags of the conditional pages
+# (see database/conditional.py), so that the pages kept by browsers aren't reused after an upgrade
+BUILD_ID = os.environ.get('BUILD_ID', '')
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
 STATIC_URL = '/files/'
@@ -1,16 +1,23 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from admin_action_buttons.admin import ActionButtonsMixin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import UserChangeForm
-from django.urls import path
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.http import FileResponse, Http404
+from django.shortcuts import render
+from django.urls import path, reverse
+from django.utils.html import format_html
 
 from database.actions import download_as_csv
 from database.models import (
     Users, ImportSource, Document, DataRequest, Dataset,
-    StudiesModel, ResultsModel,
+    StudiesModel, ResultsModel, Studies, Results,
 )
 from database.exporter import download_excel_worksheet
+from database.backup import start_backup_job, list_backups, get_backup_path
+from database.snapshot import download_sqlite_snapshot
 
+from .aggregates import aggregate_column, child_count
 from .base import ViewModelAdmin
 
 class MyUserChangeForm(UserChangeForm):
@@ -104,7 +111,15 @@ class DatasetAdmin(ViewModelAdmin):
     perm_delete_all = Users.ACCESS_SUPER
     perm_delete_owner = None
 
-    actions = ['delete_selected', 'backup_studies']
+    list_display = ('Dataset_name', 'get_studies_count', 'get_results_count')
+
+    actions = ['delete_selected', 'backup_studies', 'backup_datasets_zip', 'snapshot_approved']
+
+    get_studies_count = aggregate_column(
+        {'studies_count': child_count(StudiesModel, 'Dataset')}, description='Studies')
+    get_results_count = aggregate_column(
+        {'results_count': child_count(ResultsModel, 'Study__Dataset')},
+        description='Results')
 
     @admin.action(description='Back-up Selected to Excel')
     def backup_studies(self, request, queryset):
@@ -118,4 +133,49 @@ class DatasetAdmin(ViewModelAdmin):
         if studies.count() == 0 and results.count() == 0:
             messages.error(request, 'No studies are associated with the selected Datasets. Perhaps they are empty?')
             return None
-        return download_excel_worksheet(studies, results)
\ No newline at end of file
+        return download_excel_worksheet(studies, results)
+
+    @admin.action(description='Back-up Selected to Zip in the background (one Excel file per Dataset)')
+    def backup_datasets_zip(self, request, queryset):
+        dataset_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        try:
+            filename = start_backup_job(dataset_ids)
+        except ImproperlyConfigured as e:
+            messages.error(request, str(e))
+            return None
+        self.message_user(request, format_html(
+            'Backing up {} datasets to {}, it will be listed in the <a href="{}">backups</a> when it is finished.',
+            len(dataset_ids), filename, reverse('admin:database_dataset_backups')))
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('backups/', self.admin_site.admin_view(self.backups_view), name='%s_%s_backups' % info),
+            path('backups/<str:filename>', self.admin_site.admin_view(self.backup_download_view),
+                name='%s_%s_backup' % info),
+        ] + super().get_urls()
+
+    def backups_view(self, request):
+        """ The backups made by backup_datasets_zip """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return render(request, 'admin/database/dataset/backups.html', context={
+            **self.admin_site.each_context(request),
+            'title': 'Dataset backups',
+            'opts': self.model._meta,
+            'backups': list_backups(),
+        })
+
+    def backup_download_view(self, request, filename):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        backup_path = get_backup_path(filename)
+        if backup_path is None:
+            raise Http404('No such backup')
+        return FileResponse(open(backup_path, 'rb'), as_attachment=True, filename=filename)
+
+    @admin.action(description='Export Approved Data in Selected to SQLite')
+    def snapshot_approved(self, request, queryset):
+        studies = Studies.objects.filter(Dataset__in=queryset)
+        results = Results.objects.filter(Study__in=studies.values('pk'))
+        return download_sqlite_snapshot(studies, results)
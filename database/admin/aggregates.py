@@ -0,0 +1,32 @@
+from django.contrib import admin
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+def child_aggregate(model, fk, aggregate, default=None):
+    """
+    Correlated subquery of the aggregate (eg. Count('pk')) over the rows of the model whose foreign key fk
+    is the outer row, eg. child_aggregate(ResultsModel, 'Study', Count('pk')) for the results of each study.
+    The subquery is only worked out for the rows which are selected (or for every row when sorted by it).
+    """
+    children = model._base_manager.filter(**{fk: OuterRef('pk')}).order_by().values(fk)
+    expression = Subquery(children.annotate(value=aggregate).values('value'))
+    if default is not None:
+        expression = Coalesce(expression, Value(default))
+    return expression
+
+def child_count(model, fk):
+    return child_aggregate(model, fk, Count('pk'), default=0)
+
+def aggregate_column(annotations, format_value=None, **display_kwargs):
+    """
+    Returns a list_display method showing aggregates of each row's related rows, which are annotated on the
+    query of the page's rows (see MyModelAdmin.get_list_annotations) rather than queried per row.
+    annotations maps names to expressions, the column is sorted by the first one, and shows it
+    (or format_value(obj) of the annotated row).
+    """
+    name, expression = next(iter(annotations.items()))
+    def render_column(self, obj):
+        return format_value(obj) if format_value else getattr(obj, name)
+    render_column.annotations = annotations
+    display_kwargs.setdefault('ordering', expression)
+    return admin.display(**display_kwargs)(render_column)
@@ -1,12 +1,61 @@
+from contextlib import ExitStack
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ERROR_FLAG
 from admin_action_buttons.admin import ActionButtonsMixin
+from django.core.exceptions import PermissionDenied
+from django.db import router
+from django.http import Http404, HttpResponseRedirect
 from django.template.loader import render_to_string
+from django.urls import path, reverse
 from django.utils.html import mark_safe
 
+from database.conditional import conditional_page, get_data_etag
+from database.filters import HierarchicalFilter
 from database.models import Users
+from database.search import has_search_index, search_queryset
+from database.versioning import data_version_batch, get_request_data_version
+from .changelist import MyChangeList, ExportChangeList, EXACT_COUNT_VAR
+from .counting import CountingPaginator
+from .planner import plan_template_fields, plan_template_relations, warn_deferred_loads
+from .rendering import get_row_renderer
+
+def template_column(template_name, cache_cells=True, **display_kwargs):
+    """
+    Returns a list_display/readonly_fields method which renders the template with the object as `row`.
+    The template is kept as the method's row_template, so that the relations it uses can be planned.
+    Cells are cached until the row version changes (see rendering.py), cache_cells=False renders them
+    every time instead, for templates showing more than the row (and its study) eg. the users' names.
+    """
+    def render_column(self, obj):
+        cells = getattr(obj, '_rendered_cells', None)
+        if cells is not None and template_name in cells:
+            return cells[template_name] # already rendered with the rest of the page (see rendering.py)
+        return render_to_string(template_name, context={'row': obj})
+    render_column.row_template = template_name
+    render_column.cache_cells = cache_cells
+    return admin.display(**display_kwargs)(render_column)
 
 class MyModelAdmin(ActionButtonsMixin, admin.ModelAdmin):
+    changelist_class = MyChangeList
+    # count with counting.get_count() (cached, estimated on PostgreSQL), this also counts the unfiltered total
+    # so show_full_result_count should be disabled
+    cached_counts = False
+    # answer the list_filters from the in-memory columnar index when enabled (see columnar.py),
+    # only for changelists of every approved row (the index doesn't depend on the user)
+    columnar_filters = False
+    # keep the pks and counts of each page in the cache until the data changes (see MyChangeList.get_results)
+    cached_pages = False
+    # answer repeat views of the changelist (and exports) with 304 Not Modified until the data changes
+    # (see conditional.py), only for changelists which show nothing but studies/results
+    conditional_views = False
     checkbox_template = None
+    list_prefetch_related = ()
+    # load only the fields used by the row templates (see get_list_only_fields), plus these,
+    # or every field when None
+    list_only_fields = None
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
@@ -15,6 +64,119 @@ class MyModelAdmin(ActionButtonsMixin, admin.ModelAdmin):
         self.request = request
         return qs
 
+    # the saves/deletes of a form (with its inlines) or an action are made at one data version (see versioning.py)
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        with data_version_batch(router.db_for_write(self.model)):
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
+    def delete_view(self, request, object_id, extra_context=None):
+        with data_version_batch(router.db_for_write(self.model)):
+            return super().delete_view(request, object_id, extra_context)
+
+    def response_action(self, request, queryset):
+        with data_version_batch(router.db_for_write(self.model)):
+            return super().response_action(request, queryset)
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if self.cached_counts:
+            return CountingPaginator(
+                queryset, per_page, orphans, allow_empty_first_page,
+                exact=EXACT_COUNT_VAR in request.GET, version=get_request_data_version(request, queryset.db))
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+    def get_urls(self):
+        urls = super().get_urls()
+        if not self.conditional_views:
+            return urls
+        # the changelist view, without never_cache
+        info = self.model._meta.app_label, self.model._meta.model_name
+        view = self.admin_site.admin_view(conditional_page(get_data_etag)(self.changelist_view), cacheable=True)
+        view.model_admin = self
+        name = '%s_%s_changelist' % info
+        return [path('', view, name=name)] + [url for url in urls if getattr(url, 'name', None) != name]
+
+    def get_changelist(self, request, **kwargs):
+        if getattr(request, 'export_only', False):
+            return ExportChangeList
+        return self.changelist_class
+
+    def get_list_relations(self, request):
+        """
+        Returns (select_related, prefetch_related) lookups for the changelist queryset: those used by
+        the list_display row templates (see planner.py), plus any declared in list_select_related
+        or list_prefetch_related (ie. relations used indirectly through model properties).
+        """
+        select_related, prefetch_related = plan_template_relations(self.model, self.get_row_templates(request))
+
+        if isinstance(self.list_select_related, (list, tuple)):
+            select_related = select_related | set(self.list_select_related)
+        return sorted(select_related), sorted(prefetch_related | set(self.list_prefetch_related))
+
+    def get_list_only_fields(self, request):
+        """
+        Returns the fields (only() lookups) to load for the changelist rows, or None to load every field:
+        those used by the row templates (see planner.py), the foreign keys of the select_related relations,
+        plus any declared in list_only_fields (ie. fields used indirectly through model properties).
+        """
+        if self.list_only_fields is None:
+            return None
+        fields = set(plan_template_fields(self.model, self.get_row_templates(request)))
+        for lookup in self.get_list_relations(request)[0]:
+            bits = lookup.split('__')
+            fields.update('__'.join(bits[:i]) for i in range(1, len(bits) + 1))
+        return sorted(fields | set(self.list_only_fields))
+
+    def get_row_templates(self, request):
+        """ templates used to render each changelist row (template_column()s and the checkbox template) """
+        templates = tuple(
+            getattr(getattr(self, name, None), 'row_template', None) for name in self.get_list_display(request)
+        ) + (self.checkbox_template, )
+        return tuple(name for name in templates if name)
+
+    def get_uncached_row_templates(self, request):
+        """ row templates of the template_column()s whose cells aren't cached """
+        columns = [ getattr(self, name, None) for name in self.get_list_display(request) ]
+        return tuple(
+            column.row_template for column in columns
+            if getattr(column, 'row_template', None) and not column.cache_cells
+        )
+
+    def get_list_annotations(self, request):
+        """ annotations of the changelist rows used by the list_display aggregate_column()s """
+        annotations = {}
+        for name in self.get_list_display(request):
+            annotations.update(getattr(getattr(self, name, None), 'annotations', None) or {})
+        return annotations
+
+    def render_rows(self, request, rows):
+        """ Renders (or fetches the cached) row templates for a page of changelist rows in one pass """
+        templates = self.get_row_templates(request)
+        if not templates:
+            return
+        with ExitStack() as stack:
+            if settings.DEBUG and self.list_only_fields is not None:
+                # a field missing from list_only_fields costs a query per row
+                stack.enter_context(warn_deferred_loads(rows, '%s row templates' % type(self).__name__))
+            get_row_renderer(templates, self.get_uncached_row_templates(request)).render(
+                rows,
+                ACTION_CHECKBOX_NAME=admin.helpers.ACTION_CHECKBOX_NAME,
+                model_name=self.model._meta.model_name,
+            )
+
+    def lookup_allowed(self, lookup, value):
+        # the levels of hierarchical filters are allowed like other list_filter fields
+        for list_filter in self.list_filter:
+            if isinstance(list_filter, type) and issubclass(list_filter, HierarchicalFilter):
+                if any(lookup == path or lookup.startswith(path + '__') for path, _ in list_filter.field_spec):
+                    return True
+        return super().lookup_allowed(lookup, value)
+
+    def get_list_select_related(self, request):
+        return self.get_list_relations(request)[0]
+
+    def get_list_prefetch_related(self, request):
+        return self.get_list_relations(request)[1]
+
     @admin.display(description=mark_safe('<input type="checkbox" id="action-toggle">'))
     def action_checkbox(self, obj):
         """
@@ -23,6 +185,10 @@ class MyModelAdmin(ActionButtonsMixin, admin.ModelAdmin):
         if self.checkbox_template is None:
             return super().action_checkbox(obj)
 
+        cells = getattr(obj, '_rendered_cells', None)
+        if cells is not None and self.checkbox_template in cells:
+            return cells[self.checkbox_template]
+
         return render_to_string(self.checkbox_template, context={
             'ACTION_CHECKBOX_NAME': admin.helpers.ACTION_CHECKBOX_NAME,
             'row': obj,
@@ -85,3 +251,52 @@ class ViewModelAdmin(MyModelAdmin):
             or self._eval_perm(request, self.perm_delete_all)
             or self._eval_owner_perm(request, self.perm_delete_owner, obj)
         )
+
+
+class FullTextSearchMixin:
+    """
+    Searches the full text index (see search.py) instead of OR-ing icontains lookups over every search_field.
+    A search term also matches rows whose search_related foreign keys match it.
+    """
+    search_related = ()
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term or not has_search_index(queryset.db):
+            return super().get_search_results(request, queryset, search_term)
+        return search_queryset(queryset, search_term, self.search_related), False
+
+
+class ExportFilteredMixin:
+    """
+    Adds an endpoint for exporting all rows matching the current changelist filters and search,
+    eg. .../studies/export/xlsx/?Disease__in=ARF&q=kimberley
+    Subclasses implement export_queryset(queryset, export_format).
+    """
+    export_formats = ('xlsx', 'csv', 'sqlite')
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        view = self.export_filtered_view
+        if self.conditional_views:
+            view = conditional_page(get_data_etag)(view)
+        my_urls = [
+            path('export/<str:export_format>/', self.admin_site.admin_view(view, cacheable=self.conditional_views),
+                name='%s_%s_export' % info),
+        ]
+        return my_urls + super().get_urls()
+
+    def export_filtered_view(self, request, export_format):
+        if export_format not in self.export_formats:
+            raise Http404('Unknown export format')
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+
+        # only build the filtered queryset, it gets evaluated (once) by the exporter
+        request.export_only = True
+        try:
+            cl = self.get_changelist_instance(request)
+        except IncorrectLookupParameters:
+            info = self.model._meta.app_label, self.model._meta.model_name
+            return HttpResponseRedirect(reverse('admin:%s_%s_changelist' % info) + '?' + ERROR_FLAG + '=1')
+
+        return self.export_queryset(cl.queryset, export_format)
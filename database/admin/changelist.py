@@ -0,0 +1,366 @@
+import base64
+import binascii
+import hashlib
+import json
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, SEARCH_VAR
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import InvalidPage, Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.db.models.expressions import OrderBy
+
+from database.columnar import get_columnar_query, get_rows
+from database.filters import get_filter_specs
+from database.search import SEARCH_RANK
+from database.versioning import get_request_data_version, get_request_data_version_stamp
+from .counting import CountingPaginator, get_count, get_facet_counts
+from .planner import get_path_field_lookups
+
+CURSOR_VAR = 'cursor'
+EXACT_COUNT_VAR = 'exact'
+
+PAGE_CACHE_PREFIX = 'database.page'
+PAGE_CACHE_TIMEOUT = 60 * 60
+
+# what get_results() works out besides the rows, kept in the page cache
+PAGE_STATE_ATTRS = (
+    'result_count', 'full_result_count', 'show_full_result_count', 'show_admin_actions', 'can_show_all',
+    'multi_page', 'count_is_exact', 'exact_count_url', 'keyset_ordering', 'previous_url', 'next_url',
+)
+
+def get_order_item(key, descending=False):
+    """ queryset ordering item of a column sort key (a field name or an expression), reversed if descending """
+    if isinstance(key, OrderBy):
+        key = key.copy()
+        if descending:
+            key.reverse_ordering()
+        return key
+    if hasattr(key, 'resolve_expression'):
+        return key.desc() if descending else key.asc()
+    if descending:
+        return key[1:] if key.startswith('-') else '-' + key
+    return key
+
+class MyChangeList(ChangeList):
+    # parameters for the page/count which aren't filters, and aren't kept by links to other filters/orderings
+    page_params = (CURSOR_VAR, EXACT_COUNT_VAR)
+    columnar_query = None
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        for name in self.page_params:
+            lookup_params.pop(name, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        new_params = dict(new_params or {})
+        for name in self.page_params:
+            new_params.setdefault(name, None)
+        return super().get_query_string(new_params, remove)
+
+    def get_ordering(self, request, queryset):
+        # show the best matches of a fuzzy search first, unless a column is sorted
+        if SEARCH_RANK in queryset.query.annotations and ORDER_VAR not in self.params:
+            return ['-' + SEARCH_RANK, '-pk']
+        if ORDER_VAR not in self.params:
+            return super().get_ordering(request, queryset)
+
+        # same as ChangeList.get_ordering(), but columns can be sorted by several keys
+        # (a list/tuple admin_order_field, eg. the composite template_column()s)
+        ordering = []
+        for param in self.params[ORDER_VAR].split('.'):
+            none, prefix, index = param.rpartition('-')
+            try:
+                order_field = self.get_ordering_field(self.list_display[int(index)])
+            except (IndexError, ValueError):
+                continue # invalid ordering specified, skip it
+            keys = order_field if isinstance(order_field, (list, tuple)) else [order_field]
+            ordering.extend(get_order_item(key, prefix == '-') for key in keys if key)
+        ordering.extend(queryset.query.order_by)
+        # keys after the pk (eg. the default ordering after a column's keys) don't change the order
+        pk_names = { 'pk', self.lookup_opts.pk.name }
+        for i, item in enumerate(ordering):
+            if isinstance(item, str) and item.lstrip('-') in pk_names:
+                return ordering[:i + 1]
+        return self._get_deterministic_ordering(ordering)
+
+    def get_filters(self, request):
+        filters = super().get_filters(request)
+        self.remaining_lookup_params = filters[2]
+        return filters
+
+    def get_facet_queryset(self, request, exclude_spec):
+        """ the changelist queryset with every filter applied except exclude_spec """
+        qs = self.root_queryset
+        for spec in get_filter_specs(self.filter_specs):
+            if spec is not exclude_spec:
+                new_qs = spec.queryset(request, qs)
+                if new_qs is not None:
+                    qs = new_qs
+        qs = qs.filter(**self.remaining_lookup_params)
+        qs, _ = self.model_admin.get_search_results(request, qs, self.query)
+        return qs
+
+    def get_facet_counts(self, spec):
+        """ {value: number of rows} for the options of the filter, under all the other active filters and search """
+        if self.columnar_query is not None:
+            counts = self.columnar_query.get_facet_counts(spec)
+            if counts is not None:
+                return counts
+        queryset = self.get_facet_queryset(self.request, spec)
+        return get_facet_counts(queryset, spec.field_path, get_request_data_version(self.request, queryset.db))
+
+    def get_queryset(self, request):
+        self.request = request
+        qs = super().get_queryset(request)
+        prefetch_related = self.model_admin.get_list_prefetch_related(request)
+        if prefetch_related:
+            qs = qs.prefetch_related(*prefetch_related)
+        return qs
+
+    def get_rows_queryset(self, request, queryset):
+        """
+        The queryset loading the rows of the page, with only the fields they show (if the model admin
+        has list_only_fields) and the aggregates of the aggregate_column()s, which are then only worked out
+        for the rows of the page. Admin actions still get every field, as they use get_queryset().
+        """
+        annotations = self.model_admin.get_list_annotations(request)
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        only_fields = self.model_admin.get_list_only_fields(request)
+        if only_fields is None:
+            return queryset
+        # the ordering fields are also read from the rows (eg. for the keyset page links)
+        for item in queryset.query.order_by:
+            if isinstance(item, str):
+                only_fields = [*only_fields, *get_path_field_lookups(self.model, item.lstrip('-').replace('__', '.'))]
+        return queryset.only(*only_fields)
+
+    def get_columnar_query(self, request):
+        """ The filters evaluated on the in-memory columnar index (see columnar.py), or None to use SQL """
+        if not self.model_admin.columnar_filters or self.query or self.remaining_lookup_params:
+            return None
+        return get_columnar_query(
+            self.root_queryset, self.filter_specs, list(self.queryset.query.order_by),
+            get_request_data_version_stamp(request, self.root_queryset.db)[0], request)
+
+    def get_columnar_results(self, request):
+        """ Same as ChangeList.get_results(), with the counts and page from the columnar index """
+        query = self.columnar_query
+        self.paginator = Paginator(query.get_pks(), self.list_per_page)
+        self.result_count = self.paginator.count
+        self.full_result_count = query.full_count()
+        self.show_full_result_count = True
+        self.show_admin_actions = bool(self.full_result_count)
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.multi_page = self.result_count > self.list_per_page
+        self.count_is_exact = True
+
+        if (self.show_all and self.can_show_all) or not self.multi_page:
+            self.result_list = self.queryset._clone()
+        else:
+            try:
+                page_pks = self.paginator.page(self.page_num).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+            self.result_list = get_rows(self.queryset, page_pks)
+
+    def get_page_cache_key(self, request):
+        """
+        Key for the page in the page cache (if the model admin has cached_pages): the query string
+        in a canonical form (sorted params, sorted values of multiple selections) and the data version
+        """
+        if not self.model_admin.cached_pages:
+            return None
+        params = []
+        for name, value in sorted(self.params.items()):
+            if name.endswith('__in'):
+                value = ','.join(sorted(set(value.split(','))))
+            elif name == SEARCH_VAR:
+                value = ' '.join(value.split())
+                if not value:
+                    continue
+            params.append((name, value))
+        version = get_request_data_version(request, self.root_queryset.db)
+        page = (self.lookup_opts.label, self.list_per_page, self.page_num, params)
+        return '%s:%s' % (PAGE_CACHE_PREFIX, hashlib.sha1(repr((version, page)).encode()).hexdigest())
+
+    def get_results(self, request):
+        self.queryset = self.get_rows_queryset(request, self.queryset)
+        key = self.get_page_cache_key(request)
+        state = cache.get(key) if key else None
+        if state is not None:
+            # the ordered pks of the page and the counts, the rows themselves are loaded by pk
+            pks = state.pop('pks')
+            self.__dict__.update(state)
+            self.paginator = Paginator(range(self.result_count), self.list_per_page)
+            self.result_list = get_rows(self.queryset, pks)
+        else:
+            self.get_uncached_results(request)
+            if key:
+                state = { name: self.__dict__[name] for name in PAGE_STATE_ATTRS if name in self.__dict__ }
+                state['pks'] = [ row.pk for row in self.result_list ]
+                cache.set(key, state, PAGE_CACHE_TIMEOUT)
+        self.model_admin.render_rows(request, self.result_list)
+
+    def get_uncached_results(self, request):
+        self.columnar_query = self.get_columnar_query(request)
+        if self.columnar_query is not None:
+            self.get_columnar_results(request)
+        else:
+            super().get_results(request)
+            self.count_is_exact = getattr(self.paginator, 'count_is_exact', True)
+            if not self.count_is_exact:
+                self.exact_count_url = self.get_query_string({EXACT_COUNT_VAR: 1, CURSOR_VAR: self.params.get(CURSOR_VAR)})
+            if isinstance(self.paginator, CountingPaginator):
+                # the unfiltered total is counted the same way (the model admin disables the default exact count)
+                self.full_result_count, _ = get_count(self.root_queryset, version=self.paginator.version)
+                self.show_full_result_count = True
+                self.show_admin_actions = bool(self.full_result_count)
+        # evaluated once by the page cache or render_rows() (and stays cached on the queryset for the result_list template tag)
+        self.result_list = self.get_page_results(request)
+
+    def get_page_results(self, request):
+        """ rows shown on the page, the (lazy) offset page from get_results() by default """
+        return self.result_list
+
+class KeysetChangeList(MyChangeList):
+    """
+    Changelist paginated by keyset (seek) instead of OFFSET: the next/previous page links carry a cursor
+    with the ordering values of the last/first row of the page, and that page is selected with
+    WHERE (ordering) > (cursor values) LIMIT n, so deep pages cost the same as the first page.
+
+    The keyset is the changelist ordering (which always ends with the pk), so it is only used when every
+    ordering field is a plain, non-null field (following non-null foreign keys), otherwise the changelist
+    falls back to the normal numbered pages.
+    """
+    keyset_ordering = None
+    previous_url = None
+    next_url = None
+
+    def get_keyset_field(self, path):
+        """ The field of the ordering path, or None if it can't be part of the keyset """
+        opts = self.lookup_opts
+        *relations, name = path.split('__')
+        try:
+            for relation in relations:
+                field = opts.get_field(relation)
+                if not field.many_to_one or field.null:
+                    return None
+                opts = field.related_model._meta
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.concrete and not field.is_relation and not field.null:
+            return field
+        return None
+
+    def get_keyset_ordering(self):
+        """ [(path, descending), ...] of the queryset ordering, or None if it can't be used as a keyset """
+        keys = []
+        for item in self.queryset.query.order_by:
+            if not isinstance(item, str) or item == '?':
+                return None
+            path = item.lstrip('-')
+            if self.get_keyset_field(path) is None:
+                return None
+            keys.append((path, item.startswith('-')))
+        if not any(path in ('pk', self.lookup_opts.pk.name) for path, _ in keys):
+            return None
+        return keys
+
+    def get_key_values(self, obj):
+        values = []
+        for path, _ in self.keyset_ordering:
+            value = obj
+            for name in path.split('__'):
+                value = getattr(value, name)
+            values.append(value)
+        return values
+
+    def encode_cursor(self, direction, obj):
+        data = json.dumps([direction, self.get_key_values(obj)], cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError, binascii.Error):
+            raise IncorrectLookupParameters('Invalid page cursor')
+        if direction not in ('next', 'prev') or not isinstance(values, list) or len(values) != len(self.keyset_ordering):
+            raise IncorrectLookupParameters('Invalid page cursor')
+        try:
+            # the values are compared with the keyset fields, which are not null
+            values = [ self.get_keyset_field(path).to_python(value) for (path, _), value in zip(self.keyset_ordering, values) ]
+        except ValidationError:
+            raise IncorrectLookupParameters('Invalid page cursor')
+        if None in values:
+            raise IncorrectLookupParameters('Invalid page cursor')
+        return direction, values
+
+    def get_seek_filter(self, values, forwards):
+        """ rows after (forwards) or before the key values in the ordering """
+        query, equal = Q(), {}
+        for (path, descending), value in zip(self.keyset_ordering, values):
+            lookup = 'lt' if descending == forwards else 'gt'
+            query |= Q(**equal, **{'%s__%s' % (path, lookup): value})
+            equal[path] = value
+        return query
+
+    def get_seek_rows(self, values, forwards):
+        """ Returns (rows, has_more) for the page after (forwards) or before the key values """
+        if self.columnar_query is not None:
+            # the keyset includes the pk, which is enough to find the row in the index
+            pk = values[[ path for path, _ in self.keyset_ordering ].index('pk')]
+            seek = self.columnar_query.seek(pk, forwards, self.list_per_page)
+            if seek is not None:
+                pks, has_more = seek
+                return get_rows(self.queryset, pks), has_more
+
+        queryset = self.queryset.filter(self.get_seek_filter(values, forwards))
+        if forwards:
+            rows = list(queryset[:self.list_per_page + 1])
+            return rows[:self.list_per_page], len(rows) > self.list_per_page
+        rows = list(queryset.reverse()[:self.list_per_page + 1])
+        return rows[:self.list_per_page][::-1], len(rows) > self.list_per_page
+
+    def get_page_results(self, request):
+        result_list = super().get_page_results(request)
+        self.keyset_ordering = self.get_keyset_ordering()
+        cursor = request.GET.get(CURSOR_VAR)
+        if self.keyset_ordering is None or not self.multi_page or (self.show_all and self.can_show_all):
+            self.keyset_ordering = None
+            return result_list
+
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+            forwards = direction == 'next'
+            rows, has_more = self.get_seek_rows(values, forwards)
+            has_previous, has_next = (True, has_more) if forwards else (has_more, True)
+        else:
+            # first page (or a numbered page from an old link)
+            rows = list(result_list)
+            has_previous, has_next = self.page_num > 1, self.page_num < self.paginator.num_pages
+
+        if rows:
+            if has_previous:
+                self.previous_url = self.get_query_string({CURSOR_VAR: self.encode_cursor('prev', rows[0])})
+            if has_next:
+                self.next_url = self.get_query_string({CURSOR_VAR: self.encode_cursor('next', rows[-1])})
+        elif has_previous:
+            self.previous_url = self.get_query_string()
+        return rows
+
+class ExportChangeList(MyChangeList):
+    """
+    Changelist which only resolves the filtered/searched queryset (for exporting),
+    without counting or paginating the results. The query string is read the same way as the changelist's
+    (eg. the sort keys of the composite columns, which the "Export all matching" links keep).
+    """
+    def get_results(self, request):
+        self.result_list = self.queryset
+        self.result_count = None
+        self.full_result_count = None
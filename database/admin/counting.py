@@ -0,0 +1,83 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count
+from django.utils.functional import cached_property
+
+from database.versioning import get_data_version
+
+COUNT_CACHE_PREFIX = 'database.count'
+COUNT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# planner estimates at or below this are counted exactly (which is cheap enough for small results)
+COUNT_ESTIMATE_THRESHOLD = 10000
+
+def get_count_cache_key(queryset, version=None, *extra):
+    """ Key for the count of the queryset: the SQL of its filters and joins (without the ordering), and the data version """
+    if version is None:
+        version = get_data_version(queryset.db)
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    digest = hashlib.sha1(repr((version, sql, params) + extra).encode()).hexdigest()
+    return '%s:%s' % (COUNT_CACHE_PREFIX, digest)
+
+def get_estimated_count(queryset):
+    """ Row estimate from the PostgreSQL planner """
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def get_count(queryset, exact=False, version=None):
+    """
+    Returns (count, is_exact) for the queryset. Exact counts are cached until the data changes.
+    On PostgreSQL large counts are estimated by the query planner unless an exact count is asked for
+    (or is already cached), elsewhere counts are always exact.
+    """
+    try:
+        key = get_count_cache_key(queryset, version)
+    except EmptyResultSet:
+        return 0, True # eg. filtered by an empty list of pks, which matches nothing without a query
+    count = cache.get(key)
+    if count is not None:
+        return count, True
+
+    if not exact and connections[queryset.db].vendor == 'postgresql':
+        estimate = get_estimated_count(queryset)
+        if estimate > COUNT_ESTIMATE_THRESHOLD:
+            return estimate, False
+
+    count = queryset.count()
+    cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count, True
+
+def get_facet_counts(queryset, field_path, version=None):
+    """ {value: number of rows} of the queryset grouped by the field, in one query (cached until the data changes) """
+    try:
+        key = get_count_cache_key(queryset, version, 'facet', field_path)
+    except EmptyResultSet:
+        return {}
+    counts = cache.get(key)
+    if counts is None:
+        counts = dict(queryset.order_by().values(field_path).annotate(facet_count=Count('pk')).values_list(field_path, 'facet_count'))
+        cache.set(key, counts, COUNT_CACHE_TIMEOUT)
+    return counts
+
+class CountingPaginator(Paginator):
+    """ Paginator which counts the rows with get_count() (cached, or estimated on PostgreSQL) """
+    def __init__(self, *args, exact=False, version=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.exact = exact
+        self.version = version
+        self.count_is_exact = True
+
+    @cached_property
+    def count(self):
+        count, self.count_is_exact = get_count(self.object_list, self.exact, self.version)
+        return count
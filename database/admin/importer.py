@@ -22,6 +22,7 @@ from database.admin_views import import_data_view
 import io, logging
 from datetime import timedelta
 
+from .aggregates import aggregate_column, child_count
 from .base import ViewModelAdmin
 
 logger = logging.getLogger(__name__)
@@ -38,7 +39,8 @@ class ImportAdmin(ViewModelAdmin):
     perm_delete_all = Users.ACCESS_SUPER
     perm_delete_owner = Users.ACCESS_CONTRIB
 
-    list_display = ('Original_filename', 'Imported_by', 'Upload_time', 'Import_time', 'import_status_short',)
+    list_display = ('Original_filename', 'Imported_by', 'Upload_time', 'Import_time',
+        'get_studies_count', 'get_results_count', 'import_status_short',)
     add_form_template = 'database/import_data_form.html'
 
     exclude = ('Import_data', 'Deleted')
@@ -59,6 +61,12 @@ class ImportAdmin(ViewModelAdmin):
         ]
         return my_urls + urls
 
+    get_studies_count = aggregate_column(
+        {'studies_count': child_count(StudiesModel, 'Import_source')}, description='Studies')
+    get_results_count = aggregate_column(
+        {'results_count': child_count(ResultsModel, 'Study__Import_source')},
+        description='Results')
+
     @admin.display(description='Imported data status')
     def import_status_short(self, obj):
         state = obj.data_state
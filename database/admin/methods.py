@@ -1,11 +1,14 @@
 from django.contrib import admin, messages
 from django.contrib.admin import ModelAdmin
-from django.http import HttpResponseRedirect
+from django.contrib.admin.utils import unquote
+from django.core.exceptions import PermissionDenied
+from django.db.models import Max, Min
+from django.http import Http404, HttpResponseRedirect
 from django.utils.html import format_html, mark_safe
 from django.utils.http import urlencode
 from django.utils import timezone
 from django.template.loader import render_to_string
-from django.urls import reverse
+from django.urls import path, reverse
 from django import forms
 from rangefilter.filters import NumericRangeFilter
 from admin_action_buttons.admin import ActionButtonsMixin
@@ -15,11 +18,18 @@ from database.models import *
 from django_admin_listfilter_dropdown.filters import (
     DropdownFilter, ChoiceDropdownFilter, RelatedDropdownFilter)
 from django.db import models
-from database.exporter import download_excel_worksheet
-
-from database.filters import TwoNumbersInRangeFilter, ChoicesMultipleSelectFilter
-
-from .base import ViewModelAdmin
+from database.exporter import (
+    download_excel_worksheet, stream_excel_worksheet, stream_csv, STUDY_FIELDS)
+from database.conditional import conditional_page, get_data_etag
+from database.snapshot import download_sqlite_snapshot
+from database.changes import record_deletions
+from database.versioning import bump_data_version
+
+from database.filters import HierarchicalFilter, TwoNumbersInRangeFilter, ChoicesMultipleSelectFilter, FacetDropdownFilter, FacetChoiceDropdownFilter
+
+from .changelist import KeysetChangeList
+from .aggregates import aggregate_column, child_aggregate, child_count
+from .base import ViewModelAdmin, ExportFilteredMixin, FullTextSearchMixin, template_column
 from .results import ReadonlyResultsInline, ResultsSubmissionInline
 
 
@@ -31,12 +41,21 @@ SUBMIT_HIDE_FIELDS = [
     'Import_source',
 ]
 
+def format_year_span(obj):
+    """ years of the point estimates of the study's results """
+    start, stop = obj.results_year_start, obj.results_year_stop
+    if start is None and stop is None:
+        return '-'
+    if start == stop or start is None or stop is None:
+        return str(start or stop)
+    return '%d\u2013%d' % (start, stop)
+
 class StudiesForm(forms.ModelForm):
     class Meta:
         model = StudiesModel
         exclude = []
 
-class BaseStudiesModelAdmin(ViewModelAdmin):
+class BaseStudiesModelAdmin(FullTextSearchMixin, ViewModelAdmin):
     inlines = [ReadonlyResultsInline]
     readonly_fields = (
         'Approved_by', 'Updated_time', 'Created_time', 'Created_by', 'Import_source', 'Approved_time',
@@ -48,15 +67,19 @@ class BaseStudiesModelAdmin(ViewModelAdmin):
         'get_method_html',
         'get_location_html',
         'get_notes_html',
+        'get_results_count',
+        'get_results_years',
     )
 
     list_display_links = None
 
     list_filter = (
-        ('Study_group', ChoiceDropdownFilter), 
-        ('Disease', ChoicesMultipleSelectFilter),
+        HierarchicalFilter.create('Study group and disease', (
+            ('Study_group', FacetChoiceDropdownFilter),
+            ('Disease', ChoicesMultipleSelectFilter),
+        )),
         ('Year', NumericRangeFilter),
-        ('Study_design', ChoiceDropdownFilter),
+        ('Study_design', FacetChoiceDropdownFilter),
         ('Diagnosis_method', ChoicesMultipleSelectFilter),
         ('Data_source', ChoicesMultipleSelectFilter),
         ('Surveillance_setting', ChoicesMultipleSelectFilter),
@@ -68,6 +91,9 @@ class BaseStudiesModelAdmin(ViewModelAdmin):
 
     checkbox_template = 'database/data/study_row_header.html'
 
+    # fields used by the row cache version, besides those used directly by the row templates
+    list_only_fields = ('Updated_time', )
+
     ordering = ('Study_group', '-Paper_title')
 
     search_fields = (
@@ -88,25 +114,47 @@ class BaseStudiesModelAdmin(ViewModelAdmin):
         'Limitations_identified',
         'Other_points',
     )
-    search_help_text = 'Search keywords in all fields. Put quotes around search terms to find exact phrases only.'
+    search_help_text = 'Search keywords in all fields, keywords match whole words or the start of words (eg. strep finds Streptococcal, but coccal does not). Put quotes around search terms to find exact phrases only. Put ~ before a word to find near matches of titles, authors and locations (eg. ~Kimberly).'
 
     actions = ['export_selected', 'view_child_results', 'delete_selected']
 
-    @admin.display(description='Study Details')
-    def get_publication_html(self, obj):
-        return render_to_string('database/data/study_publication_info.html', context={'row': obj})
-
-    @admin.display(description='Geography')
-    def get_location_html(self, obj):
-        return render_to_string('database/data/study_geography_info.html', context={'row': obj})
-
-    @admin.display(description='Method Details')
-    def get_method_html(self, obj):
-        return render_to_string('database/data/study_method_info.html', context={'row': obj})
+    # the composite columns are sorted by several of the fields they show (see MyChangeList.get_ordering)
+    get_publication_html = template_column('database/data/study_publication_info.html',
+        ordering=('Disease', 'Year', 'pk'), description='Study Details')
+    get_location_html = template_column('database/data/study_geography_info.html',
+        ordering=('Coverage', 'Climate', 'pk'), description='Geography')
+    get_method_html = template_column('database/data/study_method_info.html',
+        ordering=('Data_source', 'Diagnosis_method', 'pk'), description='Method Details')
+    get_notes_html = template_column('database/data/study_notes.html', description='Notes')
+
+    get_results_count = aggregate_column(
+        {'results_count': child_count(ResultsModel, 'Study')}, description='Results')
+    get_results_years = aggregate_column({
+            'results_year_start': child_aggregate(ResultsModel, 'Study', Min('Year_start')),
+            'results_year_stop': child_aggregate(ResultsModel, 'Study', Max('Year_stop')),
+        },
+        format_value=format_year_span, description='Years of results',
+    )
 
-    @admin.display(description='Notes')
-    def get_notes_html(self, obj):
-        return render_to_string('database/data/study_notes.html', context={'row': obj})
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        view = conditional_page(get_data_etag)(self.results_page_view)
+        return [
+            path('<path:object_id>/results/', self.admin_site.admin_view(view, cacheable=True),
+                name='%s_%s_results' % info),
+        ] + super().get_urls()
+
+    def results_page_view(self, request, object_id):
+        """ A further page of the results inline (see ReadonlyResultsInline) """
+        study = self.get_object(request, unquote(object_id))
+        if study is None:
+            raise Http404('Study not found')
+        if not self.has_view_permission(request, study):
+            raise PermissionDenied
+        for inline in self.get_inline_instances(request, study):
+            if isinstance(inline, ReadonlyResultsInline):
+                return inline.results_page_view(request, study)
+        raise Http404('No results inline')
 
     @admin.action(description='View Results for Selected')
     def view_child_results(self, request, queryset):
@@ -118,10 +166,20 @@ class BaseStudiesModelAdmin(ViewModelAdmin):
 
     @admin.action(description='Export Selected to Excel')
     def export_selected(self, request, queryset):
-        study_ids = queryset.values_list('pk', flat=True)
-        my_results = ResultsModel.objects.filter(Study_id__in=study_ids).order_by('Study_id')
+        my_results = ResultsModel.objects.filter(Study__in=queryset.values('pk')).order_by('Study_id')
         my_studies = queryset.order_by('pk')
         return download_excel_worksheet(my_studies, my_results)
+
+    def export_queryset(self, queryset, export_format):
+        my_studies = queryset.order_by('pk')
+        if export_format == 'csv':
+            return stream_csv(my_studies, STUDY_FIELDS, 'Studies')
+
+        # results are selected with a subquery on the filtered studies
+        my_results = ResultsModel.objects.filter(Study__in=queryset.values('pk')).order_by('Study_id')
+        if export_format == 'sqlite':
+            return download_sqlite_snapshot(my_studies, my_results)
+        return stream_excel_worksheet(my_studies, my_results)
     
     def get_fields(self, request, obj=None):
         """ Get list of fields to view or edit in the object view/change page """
@@ -152,7 +210,14 @@ class BaseStudiesModelAdmin(ViewModelAdmin):
 
 
 @admin.register(Studies)
-class AllStudiesView(BaseStudiesModelAdmin):
+class AllStudiesView(ExportFilteredMixin, BaseStudiesModelAdmin):
+    changelist_class = KeysetChangeList
+    cached_counts = True
+    columnar_filters = True
+    cached_pages = True
+    conditional_views = True
+    show_full_result_count = False
+
     perm_view_all = Users.ACCESS_READONLY
     perm_view_owner = Users.ACCESS_READONLY
 
@@ -173,7 +238,14 @@ class AllStudiesView(BaseStudiesModelAdmin):
             if not self.has_change_permission(request, study):
                 messages.warning(request, 'Not allowed to edit one or more of the selected studies. If they were imported, edit them in the spreadsheet. If not, submit a correction/addition request.')
                 return
-        num_rows = queryset.update(Approved_by=None, Approved_time=None, Import_source=None)
+        # bulk updates bypass auto_now and the signals, so bump the change tracking timestamps and versions explicitly
+        now = timezone.now()
+        datasets = list(queryset.values_list('Dataset', flat=True).distinct())
+        version = bump_data_version(queryset.db, datasets)
+        record_deletions('study', queryset.values_list('pk', flat=True), version, queryset.db)
+        ResultsModel.objects.filter(Study__in=queryset.values('pk')).update(Updated_time=now, Change_version=version)
+        num_rows = queryset.update(Approved_by=None, Approved_time=None, Import_source=None, Updated_time=now,
+            Change_version=version)
         self.message_user(request, '%d studies reverted to draft for editing' % num_rows)
         return HttpResponseRedirect(reverse('admin:database_my_drafts_changelist'))
 
@@ -211,11 +283,16 @@ class EditMyDrafts(BaseStudiesModelAdmin):
         'get_method_html',
         'get_location_html',
         'get_notes_html',
+        'get_results_count',
+        'get_results_years',
     )
 
-    @admin.display(ordering='Created_time', description='Submission Details')
-    def get_submission_html(self, obj):
-        return render_to_string('database/data/study_submission_info.html', context={'row': obj})
+    # shows the users' names, which aren't part of the row version
+    get_submission_html = template_column('database/data/study_submission_info.html', cache_cells=False,
+        ordering='Created_time', description='Submission Details')
+
+    # used by the Created_by_name/Approved_by_name properties in the submission details
+    list_select_related = ('Created_by', 'Approved_by')
 
     actions = [*BaseStudiesModelAdmin.actions, 'approve_study']
 
@@ -237,5 +314,10 @@ class EditMyDrafts(BaseStudiesModelAdmin):
 
     @admin.action(description='Approve Selected')
     def approve_study(self, request, queryset):
-        num_rows = queryset.update(Approved_by=request.user, Approved_time=timezone.now())
+        now = timezone.now()
+        datasets = list(queryset.values_list('Dataset', flat=True).distinct())
+        version = bump_data_version(queryset.db, datasets)
+        ResultsModel.objects.filter(Study__in=queryset.values('pk')).update(Updated_time=now, Change_version=version)
+        num_rows = queryset.update(Approved_by=request.user, Approved_time=now, Updated_time=now,
+            Change_version=version)
         self.message_user(request, '%d studies marked as approved.' % num_rows)
@@ -0,0 +1,116 @@
+import re
+import warnings
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Model
+from django.template.loader import get_template
+
+# attribute paths used on the row object in list_display templates, eg. {{ row.Study.Paper_title }}
+ROW_ATTR_RE = re.compile(r'\brow((?:\.\w+)+)')
+
+@lru_cache(maxsize=None)
+def get_template_row_paths(template_name):
+    """ Returns the set of attribute paths (eg. 'Study.Paper_title') used on `row` in the template source """
+    source = get_template(template_name).template.source
+    return frozenset(match.group(1)[1:] for match in ROW_ATTR_RE.finditer(source))
+
+def get_path_relations(model, path):
+    """
+    Follows the attribute path through the model's relation fields, returning a list of
+    (lookup, is_single_valued) for each relation traversed, eg. [('Study', True), ('Study__Dataset', True)]
+    """
+    relations = []
+    lookup = []
+    single = True
+    opts = model._meta
+    for bit in path.split('.'):
+        try:
+            field = opts.get_field(bit)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation or field.related_model is None:
+            break
+        lookup.append(bit)
+        single = single and (field.many_to_one or field.one_to_one)
+        relations.append(('__'.join(lookup), single))
+        opts = field.related_model._meta
+    return relations
+
+@lru_cache(maxsize=None)
+def plan_template_relations(model, template_names):
+    """
+    Derives the select_related and prefetch_related lookups needed to render the given row templates
+    without extra queries per row. Returns (select_related, prefetch_related) sets.
+    """
+    select_related = set()
+    prefetch_related = set()
+    for template_name in template_names:
+        for path in get_template_row_paths(template_name):
+            for lookup, single in get_path_relations(model, path):
+                if single:
+                    select_related.add(lookup)
+                else:
+                    prefetch_related.add(lookup)
+
+    # select_related lookups which are covered by a longer select_related lookup are redundant
+    select_related = {
+        lookup for lookup in select_related
+        if not any(other.startswith(lookup + '__') for other in select_related)
+    }
+    return frozenset(select_related), frozenset(prefetch_related)
+
+def get_path_field_lookups(model, path):
+    """
+    Follows the attribute path through the model's fields, returning the lookups of the fields it uses,
+    eg. ['Study', 'Study__Paper_title'] for 'Study.Paper_title'. Attributes which aren't fields (eg. properties)
+    and many-valued relations end the path, as the fields they use can't be worked out from the template.
+    """
+    lookups = []
+    lookup = []
+    opts = model._meta
+    for bit in path.split('.'):
+        try:
+            field = opts.pk if bit == 'pk' else opts.get_field(bit)
+        except FieldDoesNotExist:
+            break
+        if not field.concrete or field.many_to_many:
+            break
+        lookup.append(field.name)
+        lookups.append('__'.join(lookup))
+        if not field.is_relation:
+            break
+        opts = field.related_model._meta
+    return lookups
+
+@lru_cache(maxsize=None)
+def plan_template_fields(model, template_names):
+    """ Derives the fields (only() lookups) used by the given row templates, see get_path_field_lookups() """
+    fields = set()
+    for template_name in template_names:
+        for path in get_template_row_paths(template_name):
+            fields.update(get_path_field_lookups(model, path))
+    return frozenset(fields)
+
+def get_loaded_objects(row):
+    """ The row and the related objects loaded with it (by select_related) """
+    objects = [row]
+    for obj in objects:
+        objects.extend(
+            related for related in obj._state.fields_cache.values()
+            if isinstance(related, Model) and not any(related is other for other in objects)
+        )
+    return objects
+
+@contextmanager
+def warn_deferred_loads(rows, description):
+    """ Warns about deferred fields of the rows (or their related objects) which are loaded within the block """
+    deferred = [ (obj, obj.get_deferred_fields()) for row in rows for obj in get_loaded_objects(row) ]
+    yield
+    loaded = set()
+    for obj, fields in deferred:
+        loaded.update((obj._meta.label, name) for name in fields - obj.get_deferred_fields())
+    if loaded:
+        warnings.warn('%s loaded deferred fields (one query per row): %s, add them to list_only_fields' % (
+            description, ', '.join('%s.%s' % field for field in sorted(loaded))), RuntimeWarning)
@@ -0,0 +1,80 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template import Context
+from django.template.loader import get_template
+
+ROW_CACHE_PREFIX = 'database.row'
+
+def get_row_cache_key(row):
+    # proxy models share the entry of their concrete model (the cells are stored per model name)
+    return '%s:%s:%s' % (ROW_CACHE_PREFIX, row._meta.concrete_model._meta.label_lower, row.pk)
+
+def invalidate_row_cache(instance):
+    cache.delete(get_row_cache_key(instance))
+
+class RowRenderer:
+    """
+    Renders the template columns for a page of rows in a single pass. Templates are resolved once
+    (when the renderer is created) and each row is rendered with one template Context shared by all
+    of its columns. The rendered cells are stored on each row as _rendered_cells (keyed by template
+    name), where the template_column() methods pick them up instead of rendering again.
+    This only saves the template lookups and Context setup, evaluating the templates is most of the
+    cost of a row, and is only avoided by the row cache.
+
+    Rows which provide get_row_version() have their cells cached, so the row templates must only
+    depend on the row itself (and the extra context, which is the same for every user), other
+    templates are given as uncached_names and rendered every time.
+    Cached cells are used for as long as the row version is unchanged, and are also removed when
+    the row is saved or deleted (see signals.py). With a per-process cache (see CACHES in settings.py)
+    that only removes them from the process which made the change, the others rely on the row version.
+    """
+    def __init__(self, template_names, uncached_names=()):
+        self.templates = [ (name, get_template(name).template) for name in template_names ]
+        self.cached_templates = [ (name, template) for name, template in self.templates if name not in uncached_names ]
+        self.uncached_templates = [ (name, template) for name, template in self.templates if name in uncached_names ]
+
+    def render_row(self, context, row, templates):
+        with context.push(row=row):
+            return { name: template.render(context) for name, template in templates }
+
+    def render(self, rows, **extra_context):
+        context = Context(extra_context)
+        timeout = settings.ROW_CACHE_TIMEOUT
+        cache_keys = {
+            row.pk: get_row_cache_key(row) for row in rows if timeout and hasattr(row, 'get_row_version')
+        }
+        cached = cache.get_many(cache_keys.values()) if cache_keys else {}
+        updated = {}
+
+        for row in rows:
+            if row.pk not in cache_keys:
+                row._rendered_cells = self.render_row(context, row, self.templates)
+                continue
+
+            key = cache_keys[row.pk]
+            version = row.get_row_version()
+            entry = cached.get(key)
+            if entry is None or entry['version'] != version:
+                entry = { 'version': version, 'cells': {} }
+
+            # cells are kept per model name, as the proxy models link to different admin pages
+            prefix = row._meta.model_name + ':'
+            missing = [ (name, template) for name, template in self.cached_templates if prefix + name not in entry['cells'] ]
+            if missing:
+                for name, html in self.render_row(context, row, missing).items():
+                    entry['cells'][prefix + name] = html
+                updated[key] = entry
+
+            row._rendered_cells = { name: entry['cells'][prefix + name] for name, _ in self.cached_templates }
+            if self.uncached_templates:
+                row._rendered_cells.update(self.render_row(context, row, self.uncached_templates))
+
+        if updated:
+            cache.set_many(updated, timeout)
+        return rows
+
+@lru_cache(maxsize=None)
+def get_row_renderer(template_names, uncached_names=()):
+    return RowRenderer(template_names, uncached_names)
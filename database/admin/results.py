@@ -1,7 +1,10 @@
 
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin
-from django.http import HttpResponseRedirect
+from django.contrib.admin.utils import quote
+from django.forms.models import BaseInlineFormSet
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.utils.functional import cached_property
 from django.utils.html import format_html, mark_safe
 from django.utils.http import urlencode
 from django.template.loader import render_to_string
@@ -10,42 +13,90 @@ from rangefilter.filters import NumericRangeFilter
 from admin_action_buttons.admin import ActionButtonsMixin
 
 from database.models import *
-from database.exporter import download_excel_worksheet
+from database.exporter import (
+    download_excel_worksheet, stream_excel_worksheet, stream_csv, RESULT_FIELDS)
+from database.snapshot import download_sqlite_snapshot
 
 from django_admin_listfilter_dropdown.filters import (
     DropdownFilter, ChoiceDropdownFilter, RelatedDropdownFilter)
 from django.db import models
 
-from database.filters import TwoNumbersInRangeFilter, ChoicesMultipleSelectFilter
-from .base import ViewModelAdmin
+from database.filters import HierarchicalFilter, TwoNumbersInRangeFilter, ChoicesMultipleSelectFilter, FacetDropdownFilter, FacetChoiceDropdownFilter
+from .changelist import KeysetChangeList
+from .base import ViewModelAdmin, ExportFilteredMixin, FullTextSearchMixin, template_column
+from .rendering import get_row_renderer
 
 class ResultsAdminMixin:
-    @admin.display(description='Study details')
-    def get_study_info_html(self, obj):
-        return render_to_string('database/data/result_study_info.html', context={'row': obj})
+    # the study columns are sorted by the keys of a studies index, then by the study's results newest first
+    # (see results_study_order_idx), so the rows are read in order through the join instead of sorted
+    get_study_info_html = template_column('database/data/result_study_info.html',
+        ordering=('Study__Disease', 'Study__Year', 'Study', 'pk'), description='Study details')
+    get_method_info_html = template_column('database/data/result_method_info.html',
+        ordering=('Study__Data_source', 'Study__Diagnosis_method', 'Study', 'pk'), description='Method details')
+    get_population_html = template_column('database/data/result_population_info.html',
+        ordering=('Year_start', 'Year_stop', 'pk'), description='Population')
+    get_location_html = template_column('database/data/result_location_info.html',
+        ordering=('Country', 'Jurisdiction', 'pk'), description='Geographic Info')
+    get_flags_html = template_column('database/data/row_flags.html', description='Flags')
+    get_point_estimate_html = template_column('database/data/result_point_estimate.html',
+        ordering=('Point_estimate_value', 'pk'), description='Point Estimate')
 
-    @admin.display(description='Method details')
-    def get_method_info_html(self, obj):
-        return render_to_string('database/data/result_method_info.html', context={'row': obj})
+def get_study_results_page(study, per_page, before=None):
+    """
+    Returns (rows, has_more) for a page of the study's results, newest first (see results_study_order_idx),
+    the page after the result with pk `before` if given
+    """
+    queryset = ResultsModel.objects.filter(Study=study)
+    if before is not None:
+        queryset = queryset.filter(pk__lt=before)
+    rows = list(queryset.order_by('-pk')[:per_page + 1])
+    for row in rows:
+        row.Study = study # all from the same study (used by the row templates)
+    return rows[:per_page], len(rows) > per_page
 
-    @admin.display(description='Population')
-    def get_population_html(self, obj):
-        return render_to_string('database/data/result_population_info.html', context={'row': obj})
+class ResultsPageFormSet(BaseInlineFormSet):
+    """
+    Formset of the first page of a study's results (for ReadonlyResultsInline), with the cells rendered
+    in one pass. The results are only counted when they don't all fit on the first page.
+    """
+    per_page = None
+    row_templates = ()
 
-    @admin.display(description='Geographic Info')
-    def get_location_html(self, obj):
-        return render_to_string('database/data/result_location_info.html', context={'row': obj})
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            if self.instance.pk is None:
+                self._queryset, self.has_more = [], False
+            else:
+                self._queryset, self.has_more = get_study_results_page(self.instance, self.per_page)
+            get_row_renderer(self.row_templates).render(self._queryset)
+        return self._queryset
 
-    @admin.display(description='Flags')
-    def get_flags_html(self, obj):
-        return render_to_string('database/data/row_flags.html', context={'row': obj})
+    @cached_property
+    def total_count(self):
+        rows = self.get_queryset()
+        if not self.has_more:
+            return len(rows)
+        return ResultsModel.objects.filter(Study=self.instance).count()
 
-    @admin.display(description='Point Estimate')
-    def get_point_estimate_html(self, obj):
-        return render_to_string('database/data/result_point_estimate.html', context={'row': obj})
+    @property
+    def next_url(self):
+        rows = self.get_queryset()
+        if not self.has_more:
+            return None
+        return get_results_page_url(self.instance, rows[-1])
+
+def get_results_page_url(study, last_row):
+    info = study._meta.app_label, study._meta.model_name
+    return '%s?%s' % (reverse('admin:%s_%s_results' % info, args=[quote(study.pk)]), urlencode({'before': last_row.pk}))
 
 class ReadonlyResultsInline(ResultsAdminMixin, admin.TabularInline):
+    """
+    The results of a study (on its change page), the first page is shown with the study,
+    later pages are loaded on demand from the study's results page endpoint (see results_page_view)
+    """
     model = ResultsModel
+    formset = ResultsPageFormSet
+    template = 'admin/edit_inline/results_page.html'
     can_delete = False
     fields = readonly_fields = (
         'get_population_html',
@@ -54,12 +105,44 @@ class ReadonlyResultsInline(ResultsAdminMixin, admin.TabularInline):
         'get_point_estimate_html',
     )
     max_num = 0
+    per_page = 50
+
+    class Media:
+        js = ('js/results-inline.js', )
 
     def has_view_permission(self, request, obj=None):
         return True
 
+    def get_row_templates(self):
+        return tuple(getattr(self, name).row_template for name in self.fields)
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.per_page = self.per_page
+        formset.row_templates = self.get_row_templates()
+        return formset
 
-class BaseResultsModelAdmin(ResultsAdminMixin, ViewModelAdmin):
+    def results_page_view(self, request, study):
+        """ The rows of the page of the study's results after ?before=<pk>, for adding to the inline table """
+        try:
+            before = int(request.GET['before'])
+        except (KeyError, ValueError):
+            raise Http404('Invalid page')
+        rows, has_more = get_study_results_page(study, self.per_page, before)
+        templates = self.get_row_templates()
+        get_row_renderer(templates).render(rows)
+        return JsonResponse({
+            'html': render_to_string('admin/edit_inline/results_page_rows.html', {
+                'rows': [
+                    (row, [ (field, row._rendered_cells[template]) for field, template in zip(self.fields, templates) ])
+                    for row in rows
+                ],
+            }),
+            'next': get_results_page_url(study, rows[-1]) if has_more else None,
+        })
+
+
+class BaseResultsModelAdmin(FullTextSearchMixin, ResultsAdminMixin, ViewModelAdmin):
     list_display = (
         'get_study_info_html',
         'get_method_info_html',
@@ -73,10 +156,12 @@ class BaseResultsModelAdmin(ResultsAdminMixin, ViewModelAdmin):
 
     list_filter = (
         # Methods-related filters
-        ('Study__Study_group', ChoiceDropdownFilter), # hierarchy Study_group -> Disease as sub-category
-        ('Study__Disease', ChoicesMultipleSelectFilter), # multiple select within Study_group options
+        HierarchicalFilter.create('Study group and disease', (
+            ('Study__Study_group', FacetChoiceDropdownFilter), # single select
+            ('Study__Disease', ChoicesMultipleSelectFilter), # multiple select within Study_group options
+        )),
         ('Study__Year', NumericRangeFilter), # standard number range (inclusive)
-        ('Study__Study_design', ChoiceDropdownFilter), # single select
+        ('Study__Study_design', FacetChoiceDropdownFilter), # single select
         ('Study__Diagnosis_method', ChoicesMultipleSelectFilter), # multiple select
         ('Study__Data_source', ChoicesMultipleSelectFilter), # multiple select
         ('Study__Surveillance_setting', ChoicesMultipleSelectFilter), # multiple select
@@ -89,12 +174,15 @@ class BaseResultsModelAdmin(ResultsAdminMixin, ViewModelAdmin):
         ('Age_general', ChoicesMultipleSelectFilter), # multiple select
         ('Population_gender', ChoicesMultipleSelectFilter), # multiple select
         ('Indigenous_population', ChoicesMultipleSelectFilter), # multiple select
-        ('Country', DropdownFilter), # single select hierarchy Country -> Jurisdiction
-        ('Jurisdiction', DropdownFilter), # multiple select from distinct values only with matching Country
+        HierarchicalFilter.create('Country and jurisdiction', (
+            ('Country', FacetDropdownFilter), # single select
+            ('Jurisdiction', FacetDropdownFilter), # single select from the jurisdictions of the Country
+        )),
         (TwoNumbersInRangeFilter.create('Observation dates (year)', ('Year_start', 'Year_stop'))), # single filter for entire start/stop range (inclusive of partial range overlaps)
+        (TwoNumbersInRangeFilter.create('Ages (years)', ('Age_min', 'Age_max'))), # same for the age range of the population
         #('Year_stop', NumericRangeFilter),
-        ('Proportion', DropdownFilter), # single select
-        ('StrepA_attributable_fraction', DropdownFilter), # single select
+        ('Proportion', FacetDropdownFilter), # single select
+        ('StrepA_attributable_fraction', FacetDropdownFilter), # single select
     )
 
     actions = ['export_selected', 'view_parent_studies', 'delete_selected']
@@ -135,10 +223,18 @@ class BaseResultsModelAdmin(ResultsAdminMixin, ViewModelAdmin):
         'Point_estimate',
         'Measure',
     )
-    search_help_text = 'Search keywords in all fields. Put quotes around search terms to find exact phrases only.'
+    search_related = ('Study', )
+    search_help_text = 'Search keywords in all fields, keywords match whole words or the start of words (eg. strep finds Streptococcal, but coccal does not). Put quotes around search terms to find exact phrases only. Put ~ before a word to find near matches of titles, authors and locations (eg. ~Kimberly).'
 
     checkbox_template = 'database/data/result_row_header.html'
 
+    # fields used by the row properties (exact_age_text, get_flags) and the row cache versions, besides those
+    # used directly by the row templates
+    list_only_fields = (
+        'Updated_time', 'Study__Updated_time', 'Age_min', 'Age_max',
+        *(field.name for field in ResultsModel.get_flag_fields()),
+    )
+
     @admin.action(description='View Studies for Selection')
     def view_parent_studies(self, request, queryset):
         study_ids = set()
@@ -149,14 +245,33 @@ class BaseResultsModelAdmin(ResultsAdminMixin, ViewModelAdmin):
 
     @admin.action(description='Export Selected to Excel')
     def export_selected(self, request, queryset):
-        study_ids = set(queryset.values_list('Study_id', flat=True))
         my_studies = StudiesModel.objects.filter(
-            pk__in=study_ids,
+            pk__in=queryset.values('Study_id'),
         ).order_by('pk')
         return download_excel_worksheet(my_studies, queryset.order_by('pk'))
 
+    def export_queryset(self, queryset, export_format):
+        my_results = queryset.order_by('pk')
+        if export_format == 'csv':
+            return stream_csv(my_results, RESULT_FIELDS, 'Results')
+
+        # parent studies are selected with a subquery on the filtered results
+        my_studies = StudiesModel.objects.filter(
+            pk__in=queryset.values('Study_id'),
+        ).order_by('pk')
+        if export_format == 'sqlite':
+            return download_sqlite_snapshot(my_studies, my_results)
+        return stream_excel_worksheet(my_studies, my_results)
+
 @admin.register(Results)
-class AllResultsView(BaseResultsModelAdmin):
+class AllResultsView(ExportFilteredMixin, BaseResultsModelAdmin):
+    changelist_class = KeysetChangeList
+    cached_counts = True
+    columnar_filters = True
+    cached_pages = True
+    conditional_views = True
+    show_full_result_count = False
+
     perm_view_all = Users.ACCESS_READONLY
     perm_view_owner = Users.ACCESS_READONLY
 
@@ -0,0 +1,154 @@
+import json
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.views.decorators.http import require_GET
+
+from database.models import Studies, Results, ResultsModel
+from database.admin_site import admin_site
+from database.changes import get_changes
+
+API_MODELS = {
+    'studies': Studies,
+    'results': Results,
+}
+
+# query string parameters used by the API itself, everything else is passed on to the changelist filters
+CURSOR_VAR = 'cursor'
+SINCE_VAR = 'since'
+LIMIT_VAR = 'limit'
+FORMAT_VAR = 'format'
+API_PARAMS = (CURSOR_VAR, LIMIT_VAR, FORMAT_VAR)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+NDJSON_CHUNK_SIZE = 2000
+
+def get_api_fields(model):
+    """ field names returned for each row (the first IMPORT_FIELDS entry is the import identifier) """
+    if issubclass(model, ResultsModel):
+        fields = ['id', 'Study_id']
+    else:
+        fields = ['id', 'Dataset_id', 'Approved_time', 'Updated_time']
+    return fields + list(model.IMPORT_FIELDS[1:])
+
+def api_error(status, message):
+    return JsonResponse({'error': message}, status=status)
+
+def check_api_user(request, model):
+    """ Returns an error response if the user can't view the model (through the admin site), otherwise None """
+    if not request.user.is_authenticated or not request.user.is_active:
+        return api_error(401, 'Authentication required')
+    if not admin_site._registry[model].has_view_permission(request):
+        return api_error(403, 'Permission denied')
+
+def get_filtered_queryset(request, model_admin):
+    """
+    Apply the changelist filters and search (same query string vocabulary as the admin site)
+    to the model admin's queryset. May raise IncorrectLookupParameters.
+    """
+    params = request.GET.copy()
+    for param in API_PARAMS:
+        params.pop(param, None)
+    request.GET = params
+    request.export_only = True
+    return model_admin.get_changelist_instance(request).queryset
+
+def encode_cursor(pk):
+    return str(pk)
+
+def decode_cursor(cursor):
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        raise IncorrectLookupParameters('Invalid cursor')
+
+def generate_ndjson(queryset, fields):
+    for row in queryset.values(*fields).iterator(chunk_size=NDJSON_CHUNK_SIZE):
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+@require_GET
+def api_list(request, model_name):
+    """
+    Read-only list of approved studies or results, eg.
+        /api/results/?Study__Disease__in=ARF&Jurisdiction=WA&limit=500
+        /api/results/?cursor=1234 (next page, as given by the "next" link)
+        /api/studies/?format=ndjson (stream all matching rows, one JSON object per line)
+    Rows are ordered by id, and paginated with a keyset cursor (the last id of the previous page).
+    """
+    model = API_MODELS.get(model_name)
+    if model is None:
+        raise Http404('Unknown API endpoint')
+
+    error = check_api_user(request, model)
+    if error:
+        return error
+    model_admin = admin_site._registry[model]
+
+    api_params = request.GET
+    fields = get_api_fields(model)
+    try:
+        queryset = get_filtered_queryset(request, model_admin).order_by('pk')
+        if api_params.get(CURSOR_VAR):
+            queryset = queryset.filter(pk__gt=decode_cursor(api_params[CURSOR_VAR]))
+        limit = max(1, min(int(api_params.get(LIMIT_VAR, DEFAULT_LIMIT)), MAX_LIMIT))
+    except ValueError:
+        return api_error(400, 'Invalid limit')
+    except IncorrectLookupParameters as e:
+        return api_error(400, 'Invalid filter parameters: %s' % e)
+
+    if api_params.get(FORMAT_VAR) == 'ndjson':
+        return StreamingHttpResponse(generate_ndjson(queryset, fields), content_type='application/x-ndjson')
+
+    rows = list(queryset.values(*fields)[:limit + 1])
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_params = api_params.copy()
+        next_params[CURSOR_VAR] = encode_cursor(rows[-1]['id'])
+        next_url = request.path + '?' + next_params.urlencode()
+
+    return JsonResponse({
+        'next': next_url,
+        'results': rows,
+    })
+
+def generate_change_lines(changes):
+    """ NDJSON lines for a change set from get_changes(), ending with a line containing the next cursor """
+    for model_name, queryset in (('study', changes['studies']), ('result', changes['results'])):
+        for row in queryset.values(*get_api_fields(queryset.model)).iterator(chunk_size=NDJSON_CHUNK_SIZE):
+            yield json.dumps({'model': model_name, 'op': 'upsert', 'data': row}, cls=DjangoJSONEncoder) + '\n'
+    for item in changes['deleted']:
+        yield json.dumps({'op': 'delete', **item}) + '\n'
+    yield json.dumps({'cursor': changes['cursor']}) + '\n'
+
+@require_GET
+def api_changes(request):
+    """
+    Approved studies and results created, updated or deleted since a cursor, eg.
+        /api/changes/ (everything, for the initial sync)
+        /api/changes/?since=1234 (the cursor returned by the previous call)
+        /api/changes/?since=...&format=ndjson (one change per line, the last line contains the next cursor)
+    """
+    error = check_api_user(request, Studies) or check_api_user(request, Results)
+    if error:
+        return error
+
+    try:
+        changes = get_changes(request.GET.get(SINCE_VAR))
+    except ValidationError as e:
+        return api_error(400, e.messages[0])
+
+    if request.GET.get(FORMAT_VAR) == 'ndjson':
+        resp = StreamingHttpResponse(generate_change_lines(changes), content_type='application/x-ndjson')
+        resp['X-Change-Cursor'] = changes['cursor']
+        return resp
+
+    return JsonResponse({
+        'cursor': changes['cursor'],
+        'studies': list(changes['studies'].values(*get_api_fields(Studies))),
+        'results': list(changes['results'].values(*get_api_fields(Results))),
+        'deleted': changes['deleted'],
+    })
@@ -6,3 +6,6 @@ class DatabaseConfig(AppConfig):
     name = 'database'
     label = 'database'
     verbose_name = 'Strep A Research Database'
+
+    def ready(self):
+        from . import signals
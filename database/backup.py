@@ -0,0 +1,176 @@
+"""
+Backups of Datasets as a zip of one Excel workbook per Dataset, with a manifest.json of row counts and checksums.
+
+The workbooks are built concurrently in a process pool, which is only ever run by the backup_datasets command:
+the Dataset admin action starts the command in a separate process (see start_backup_job) and the finished
+backups are downloaded from the Dataset admin, so web workers neither build backups nor fork.
+"""
+import hashlib, io, json, logging, os, subprocess, sys, threading, zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import xlsxwriter
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils import timezone
+from django.utils.text import slugify
+
+from database.models import Dataset, StudiesModel, ResultsModel
+from database.exporter import write_excel_workbook
+
+logger = logging.getLogger(__name__)
+
+def get_backup_workers(num_datasets):
+    max_workers = getattr(settings, 'BACKUP_MAX_WORKERS', None) or os.cpu_count() or 1
+    return max(1, min(max_workers, num_datasets))
+
+def init_backup_worker():
+    """ Process pool initializer: make sure Django is set up and no DB connections are shared with the parent """
+    import django
+    django.setup()
+    connections.close_all()
+
+def build_dataset_workbook(dataset_id):
+    """
+    Builds the backup workbook for a single Dataset (runs in a worker process).
+    Returns a dict with the workbook file name, data and row counts.
+    """
+    dataset = Dataset.objects.get(pk=dataset_id)
+    studies = list(StudiesModel.objects.filter(
+        Dataset_id = dataset_id,
+    ).order_by('Study_group', 'pk'))
+    results = list(ResultsModel.objects.filter(
+        Study__Dataset_id = dataset_id,
+    ).order_by('Study__Study_group', 'Study_id'))
+
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    write_excel_workbook(workbook, studies, results)
+    workbook.close()
+
+    return {
+        'dataset': dataset.Dataset_name,
+        'filename': '%s.xlsx' % (slugify(dataset.Dataset_name) or 'dataset-%d' % dataset.pk),
+        'data': output.getvalue(),
+        'studies': len(studies),
+        'results': len(results),
+    }
+
+def build_dataset_workbooks(dataset_ids):
+    """
+    Generates backup workbooks for each Dataset id, in order of completion.
+    Workbooks are built concurrently in a process pool when more than one worker is available.
+    """
+    dataset_ids = list(dataset_ids)
+    max_workers = get_backup_workers(len(dataset_ids))
+    if max_workers == 1:
+        for dataset_id in dataset_ids:
+            yield build_dataset_workbook(dataset_id)
+        return
+
+    # connections must not be inherited by the forked workers
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_backup_worker) as pool:
+        futures = [ pool.submit(build_dataset_workbook, dataset_id) for dataset_id in dataset_ids ]
+        for future in as_completed(futures):
+            yield future.result()
+
+class ZipStreamBuffer:
+    """ Unseekable file-like object for ZipFile, which hands back the bytes written since the last read """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_written(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def generate_backup_zip(dataset_ids):
+    """
+    Generates the chunks of a zip file containing one workbook per Dataset and a manifest.json
+    listing the row counts and SHA-256 checksum of each workbook.
+    """
+    buffer = ZipStreamBuffer()
+    manifest = {
+        'created': timezone.now().isoformat(),
+        'datasets': [],
+    }
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for workbook in build_dataset_workbooks(dataset_ids):
+            zf.writestr(workbook['filename'], workbook['data'])
+            manifest['datasets'].append({
+                'dataset': workbook['dataset'],
+                'file': workbook['filename'],
+                'studies': workbook['studies'],
+                'results': workbook['results'],
+                'sha256': hashlib.sha256(workbook['data']).hexdigest(),
+            })
+            yield buffer.read_written()
+
+        manifest['datasets'].sort(key=lambda x: x['dataset'])
+        zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+    yield buffer.read_written()
+
+def write_backup_zip(dataset_ids, path):
+    """ Writes the backup zip to the path, through a temporary file so that only complete backups are listed """
+    partial_path = '%s.part' % path
+    try:
+        with open(partial_path, 'wb') as output:
+            for chunk in generate_backup_zip(dataset_ids):
+                output.write(chunk)
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+def get_backup_dir():
+    """ The directory of the backups, or None if settings.BACKUP_ROOT isn't set """
+    return Path(settings.BACKUP_ROOT) if settings.BACKUP_ROOT else None
+
+def start_backup_job(dataset_ids):
+    """
+    Starts the backup_datasets command for the Dataset ids in a new process (which outlives the request),
+    and returns the file name the backup will be saved as once it is complete (see list_backups).
+    The command's output is kept next to the backup, as <file name>.log.
+    Raises ImproperlyConfigured if there is no backup directory.
+    """
+    backup_dir = get_backup_dir()
+    if backup_dir is None:
+        raise ImproperlyConfigured('Backups are not available until BACKUP_ROOT is set')
+    backup_dir.mkdir(parents=True, exist_ok=True)
+    filename = 'ASAVI-StrepA-Backup_%s.zip' % timezone.localtime().strftime('%Y-%m-%d_%H%M%S')
+    args = [sys.executable, str(Path(settings.BASE_DIR) / 'manage.py'), 'backup_datasets', str(backup_dir / filename)]
+    for dataset_id in dataset_ids:
+        args += ['--dataset-id', str(dataset_id)]
+    with open(backup_dir / ('%s.log' % filename), 'wb') as log:
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    # reaped once it exits, so that long lived web workers aren't left with a zombie process for every backup
+    threading.Thread(target=process.wait, daemon=True).start()
+    logger.info('Started backup of datasets %s to %s', list(dataset_ids), filename)
+    return filename
+
+def list_backups():
+    """ Returns [(file name, size, modified time)] of the complete backups, newest first """
+    backup_dir = get_backup_dir()
+    if backup_dir is None or not backup_dir.is_dir():
+        return []
+    backups = []
+    for path in backup_dir.glob('*.zip'):
+        stat = path.stat()
+        backups.append((path.name, stat.st_size, timezone.make_aware(datetime.fromtimestamp(stat.st_mtime))))
+    return sorted(backups, key=lambda backup: backup[2], reverse=True)
+
+def get_backup_path(filename):
+    """ Path of the complete backup with the file name, or None """
+    if filename not in [ name for name, _, _ in list_backups() ]:
+        return None
+    return get_backup_dir() / filename
@@ -0,0 +1,76 @@
+from django.core.exceptions import ValidationError
+
+from database.models import StudiesModel, ResultsModel, Studies, Results, DeletedRecord
+from database.versioning import get_data_version_stamp
+
+def get_change_model_name(instance):
+    """ name used for studies/results in the change feed (proxy models are reported as their concrete model) """
+    if isinstance(instance, StudiesModel):
+        return 'study'
+    if isinstance(instance, ResultsModel):
+        return 'result'
+
+def record_deletions(model_name, pks, version, using='default'):
+    """ Leaves tombstones for the deleted or withdrawn rows, written at the data version """
+    DeletedRecord.objects.using(using).bulk_create(
+        DeletedRecord(Model_name=model_name, Object_id=pk, Version=version) for pk in pks)
+
+def encode_change_cursor(version):
+    return str(version)
+
+def decode_change_cursor(cursor):
+    """ cursors are data versions (as returned by a previous call to get_changes) """
+    try:
+        value = int(cursor)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise ValidationError('Invalid change cursor "%s"' % cursor)
+    return value
+
+def get_changes(since=None, using='default', include_drafts=False):
+    """
+    Returns the studies and results which were created, updated or deleted since the given cursor
+    (or everything if no cursor is given), and the cursor to use for the next call.
+
+    Returns dict of {
+        'cursor': next cursor,
+        'studies': queryset of approved studies which were added/changed,
+        'results': queryset of approved results which were added/changed,
+        'deleted': list of {'model': 'study'/'result', 'id': pk} for deleted or withdrawn (reverted to draft) rows
+    }
+    Withdrawn studies are reported as deleted, their results should be treated as deleted too.
+    With include_drafts the drafts are included (withdrawn studies are then changed rather than deleted),
+    the drafts which have been deleted aren't reported though.
+    """
+    # everything up to the current data version, the writes of later versions (including those which
+    # haven't been committed yet) are picked up by the next call (see versioning.py)
+    until = get_data_version_stamp(using)[0]
+    since = decode_change_cursor(since) if since else None
+
+    def changed(qs, field):
+        qs = qs.using(using)
+        if since is not None:
+            # rows which haven't been written since the versions were added (null) are in the initial sync only
+            qs = qs.filter(**{'%s__gt' % field: since, '%s__lte' % field: until})
+        return qs
+
+    studies = changed((StudiesModel if include_drafts else Studies).objects.all(), 'Change_version').order_by('pk')
+    results = changed((ResultsModel if include_drafts else Results).objects.all(), 'Change_version').order_by('pk')
+
+    deleted = []
+    if since is not None:
+        # studies which were withdrawn and approved again are reported as changed
+        tombstones = changed(DeletedRecord.objects.all(), 'Version').exclude(
+            Model_name='study', Object_id__in=studies.values('pk'))
+        deleted = [
+            {'model': model_name, 'id': pk} for model_name, pk in
+            dict.fromkeys(tombstones.order_by('pk').values_list('Model_name', 'Object_id'))
+        ]
+
+    return {
+        'cursor': encode_change_cursor(until),
+        'studies': studies,
+        'results': results,
+        'deleted': deleted,
+    }
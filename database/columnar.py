@@ -0,0 +1,388 @@
+"""
+In-memory columnar index of the approved studies/results, used to answer the Studies and Results changelists
+(list_filter combinations, range filters, counts and facet counts) without querying the database.
+
+Each index keeps the filtered columns of every row as NumPy arrays in the changelist ordering: choice, text and
+boolean columns are dictionary encoded with a bitmap (boolean array) of the rows for each value, numeric columns
+are float arrays (NaN for null). A combination of filters is a mask of the rows, so counts, facet counts and
+pages are a few vectorised operations over the arrays.
+
+Each index is at a cursor of the change feed (see changes.py), and answers the requests which read the data at
+or before that version. Requests which read a later version schedule an update: the index is then refreshed from
+the change feed, or rebuilt when rows were added or moved in the ordering, or too many rows changed. Updates run
+in a background thread, requests never wait for them and use SQL as usual until the index has caught up, as well
+as for searches, orderings and filters it can't answer.
+Enabled by settings.COLUMNAR_FILTERS.
+"""
+import logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.contrib.admin.filters import FieldListFilter
+from django.contrib.admin.utils import unquote
+from django.core.exceptions import ValidationError
+from django.db import connections
+from rangefilter.filters import NumericRangeFilter
+
+from database.changes import decode_change_cursor, get_changes
+from database.filters import ChoicesMultipleSelectFilter, TwoNumbersInRangeFilter, get_filter_specs
+from database.models import StudiesModel, ResultsModel
+
+logger = logging.getLogger(__name__)
+
+# refreshes with more changed rows than this rebuild the index instead
+COLUMNAR_MAX_CHANGES = 1000
+
+NUMBER_FIELD_TYPES = (
+    'IntegerField', 'SmallIntegerField', 'BigIntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'PositiveBigIntegerField', 'FloatField', 'DecimalField',
+)
+
+NUMBER_LOOKUPS = {
+    'exact': np.equal,
+    'gt': np.greater,
+    'gte': np.greater_equal,
+    'lt': np.less,
+    'lte': np.less_equal,
+}
+
+LOOKUPS = ('exact', 'in', 'isnull', *NUMBER_LOOKUPS)
+
+class ChoiceColumn:
+    """ Dictionary encoded column, with a bitmap of the rows for each value and for null """
+    def __init__(self, field, values):
+        self.field = field
+        self.values = []
+        self.value_codes = {}
+        self.codes = np.fromiter((self.encode(value) for value in values), dtype=np.int32, count=len(values))
+        self.bitmaps = [ self.codes == code for code in range(len(self.values)) ]
+        self.nulls = self.codes == -1
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        code = self.value_codes.get(value)
+        if code is None:
+            code = self.value_codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def copy(self):
+        column = ChoiceColumn.__new__(ChoiceColumn)
+        column.field = self.field
+        column.values = list(self.values)
+        column.value_codes = dict(self.value_codes)
+        column.codes = self.codes.copy()
+        column.bitmaps = [ bitmap.copy() for bitmap in self.bitmaps ]
+        column.nulls = self.nulls.copy()
+        return column
+
+    def set(self, position, value):
+        old_code = self.codes[position]
+        (self.bitmaps[old_code] if old_code >= 0 else self.nulls)[position] = False
+        code = self.codes[position] = self.encode(value)
+        while len(self.bitmaps) < len(self.values):
+            self.bitmaps.append(np.zeros(len(self.codes), dtype=bool))
+        (self.bitmaps[code] if code >= 0 else self.nulls)[position] = True
+
+    def match(self, lookup, value):
+        if lookup == 'isnull':
+            return self.nulls if value else ~self.nulls
+        if lookup == 'exact':
+            value = [value]
+        elif lookup != 'in':
+            return None
+        mask = np.zeros(len(self.codes), dtype=bool)
+        for item in value:
+            try:
+                code = self.value_codes.get(self.field.to_python(item))
+            except ValidationError:
+                return None
+            if code is not None:
+                mask |= self.bitmaps[code]
+        return mask
+
+    def counts(self, mask):
+        """ {value: number of rows} of the rows in the mask (like counting.get_facet_counts) """
+        counts = np.bincount(self.codes[mask] + 1, minlength=len(self.values) + 1)
+        values = [None] + self.values
+        return { values[code]: int(count) for code, count in enumerate(counts) if count }
+
+class NumberColumn:
+    """ Numeric column as floats, null values are NaN """
+    def __init__(self, field, values):
+        self.field = field
+        self.data = np.fromiter((self.encode(value) for value in values), dtype=np.float64, count=len(values))
+
+    @staticmethod
+    def encode(value):
+        return np.nan if value is None else float(value)
+
+    def copy(self):
+        column = NumberColumn.__new__(NumberColumn)
+        column.field = self.field
+        column.data = self.data.copy()
+        return column
+
+    def set(self, position, value):
+        self.data[position] = self.encode(value)
+
+    def match(self, lookup, value):
+        if lookup == 'isnull':
+            nulls = np.isnan(self.data)
+            return nulls if value else ~nulls
+        if lookup not in NUMBER_LOOKUPS:
+            return None
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        # comparisons with NaN are false, so null values never match (as in SQL)
+        return NUMBER_LOOKUPS[lookup](self.data, value)
+
+    def counts(self, mask):
+        return None
+
+def get_field(model, path):
+    *relations, name = path.split('__')
+    opts = model._meta
+    for relation in relations:
+        opts = opts.get_field(relation).related_model._meta
+    return opts.get_field(name)
+
+class ColumnarIndex:
+    """ Columns of the rows of the queryset, in the ordering (which must include the pk) """
+    def __init__(self, queryset, field_paths, ordering):
+        self.queryset = queryset.order_by(*ordering)
+        self.field_paths = list(field_paths)
+        self.key_paths = [ item.lstrip('-') for item in ordering ]
+
+        # changes from here on are applied by refresh()
+        self.cursor = decode_change_cursor(get_changes(using=queryset.db)['cursor'])
+        rows = list(self.queryset.values_list(*self.key_paths, *self.field_paths))
+        pk_index = self.key_paths.index('pk')
+        num_keys = len(self.key_paths)
+
+        self.pks = np.fromiter((row[pk_index] for row in rows), dtype=np.int64, count=len(rows))
+        self.positions = { pk: position for position, pk in enumerate(self.pks.tolist()) }
+        self.keys = [ row[:num_keys] for row in rows ]
+        self.alive = np.ones(len(rows), dtype=bool)
+        self.columns = {}
+        for i, path in enumerate(self.field_paths, num_keys):
+            field = get_field(self.queryset.model, path)
+            column_class = NumberColumn if field.get_internal_type() in NUMBER_FIELD_TYPES else ChoiceColumn
+            self.columns[path] = column_class(field, [ row[i] for row in rows ])
+
+    def copy(self):
+        index = ColumnarIndex.__new__(ColumnarIndex)
+        index.__dict__.update(self.__dict__)
+        index.alive = self.alive.copy()
+        index.columns = { path: column.copy() for path, column in self.columns.items() }
+        return index
+
+    def get_changed_rows(self, changes):
+        """ Returns (pks of the rows to reload, pks of the rows to remove) for the changes from get_changes() """
+        deleted = {}
+        for item in changes['deleted']:
+            deleted.setdefault(item['model'], set()).add(item['id'])
+
+        if self.queryset.model._meta.concrete_model is StudiesModel:
+            changed = set(changes['studies'].values_list('pk', flat=True))
+            return changed, deleted.get('study', set())
+
+        # results are also changed by changes to their study
+        changed = set(changes['results'].values_list('pk', flat=True))
+        changed.update(self.queryset.filter(Study__in=changes['studies'].values('pk')).values_list('pk', flat=True))
+        removed = deleted.get('result', set())
+        if deleted.get('study'):
+            removed.update(ResultsModel.objects.filter(Study__in=deleted['study']).values_list('pk', flat=True))
+        return changed, removed
+
+    def refresh(self):
+        """ A copy of the index with the changes since it was built/refreshed, or None if it has to be rebuilt """
+        changes = get_changes(self.cursor, using=self.queryset.db)
+        changed, removed = self.get_changed_rows(changes)
+        if len(changed) + len(removed) > COLUMNAR_MAX_CHANGES:
+            return None
+
+        num_keys = len(self.key_paths)
+        updates = []
+        for row in self.queryset.filter(pk__in=changed).values_list(*self.key_paths, *self.field_paths):
+            position = self.positions.get(row[self.key_paths.index('pk')])
+            if position is None or row[:num_keys] != self.keys[position]:
+                return None # new row, or moved in the ordering
+            updates.append((position, row[num_keys:]))
+
+        index = self.copy()
+        index.cursor = decode_change_cursor(changes['cursor'])
+        for pk in removed | changed:
+            position = index.positions.get(pk)
+            if position is not None:
+                index.alive[position] = False
+        for position, values in updates:
+            index.alive[position] = True
+            for path, value in zip(self.field_paths, values):
+                index.columns[path].set(position, value)
+        return index
+
+    def get_mask(self, lookups):
+        """ Rows matching all of the lookups ({'field_path__lookup': value}), or None if a lookup isn't supported """
+        mask = self.alive.copy()
+        for key, value in lookups.items():
+            path, _, lookup = key.rpartition('__')
+            if lookup not in LOOKUPS:
+                path, lookup = key, 'exact' # eg. AllValuesFieldListFilter
+            column = self.columns.get(path)
+            match = column.match(lookup, value) if column is not None else None
+            if match is None:
+                return None
+            mask &= match
+        return mask
+
+_indexes = {}
+# keys of the indexes with an update queued or running
+_pending = set()
+_pending_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='columnar')
+
+def update_columnar_index(key, queryset, field_paths, ordering):
+    """ Brings the index up to date with the change feed, or builds it """
+    index = _indexes.get(key)
+    # refreshed indexes are copies, so requests using the current index aren't affected
+    _indexes[key] = (index and index.refresh()) or ColumnarIndex(queryset, field_paths, ordering)
+
+def run_update(key, queryset, field_paths, ordering):
+    try:
+        update_columnar_index(key, queryset, field_paths, ordering)
+    except Exception:
+        logger.exception('Update of the columnar index %s failed', key)
+    finally:
+        with _pending_lock:
+            _pending.discard(key)
+        # the worker thread's own connections
+        connections.close_all()
+
+def schedule_update(key, queryset, field_paths, ordering):
+    """ Queues update_columnar_index() on the background thread, unless the index already has an update queued """
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    _executor.submit(run_update, key, queryset, field_paths, ordering)
+
+def get_columnar_index(queryset, field_paths, ordering, cursor):
+    """ The index of the queryset's rows at (or after) the change feed cursor, or None if it isn't up to date yet """
+    key = (queryset.db, queryset.model._meta.label, tuple(field_paths), tuple(ordering))
+    index = _indexes.get(key)
+    if index is None or index.cursor < cursor:
+        schedule_update(key, queryset, field_paths, ordering)
+        # the update may have finished already
+        index = _indexes.get(key)
+    if index is None or index.cursor < cursor:
+        return None
+    return index
+
+def get_filter_fields(spec):
+    """ Field paths used by the list_filter, or None if it isn't supported """
+    if isinstance(spec, TwoNumbersInRangeFilter):
+        return list(spec.field_spec)
+    if isinstance(spec, FieldListFilter):
+        return [spec.field_path]
+    return None
+
+def get_filter_lookups(spec, request):
+    """ {'field_path__lookup': value} applied by the list_filter, or None if it isn't supported """
+    if isinstance(spec, TwoNumbersInRangeFilter):
+        return spec.get_lookups()
+    if isinstance(spec, NumericRangeFilter):
+        if not spec.form.is_valid():
+            return {}
+        return spec._make_query_filter(request, spec.form.cleaned_data)
+    if isinstance(spec, ChoicesMultipleSelectFilter):
+        lookups = dict(spec.used_parameters)
+        if spec.lookup_kwarg in lookups:
+            lookups[spec.lookup_kwarg] = [ unquote(item) for item in lookups[spec.lookup_kwarg] ]
+        return lookups
+    if isinstance(spec, FieldListFilter) and type(spec).queryset is FieldListFilter.queryset:
+        return dict(spec.used_parameters)
+    return None
+
+class ColumnarQuery:
+    """ The list_filters of a changelist evaluated on the index """
+    def __init__(self, index, spec_masks):
+        self.index = index
+        self.spec_masks = spec_masks
+        self.mask = self.get_mask()
+
+    def get_mask(self, exclude_spec=None):
+        mask = self.index.alive.copy()
+        for spec, spec_mask in self.spec_masks:
+            if spec is not exclude_spec:
+                mask &= spec_mask
+        return mask
+
+    def count(self):
+        return int(np.count_nonzero(self.mask))
+
+    def full_count(self):
+        return int(np.count_nonzero(self.index.alive))
+
+    def get_pks(self):
+        """ pks of the matching rows, in the changelist ordering """
+        return self.index.pks[self.mask]
+
+    def get_facet_counts(self, spec):
+        column = self.index.columns.get(getattr(spec, 'field_path', None))
+        return column.counts(self.get_mask(spec)) if column is not None else None
+
+    def seek(self, pk, forwards, limit):
+        """ Returns (pks, has_more) of up to limit matching rows after (or before) the row, or None if the row is unknown """
+        position = self.index.positions.get(pk)
+        if position is None:
+            return None
+        positions = np.flatnonzero(self.mask)
+        if forwards:
+            start = np.searchsorted(positions, position, 'right')
+            positions = positions[start:start + limit + 1]
+            has_more = len(positions) > limit
+            positions = positions[:limit]
+        else:
+            stop = np.searchsorted(positions, position, 'left')
+            positions = positions[max(stop - limit - 1, 0):stop]
+            has_more = len(positions) > limit
+            positions = positions[-limit:]
+        return self.index.pks[positions], has_more
+
+def get_rows(queryset, pks):
+    """ The rows of the queryset with the pks, in the same order """
+    pks = [ int(pk) for pk in pks ]
+    rows = { row.pk: row for row in queryset.filter(pk__in=pks).order_by() }
+    return [ rows[pk] for pk in pks if pk in rows ]
+
+def get_columnar_query(queryset, filter_specs, ordering, cursor, request):
+    """ ColumnarQuery for the filters on the queryset (in the ordering), or None if SQL has to be used instead """
+    if not settings.COLUMNAR_FILTERS or not all(isinstance(item, str) for item in ordering):
+        return None # eg. sorted by an aggregate_column() expression
+    if 'pk' not in [ item.lstrip('-') for item in ordering ]:
+        return None
+
+    field_paths, lookups = set(), []
+    for spec in get_filter_specs(filter_specs):
+        spec_fields, spec_lookups = get_filter_fields(spec), get_filter_lookups(spec, request)
+        if spec_fields is None or spec_lookups is None:
+            return None
+        field_paths.update(spec_fields)
+        lookups.append((spec, spec_lookups))
+
+    index = get_columnar_index(queryset, sorted(field_paths), ordering, cursor)
+    if index is None:
+        return None
+
+    spec_masks = []
+    for spec, spec_lookups in lookups:
+        mask = index.get_mask(spec_lookups)
+        if mask is None:
+            return None
+        spec_masks.append((spec, mask))
+    return ColumnarQuery(index, spec_masks)
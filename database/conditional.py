@@ -0,0 +1,66 @@
+"""
+HTTP conditional requests for pages which only depend on the data, the user and the query string
+(the Studies/Results changelists, their exports and the home page).
+
+Each response gets an ETag made from those and the deployed build (settings.BUILD_ID, as upgrades change
+the pages too), and a request with a matching If-None-Match is answered with 304 Not Modified before anything
+is queried or rendered. The responses are private (they depend on the user) and no-cache, so browsers keep
+them but check with the server on every visit.
+The pages only get an ETag, as a Last-Modified date can't tell users (or query strings) apart.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.utils.cache import add_never_cache_headers, patch_cache_control
+from django.views.decorators.http import condition
+
+from database.versioning import get_request_data_version
+
+def make_etag(*parts):
+    return hashlib.sha1(repr((settings.BUILD_ID, *parts)).encode()).hexdigest()
+
+def get_user_key(request):
+    """
+    The parts of the request which change a page for the same data: the user and their access level,
+    and the CSRF secret (the forms of the page carry a token made from it, which changes at login)
+    """
+    user = request.user
+    return user.pk, getattr(user, 'access_level', None), request.META.get('CSRF_COOKIE', '')
+
+def get_query_key(request):
+    return sorted((key, sorted(values)) for key, values in request.GET.lists())
+
+def is_conditional(request):
+    # messages waiting to be shown would be lost by a 304 (and only GET/HEAD responses are kept by browsers)
+    return request.method in ('GET', 'HEAD') and not len(get_messages(request))
+
+def get_data_etag(request, *args, **kwargs):
+    """
+    ETag of a page of the studies/results data (None for requests which aren't answered conditionally),
+    the view's arguments are part of the path
+    """
+    if not is_conditional(request):
+        return None
+    return make_etag(request.path, get_request_data_version(request), get_user_key(request), get_query_key(request))
+
+def conditional_page(etag_func):
+    """
+    Like django.views.decorators.http.condition(), but responses with validators are marked to be revalidated
+    on every request (private, no-cache) so that they can be kept by browsers, and the others are never cached.
+    This replaces never_cache, so admin views must be wrapped with AdminSite.admin_view(cacheable=True).
+    """
+    def decorator(view_func):
+        conditional_view = condition(etag_func)(view_func)
+
+        @wraps(view_func)
+        def inner(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if response.status_code in (200, 304) and response.has_header('ETag'):
+                patch_cache_control(response, private=True, no_cache=True)
+            else:
+                add_never_cache_headers(response)
+            return response
+        return inner
+    return decorator
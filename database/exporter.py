@@ -1,5 +1,5 @@
-import xlsxwriter, logging, io
-from django.http import HttpResponse
+import xlsxwriter, logging, io, csv, tempfile
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse
 from database.models import StudiesModel, ResultsModel
 from database.importer import get_field_descriptions, get_field_type_description
 from datetime import date
@@ -116,7 +116,47 @@ def download_excel_worksheet(studies_qs, results_qs):
         output.getvalue(),
         content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
-    resp['Content-Disposition'] = 'attachment; filename=ASAVI-StrepA-Studies_%s.xlsx' % date.today().strftime('%d-%m-%Y')
+    resp['Content-Disposition'] = 'attachment; filename=%s' % get_export_filename('xlsx')
 
     return resp
-    
\ No newline at end of file
+
+def get_export_filename(extension, name='Studies'):
+    return 'ASAVI-StrepA-%s_%s.%s' % (name, date.today().strftime('%d-%m-%Y'), extension)
+
+def stream_excel_worksheet(studies_qs, results_qs):
+    """
+    Same as download_excel_worksheet, but rows are fetched in chunks and written to a temporary
+    file which is streamed back, so large exports don't need to be held in memory.
+    """
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    write_excel_workbook(workbook, studies_qs.iterator(), results_qs.iterator())
+    workbook.close()
+    output.seek(0)
+
+    return FileResponse(
+        output,
+        as_attachment=True,
+        filename=get_export_filename('xlsx'),
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+class Echo:
+    """ File-like object which returns written values instead of storing them (for streaming CSV) """
+    def write(self, value):
+        return value
+
+def stream_csv_rows(instances, fields_spec):
+    writer = csv.writer(Echo())
+    yield writer.writerow([ spec[1] for spec in fields_spec ])
+    for inst in instances:
+        yield writer.writerow([ getattr(inst, spec[0]) for spec in fields_spec ])
+
+def stream_csv(queryset, fields_spec, name):
+    """ Stream a single sheet (ie. STUDY_FIELDS or RESULT_FIELDS) as CSV """
+    resp = StreamingHttpResponse(
+        stream_csv_rows(queryset.iterator(), fields_spec),
+        content_type='text/csv',
+    )
+    resp['Content-Disposition'] = 'attachment; filename=%s' % get_export_filename('csv', name)
+    return resp
@@ -1,11 +1,28 @@
+import hashlib
+from decimal import Decimal, InvalidOperation
+
 from django.contrib.admin.filters import (
     ListFilter, ChoicesFieldListFilter, AllValuesFieldListFilter,
     FieldListFilter)
-from django.contrib.admin.utils import prepare_lookup_value, quote, unquote
+from django.contrib.admin.utils import get_fields_from_path, prepare_lookup_value, quote, reverse_field_path, unquote
 from django.contrib.admin.options import IncorrectLookupParameters
 from django.contrib.admin.templatetags import admin_list
 from django.utils.safestring import mark_safe 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.db.models import QuerySet
+from django_admin_listfilter_dropdown.filters import DropdownFilter, ChoiceDropdownFilter
+
+from database.intervals import filter_overlapping, get_overlap_lookups
+from database.versioning import get_request_data_version
+
+DISTINCT_VALUES_CACHE_PREFIX = 'database.distinct'
+DISTINCT_VALUES_CACHE_TIMEOUT = 24 * 60 * 60
+
+def get_facet_counts(changelist, spec):
+    """ {value: number of rows} for the filter's options under the other active filters, if the changelist has facets """
+    get_counts = getattr(changelist, 'get_facet_counts', None)
+    return get_counts(spec) if get_counts else None
 
 class MyListFilter(ListFilter):
     field_spec = None
@@ -51,51 +68,89 @@ class HierarchicalFilter(MyListFilter):
     """ 
     Single or multiple select filters from 'top level' to 'bottom level' ie for fields
     which contain dependent or redundant data (eg. broad category -> specific category).
+    Each level is shown as its own filter, with the options narrowed to the values found
+    with the values selected in the level above (see get_value_map()).
     Records with null values in specified fields will not appear except when this 
     filter is unset.
     """
-    field_spec = None
+    field_spec = None # must be tuple of (field_path, FieldListFilter class) from top to bottom level
     template = "admin/hierarchical_filter.html"
 
+    def __init__(self, request, params, model, model_admin):
+        # each level takes its own params (so must be created before MyListFilter takes the rest)
+        self.filter_specs = [
+            filter_class(get_fields_from_path(model, field_path)[-1], request, params, model, model_admin, field_path)
+            for field_path, filter_class in self.field_spec
+        ]
+        super().__init__(request, params, model, model_admin)
+
+        queryset = model_admin.get_queryset(request)
+        for parent, child in zip(self.filter_specs, self.filter_specs[1:]):
+            value_map = get_value_map(request, queryset, parent.field_path, child.field_path)
+            if parent is self.filter_specs[0] and hasattr(parent, 'lookup_choices'):
+                parent.lookup_choices = list(value_map)
+            selected = get_selected_values(parent)
+            if selected:
+                values = sorted({ value for parent_value in selected for value in value_map.get(parent_value, ()) }, key=none_first)
+            else:
+                values = sorted({ value for child_values in value_map.values() for value in child_values }, key=none_first)
+            if hasattr(child, 'lookup_choices'):
+                child.lookup_choices = values
+            else:
+                child.allowed_values = values if selected else None
+
     def expected_parameters(self):
-        return [ field for field, _ in self.field_spec ]
+        return [ param for spec in self.filter_specs for param in spec.expected_parameters() ]
+
+    def has_output(self):
+        return any(spec.has_output() for spec in self.filter_specs)
 
     def filters(self):
-        # keep track cumulatively of filter params which are "consumed" by filters
-        # from highest level to lowest level in hierarchy
-        self_and_child_params = self.expected_parameters()
-        
-        for field, _filter in self.field_spec:
-            pass
-            #filter_applied = False
-            #for parm in _filter.expected_parameters():
-            #    if parm in self_and_child_params:
-            #        # remove params from the list as we find them
-            #        self_and_child_params.remove(parm) 
-            #    if parm self.params:
-            #        filter_applied = True
-            #    
-            #yield {
-            #    'html': mark_safe(admin_list.admin_list_filter(self.changelist, _filter)),
-            #    'clear_filter': self.changelist.get_query_string()
-            #}
+        """ html of the filter for each level """
+        for spec in self.filter_specs:
+            if spec.has_output():
+                yield mark_safe(admin_list.admin_list_filter(self.changelist, spec))
 
-    
     def queryset(self, request, queryset):
-        # from django.contrib.admin.filters.FieldListFilter
-        try:
-            return queryset.filter(**self.used_parameters)
-        except (ValueError, ValidationError) as e:
-            raise IncorrectLookupParameters(e)
+        for spec in self.filter_specs:
+            queryset = spec.queryset(request, queryset)
+        return queryset
+
+def get_filter_specs(filter_specs):
+    """ the filters of a changelist, with each level of hierarchical filters as a separate filter """
+    for spec in filter_specs:
+        yield from getattr(spec, 'filter_specs', [spec])
+
+def none_first(value):
+    return (value is not None, value)
 
-class HierarchicalFilterFilter:
-    pass
+def get_value_map(request, queryset, parent_path, child_path):
+    """ {parent value: [child values]} of the rows of the queryset, from get_distinct_values() """
+    value_map = {}
+    rows = queryset.order_by().values_list(parent_path, child_path).distinct()
+    for parent_value, child_value in get_distinct_values(request, rows):
+        value_map.setdefault(parent_value, []).append(child_value)
+    return dict(sorted(value_map.items(), key=lambda item: none_first(item[0])))
 
-class HierarchicalSingleFilter(HierarchicalFilterFilter):
-    pass
+def get_distinct_values(request, queryset):
+    """ The rows of a values_list() queryset of filter options, cached until the data changes (see versioning.py) """
+    version = get_request_data_version(request, queryset.db)
+    sql, params = queryset.query.sql_with_params()
+    key = '%s:%s' % (DISTINCT_VALUES_CACHE_PREFIX, hashlib.sha1(repr((version, sql, params)).encode()).hexdigest())
+    values = cache.get(key)
+    if values is None:
+        values = list(queryset)
+        cache.set(key, values, DISTINCT_VALUES_CACHE_TIMEOUT)
+    return values
 
-class HierarchicalMultipleFilter(HierarchicalFilterFilter):
-    pass
+def get_selected_values(spec):
+    """ values selected in a single or multiple select filter """
+    value = spec.used_parameters.get(spec.lookup_kwarg)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [ unquote(item) for item in value ]
+    return [ value ]
 
 class TwoNumbersInRangeFilter(MyListFilter):
     """
@@ -114,19 +169,32 @@ class TwoNumbersInRangeFilter(MyListFilter):
         self.lookup_kwarg_gte = "%s__range__gte" % self.field_name_gte
         self.lookup_kwarg_lte = "%s__range__lte" % self.field_name_lte
         super().__init__(request, params, model, model_admin)
-        self.lookup_val_gte = self.used_parameters.get(self.lookup_kwarg_gte)
-        self.lookup_val_lte = self.used_parameters.get(self.lookup_kwarg_lte)
+        self.lookup_val_gte = self.used_parameters.get(self.lookup_kwarg_gte) or None
+        self.lookup_val_lte = self.used_parameters.get(self.lookup_kwarg_lte) or None
 
     def expected_parameters(self):
         return [self.lookup_kwarg_gte, self.lookup_kwarg_lte]
 
+    def get_range(self):
+        """ (from, to) of the filter as numbers, either may be None """
+        values = []
+        for value in (self.lookup_val_gte, self.lookup_val_lte):
+            if value is not None:
+                try:
+                    value = Decimal(value)
+                except InvalidOperation as e:
+                    raise IncorrectLookupParameters(e)
+                if not value.is_finite():
+                    raise IncorrectLookupParameters('Invalid range "%s"' % value)
+            values.append(value)
+        return tuple(values)
+
+    def get_lookups(self):
+        return get_overlap_lookups(self.field_name_gte, self.field_name_lte, *self.get_range())
+
     def queryset(self, request, queryset):
-        filter_args = {}
-        if self.lookup_val_gte is not None:
-            filter_args['%s__gte' % self.field_name_gte] = self.lookup_val_gte
-        if self.lookup_val_lte is not None:
-            filter_args['%s__lte' % self.field_name_lte] = self.lookup_val_lte
-        return queryset.filter(**filter_args)
+        # rows whose range overlaps the filter range (using the interval index, see intervals.py)
+        return filter_overlapping(queryset, self.field_name_gte, self.field_name_lte, *self.get_range())
 
 class ChoicesMultipleSelectFilter(FieldListFilter):
     """
@@ -134,6 +202,8 @@ class ChoicesMultipleSelectFilter(FieldListFilter):
     do not match ANY of the selected values.
     """
     template = 'admin/multiple_filter.html'
+    allowed_values = None # only these options are shown if set (see HierarchicalFilter)
+
     def __init__(self, field, request, params, model, model_admin, field_path):
         # adapted from django.contrib.admin.filters.ChoicesFieldListFilter 
         self.lookup_kwarg = "%s__in" % field_path
@@ -147,13 +217,15 @@ class ChoicesMultipleSelectFilter(FieldListFilter):
 
     def choices(self, changelist):
         self.changelist = changelist
+        counts = get_facet_counts(changelist, self)
         for lookup, title in self.field.flatchoices:
             # null value title not supported
-            if lookup is None:
+            if lookup is None or not self.is_allowed(lookup):
                 continue
             yield {
                 'code': quote(lookup),
                 'display': mark_safe(title.replace('"', '""')),
+                'count': counts.get(lookup, 0) if counts is not None else None,
             }
 
     def queryset(self, request, queryset):
@@ -171,6 +243,9 @@ class ChoicesMultipleSelectFilter(FieldListFilter):
             # the parameters to the correct type.
             raise IncorrectLookupParameters(e)
 
+    def is_allowed(self, lookup):
+        return self.allowed_values is None or lookup in self.allowed_values
+
     def null_query_string(self):
         return mark_safe(self.changelist.get_query_string({self.lookup_kwarg_isnull: "True"}, [self.lookup_kwarg]).replace('"', '""'))
 
@@ -187,9 +262,76 @@ class ChoicesMultipleSelectFilter(FieldListFilter):
 
         sel_actual = set()
         for lookup, title in self.field.flatchoices:
-            if lookup is None:
+            if lookup is None or not self.is_allowed(lookup):
                 continue
             lookup = quote(lookup)
             if selected_items is None or lookup in selected_items:
                 sel_actual.add(lookup)
         return sel_actual
+
+
+class FacetCountsMixin:
+    """
+    Adds the number of matching rows to each option of a dropdown filter (see get_facet_counts()),
+    the options are "All", then the values from get_option_values(), then the empty value.
+    """
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.request = request
+        self.model = model
+        self.model_admin = model_admin
+        super().__init__(field, request, params, model, model_admin, field_path)
+
+    def get_option_values(self):
+        """
+        The distinct values of the field, in the same order as the options of AllValuesFieldListFilter
+        (and from the same cache entry as CachedValuesMixin), filters with other options override this
+        """
+        parent_model, _ = reverse_field_path(self.model, self.field_path)
+        if parent_model == self.model:
+            queryset = self.model_admin.get_queryset(self.request)
+        else:
+            queryset = parent_model._default_manager.all()
+        values = queryset.distinct().order_by(self.field.name).values_list(self.field.name, flat=True)
+        return [ value for value in get_distinct_values(self.request, values) if value is not None ]
+
+    def choices(self, changelist):
+        counts = get_facet_counts(changelist, self)
+        choices = super().choices(changelist)
+        if counts is None:
+            yield from choices
+            return
+
+        options = [ sum(counts.values()) ] + [ counts.get(value, 0) for value in self.get_option_values() ] + [ counts.get(None, 0) ]
+        for choice, count in zip(choices, options):
+            yield dict(choice, display='%s (%d)' % (choice['display'], count))
+
+class CachedValuesMixin:
+    """
+    Takes the options of an AllValuesFieldListFilter from get_distinct_values() (cached until the data changes),
+    instead of a DISTINCT query of the table each time the changelist is shown.
+    """
+    _lookup_choices = None
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.request = request
+        super().__init__(field, request, params, model, model_admin, field_path)
+
+    @property
+    def lookup_choices(self):
+        if isinstance(self._lookup_choices, QuerySet):
+            self._lookup_choices = get_distinct_values(self.request, self._lookup_choices)
+        return self._lookup_choices
+
+    @lookup_choices.setter
+    def lookup_choices(self, values):
+        # the (lazy) queryset from AllValuesFieldListFilter, or the options set by HierarchicalFilter
+        self._lookup_choices = values
+
+class FacetDropdownFilter(CachedValuesMixin, FacetCountsMixin, DropdownFilter):
+    def get_option_values(self):
+        # the options may be narrowed by HierarchicalFilter
+        return [ value for value in self.lookup_choices if value is not None ]
+
+class FacetChoiceDropdownFilter(FacetCountsMixin, ChoiceDropdownFilter):
+    def get_option_values(self):
+        return [ lookup for lookup, _ in self.field.flatchoices if lookup is not None ]
@@ -0,0 +1,166 @@
+"""
+Typo tolerant (trigram) search for titles, authors and locations, used for search terms prefixed with ~
+(eg. ~Kimberly finds Kimberley).
+
+On PostgreSQL the pg_trgm word similarity operator is used, with trigram GIN indexes on the columns.
+On SQLite an in-process trigram index of the columns is kept per table, and updated from the change feed.
+Either way each match gets a word similarity score (0 to 1) used to rank the results.
+"""
+import heapq
+import re
+import threading
+from collections import Counter, defaultdict
+
+from django.db import connections
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+from database.changes import encode_change_cursor, get_changes
+from database.models import StudiesModel
+from database.versioning import get_data_version_stamp
+
+# columns searched for fuzzy terms in each table
+FUZZY_SEARCH_COLUMNS = {
+    'database_studies': ('Paper_title', 'Study_description'),
+    'database_results': ('Specific_location', ),
+}
+
+# minimum word similarity for a match (the pg_trgm default for word_similarity_threshold)
+FUZZY_SEARCH_THRESHOLD = 0.6
+
+# maximum number of matches used from the in-process index (best matches first)
+FUZZY_SEARCH_LIMIT = 500
+
+WORD_RE = re.compile(r'[^\W_]+')
+
+def get_trigrams(text):
+    """ Trigrams of each word in the text, padded the same way as pg_trgm """
+    trigrams = set()
+    for word in WORD_RE.findall(text.lower()):
+        word = '  %s ' % word
+        trigrams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return trigrams
+
+class TrigramIndex:
+    """
+    Maps each trigram to the rows (pks) containing it. Updates replace the sets of the trigrams they
+    change rather than changing them in place, so that searches can run while the index is updated.
+    """
+    def __init__(self, rows):
+        self.postings = {}
+        self.trigrams = {}
+        self.update(rows)
+
+    def update(self, rows):
+        """ Adds the rows [(pk, *values), ...] or replaces the rows which are already indexed """
+        changes = defaultdict(lambda: (set(), set()))
+        for pk, *values in rows:
+            trigrams = get_trigrams(' '.join(value for value in values if value))
+            old_trigrams = self.trigrams.get(pk, set())
+            for trigram in trigrams - old_trigrams:
+                changes[trigram][0].add(pk)
+            for trigram in old_trigrams - trigrams:
+                changes[trigram][1].add(pk)
+            self.trigrams[pk] = trigrams
+        self.apply(changes)
+
+    def remove(self, pks):
+        changes = defaultdict(lambda: (set(), set()))
+        for pk in pks:
+            for trigram in self.trigrams.pop(pk, ()):
+                changes[trigram][1].add(pk)
+        self.apply(changes)
+
+    def apply(self, changes):
+        for trigram, (added, removed) in changes.items():
+            self.postings[trigram] = (self.postings.get(trigram, set()) - removed) | added
+
+    def search(self, term, threshold=FUZZY_SEARCH_THRESHOLD, limit=FUZZY_SEARCH_LIMIT):
+        """
+        Returns the best matching [(pk, score), ...] where score is the share of the term's
+        trigrams found in the row (which is how word similarity is worked out by pg_trgm).
+        """
+        trigrams = get_trigrams(term)
+        if not trigrams:
+            return []
+        counts = Counter()
+        for trigram in trigrams:
+            counts.update(self.postings.get(trigram, ()))
+        matches = ((pk, count / len(trigrams)) for pk, count in counts.items())
+        return heapq.nlargest(limit, (match for match in matches if match[1] >= threshold), key=lambda match: match[1])
+
+_trigram_indexes = {}
+_trigram_index_locks = defaultdict(threading.Lock)
+
+def get_trigram_index(model, using):
+    """
+    The in-process trigram index of the model's table (drafts included), at a data version. Requests which
+    read a later version update it with the rows written since from the change feed (see changes.py), while
+    searches of the index go on. It is only rebuilt when the version was reused after a rollback.
+    """
+    model = model._meta.concrete_model
+    table = model._meta.db_table
+    stamp = get_data_version_stamp(using)
+
+    def is_current(cached):
+        return cached is not None and (cached[0] == stamp or cached[0][0] > stamp[0])
+
+    cached = _trigram_indexes.get((using, table))
+    if is_current(cached):
+        return cached[1]
+    with _trigram_index_locks[(using, table)]:
+        cached = _trigram_indexes.get((using, table))
+        if is_current(cached):
+            return cached[1]
+        changes_key, model_name = ('studies', 'study') if model is StudiesModel else ('results', 'result')
+        columns = FUZZY_SEARCH_COLUMNS[table]
+        if cached is None or cached[0][0] == stamp[0]:
+            changes = get_changes(using=using, include_drafts=True)
+            index = TrigramIndex(changes[changes_key].values_list('pk', *columns).iterator())
+        else:
+            changes = get_changes(encode_change_cursor(cached[0][0]), using, include_drafts=True)
+            index = cached[1]
+            index.remove(item['id'] for item in changes['deleted'] if item['model'] == model_name)
+            index.update(changes[changes_key].values_list('pk', *columns))
+        # rows written after the stamp are applied again by the next update
+        _trigram_indexes[(using, table)] = (stamp, index)
+    return index
+
+def get_fuzzy_match(model, term, using, field_name=None):
+    """
+    Returns (Q, rank expression) for rows of the model matching the fuzzy term, or for rows whose
+    foreign key field_name points to matching rows of the related model.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    match_model = model._meta.get_field(field_name).related_model if field_name else model
+    table = match_model._meta.concrete_model._meta.db_table
+    columns = FUZZY_SEARCH_COLUMNS[table]
+    lookup = '%s__in' % field_name if field_name else 'pk__in'
+
+    if connection.vendor == 'postgresql':
+        match_sql = 'SELECT id FROM %s WHERE %s' % (
+            qn(table), ' OR '.join('%%s <%%%% %s' % qn(column) for column in columns))
+        similarity_sql = 'GREATEST(%s)' % ', '.join(
+            'word_similarity(%%s, %s.%s)' % (qn(table), qn(column)) for column in columns)
+        if field_name:
+            # rank by the related row, correlated on the foreign key of the outer table
+            similarity_sql = 'COALESCE((SELECT %s FROM %s WHERE %s.id = %s.%s), 0)' % (
+                similarity_sql, qn(table), qn(table),
+                qn(model._meta.concrete_model._meta.db_table), qn(model._meta.get_field(field_name).column))
+        params = [term] * len(columns)
+        return Q(**{lookup: RawSQL(match_sql, params)}), RawSQL(similarity_sql, params, output_field=FloatField())
+
+    matches = get_trigram_index(match_model, using).search(term)
+    rank_field = field_name + '_id' if field_name else 'pk'
+    if not matches:
+        return Q(**{lookup: []}), Value(0.0)
+    # one When for each score (there are only as many as the term has trigrams) rather than for each match
+    scores = defaultdict(list)
+    for pk, score in matches:
+        scores[score].append(pk)
+    rank = Case(
+        *(When(**{'%s__in' % rank_field: pks, 'then': Value(score)}) for score, pks in scores.items()),
+        default=Value(0.0), output_field=FloatField(),
+    )
+    return Q(**{lookup: [pk for pk, _ in matches]}), rank
@@ -8,6 +8,7 @@ from django.db.models import fields
 from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.utils import timezone
 from database.models import StudiesModel, ResultsModel, Dataset
+from database.versioning import data_version_batch
 
 import decimal
 import pandas as pd
@@ -178,7 +179,8 @@ def process_db_import(request, import_source):
     Translate the Import_source.Import_data JSON into actual database rows
     """
     try:
-        with transaction.atomic():
+        # every row of the import is written at one data version (see versioning.py)
+        with transaction.atomic(), data_version_batch():
             import_source.Import_time = timezone.now()
             import_source.save()
 
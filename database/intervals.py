@@ -0,0 +1,73 @@
+"""
+Interval overlap filtering, for pairs of columns which hold a range (eg. Year_start/Year_stop, Age_min/Age_max),
+used by filters.TwoNumbersInRangeFilter.
+
+Each pair of columns has an index of the intervals: on PostgreSQL a GiST index on a numrange of the columns,
+on SQLite an R*Tree table (<table>_<start>_<stop>_interval) kept in sync by triggers. The index selects the rows
+which may overlap the filter range, and those are checked with plain comparisons of the columns. Rows with an
+unknown (null) start or stop don't match a filter range which is bounded on that side.
+The indexes are created by migration 0010, and SQLite migrations which rebuild the table drop the triggers,
+like the search index (see search.py).
+"""
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+# columns (start, stop) of each table with an interval index
+INTERVAL_INDEX_COLUMNS = {
+    'database_results': (
+        ('Year_start', 'Year_stop'),
+        ('Age_min', 'Age_max'),
+    ),
+}
+
+def get_interval_index_name(table, start, stop):
+    return '%s_%s_%s_interval' % (table, start.lower(), stop.lower())
+
+def get_range_sql(qn, table, start, stop):
+    """ numrange of the columns (in either order, as the index must also accept rows with start > stop) """
+    start, stop = '%s.%s' % (qn(table), qn(start)), '%s.%s' % (qn(table), qn(stop))
+    return "numrange(LEAST(%s, %s), GREATEST(%s, %s), '[]')" % (start, stop, start, stop)
+
+def get_overlap_lookups(start, stop, low, high):
+    """ Lookups for rows whose start..stop range overlaps low..high (either may be None for an open range) """
+    lookups = {}
+    if low is not None:
+        lookups['%s__gte' % stop] = low
+    if high is not None:
+        lookups['%s__lte' % start] = high
+    return lookups
+
+def filter_overlapping(queryset, start, stop, low, high):
+    """
+    Filters the queryset to rows whose start..stop range overlaps low..high (numbers, either may be None
+    for an open range), using the interval index of the columns where there is one.
+    """
+    lookups = get_overlap_lookups(start, stop, low, high)
+    if not lookups:
+        return queryset
+
+    model = queryset.model
+    table = model._meta.concrete_model._meta.db_table
+    columns = (model._meta.get_field(start).column, model._meta.get_field(stop).column)
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+
+    if columns in INTERVAL_INDEX_COLUMNS.get(table, ()):
+        if connection.vendor == 'postgresql':
+            queryset = queryset.filter(RawSQL(
+                "%s && numrange(%%s, %%s, '[]')" % get_range_sql(qn, table, *columns),
+                [low, high], output_field=BooleanField()))
+        elif connection.vendor == 'sqlite':
+            conditions, params = [], []
+            if low is not None:
+                conditions.append('stop >= %s')
+                params.append(float(low))
+            if high is not None:
+                conditions.append('start <= %s')
+                params.append(float(high))
+            queryset = queryset.filter(pk__in=RawSQL('SELECT id FROM %s WHERE %s' % (
+                qn(get_interval_index_name(table, *columns)), ' AND '.join(conditions)), params))
+
+    # the index is approximate (the R*Tree rounds outwards, and orders start/stop), so check the columns too
+    return queryset.filter(**lookups)
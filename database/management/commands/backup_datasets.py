@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import logging
+from database.models import Dataset
+from database.backup import write_backup_zip
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Back up Datasets to a zip file containing one Excel workbook per Dataset (built in parallel)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Zip file to write the backup to')
+        parser.add_argument('--dataset', action='append', default=[],
+            help='Name of Dataset to back up (can be repeated, default is all Datasets)')
+        parser.add_argument('--dataset-id', action='append', type=int, default=[],
+            help='Id of Dataset to back up (can be repeated, as used by the Dataset admin action)')
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.order_by('pk')
+        if options['dataset']:
+            datasets = datasets.filter(Dataset_name__in=options['dataset'])
+            missing = set(options['dataset']) - set(datasets.values_list('Dataset_name', flat=True))
+            if missing:
+                raise CommandError('No such Dataset(s): %s' % ', '.join(sorted(missing)))
+        if options['dataset_id']:
+            datasets = datasets.filter(pk__in=options['dataset_id'])
+
+        dataset_ids = list(datasets.values_list('pk', flat=True))
+        write_backup_zip(dataset_ids, options['output'])
+
+        self.stdout.write('Backed up %d datasets to %s' % (len(dataset_ids), options['output']))
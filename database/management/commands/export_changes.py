@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ValidationError
+
+import logging, os
+from database.changes import get_changes
+from database.api import generate_change_lines
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Export approved Studies and Results which were created, updated or deleted since a cursor '
+        'as NDJSON (for incremental/delta backups)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='NDJSON file to write the changes to')
+        parser.add_argument('--since', help='Cursor returned by the previous export (default: export everything)')
+        parser.add_argument('--cursor-file',
+            help='File to read the previous cursor from, and to save the next cursor to after a successful export')
+
+    def handle(self, *args, **options):
+        since = options['since']
+        cursor_file = options['cursor_file']
+        if since is None and cursor_file and os.path.exists(cursor_file):
+            with open(cursor_file, 'r') as f:
+                since = f.read().strip() or None
+
+        try:
+            changes = get_changes(since)
+        except ValidationError as e:
+            raise CommandError(e.messages[0])
+
+        num_lines = 0
+        with open(options['output'], 'w') as output:
+            for line in generate_change_lines(changes):
+                output.write(line)
+                num_lines += 1
+
+        if cursor_file:
+            with open(cursor_file, 'w') as f:
+                f.write(changes['cursor'])
+
+        # last line is the cursor
+        self.stdout.write('Exported %d changes since %s, next cursor is %s' % (
+            num_lines - 1, since or 'the beginning', changes['cursor']))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import logging, os
+from database.models import Dataset, Studies, Results
+from database.snapshot import write_sqlite_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Export approved Studies and Results to a standalone SQLite database file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='SQLite file to create')
+        parser.add_argument('--dataset', action='append', default=[],
+            help='Name of Dataset to export (can be repeated, default is all Datasets)')
+
+    def handle(self, *args, **options):
+        if os.path.exists(options['output']):
+            raise CommandError('Output file "%s" already exists' % options['output'])
+
+        studies = Studies.objects.all()
+        if options['dataset']:
+            datasets = Dataset.objects.filter(Dataset_name__in=options['dataset'])
+            missing = set(options['dataset']) - set(datasets.values_list('Dataset_name', flat=True))
+            if missing:
+                raise CommandError('No such Dataset(s): %s' % ', '.join(sorted(missing)))
+            studies = studies.filter(Dataset__in=datasets)
+        results = Results.objects.filter(Study__in=studies.values('pk'))
+
+        write_sqlite_snapshot(options['output'], studies, results)
+        self.stdout.write('Exported %d studies and %d results to %s' % (
+            studies.count(), results.count(), options['output']))
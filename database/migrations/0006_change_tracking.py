@@ -0,0 +1,56 @@
+# Generated by Django 4.2.1 on 2026-10-19 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0005_studiesmodel_dataset"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeletedRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "Model_name",
+                    models.CharField(
+                        help_text="Model of the deleted row (ie. study or result)",
+                        max_length=30,
+                    ),
+                ),
+                ("Object_id", models.BigIntegerField()),
+                (
+                    "Deleted_time",
+                    models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+            ],
+            options={
+                "verbose_name": "Deleted record",
+            },
+        ),
+        migrations.AddField(
+            model_name="resultsmodel",
+            name="Updated_time",
+            field=models.DateTimeField(
+                auto_now=True, db_index=True, verbose_name="Last modified"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="studiesmodel",
+            name="Updated_time",
+            field=models.DateTimeField(
+                auto_now=True, db_index=True, verbose_name="Last modified"
+            ),
+        ),
+    ]
@@ -0,0 +1,106 @@
+from django.db import migrations
+
+# columns indexed as of this migration (see database.search.SEARCH_INDEX_COLUMNS)
+SEARCH_INDEX_COLUMNS = {
+    "database_studies": (
+        "Study_group",
+        "Paper_title",
+        "Year",
+        "Study_description",
+        "Disease",
+        "Study_design",
+        "Diagnosis_method",
+        "Data_source",
+        "Data_source_name",
+        "Surveillance_setting",
+        "Clinical_definition_category",
+        "Coverage",
+        "Climate",
+        "Urban_rural_coverage",
+        "Limitations_identified",
+        "Other_points",
+    ),
+    "database_results": (
+        "Age_general",
+        "Age_specific",
+        "Population_gender",
+        "Indigenous_status",
+        "Indigenous_population",
+        "Country",
+        "Jurisdiction",
+        "Specific_location",
+        "Year_start",
+        "Year_stop",
+        "Observation_time_years",
+        "Point_estimate",
+        "Measure",
+    ),
+}
+
+
+def create_search_index(schema_editor, table, columns):
+    # as of this migration, on PostgreSQL a generated tsvector column with a GIN index,
+    # on SQLite an FTS5 external content table kept in sync by triggers (see database.search)
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.quote_name
+
+    if vendor == "postgresql":
+        document = " || ' ' || ".join("coalesce(%s::text, '')" % qn(column) for column in columns)
+        schema_editor.execute(
+            "ALTER TABLE %s ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, %s)) STORED" % (
+                qn(table), document))
+        schema_editor.execute("CREATE INDEX %s ON %s USING GIN (search_vector)" % (qn("%s_search_idx" % table), qn(table)))
+
+    elif vendor == "sqlite":
+        fts_table = "%s_search" % table
+        column_list = ", ".join(qn(column) for column in columns)
+        new_values = ", ".join("new.%s" % qn(column) for column in columns)
+        old_values = ", ".join("old.%s" % qn(column) for column in columns)
+        insert_new = "INSERT INTO %s(rowid, %s) VALUES (new.id, %s);" % (qn(fts_table), column_list, new_values)
+        delete_old = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s);" % (
+            qn(fts_table), qn(fts_table), column_list, old_values)
+
+        schema_editor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content=%s, content_rowid='id')" % (
+            qn(fts_table), column_list, qn(table)))
+        schema_editor.execute("CREATE TRIGGER %s AFTER INSERT ON %s BEGIN %s END" % (
+            qn(fts_table + "_insert"), qn(table), insert_new))
+        schema_editor.execute("CREATE TRIGGER %s AFTER DELETE ON %s BEGIN %s END" % (
+            qn(fts_table + "_delete"), qn(table), delete_old))
+        schema_editor.execute("CREATE TRIGGER %s AFTER UPDATE ON %s BEGIN %s %s END" % (
+            qn(fts_table + "_update"), qn(table), delete_old, insert_new))
+        # index the existing rows
+        schema_editor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (qn(fts_table), qn(fts_table)))
+
+
+def drop_search_index(schema_editor, table):
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.quote_name
+
+    if vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE %s DROP COLUMN search_vector" % qn(table))
+    elif vendor == "sqlite":
+        fts_table = "%s_search" % table
+        for suffix in ("_insert", "_delete", "_update"):
+            schema_editor.execute("DROP TRIGGER IF EXISTS %s" % qn(fts_table + suffix))
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % qn(fts_table))
+
+
+def create_search_indexes(apps, schema_editor):
+    for table, columns in SEARCH_INDEX_COLUMNS.items():
+        create_search_index(schema_editor, table, columns)
+
+
+def drop_search_indexes(apps, schema_editor):
+    for table in SEARCH_INDEX_COLUMNS:
+        drop_search_index(schema_editor, table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0006_change_tracking"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# columns with trigram indexes as of this migration (see database.fuzzy.FUZZY_SEARCH_COLUMNS)
+FUZZY_SEARCH_COLUMNS = {
+    "database_studies": ("Paper_title", "Study_description"),
+    "database_results": ("Specific_location",),
+}
+
+
+def get_index_name(table, column):
+    return "%s_%s_trgm" % (table, column.lower())
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # SQLite uses an in-process trigram index instead (see database.fuzzy)
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    qn = schema_editor.quote_name
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, columns in FUZZY_SEARCH_COLUMNS.items():
+        for column in columns:
+            schema_editor.execute(
+                "CREATE INDEX %s ON %s USING GIN (%s gin_trgm_ops)"
+                % (qn(get_index_name(table, column)), qn(table), qn(column))
+            )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for table, columns in FUZZY_SEARCH_COLUMNS.items():
+        for column in columns:
+            schema_editor.execute(
+                "DROP INDEX IF EXISTS %s"
+                % schema_editor.quote_name(get_index_name(table, column))
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0007_search_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
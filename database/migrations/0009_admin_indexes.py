@@ -0,0 +1,59 @@
+# Generated by Django 4.2.1 on 2026-10-19 04:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0008_fuzzy_search_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="resultsmodel",
+            index=models.Index(fields=["Study", "-id"], name="results_study_order_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="resultsmodel",
+            index=models.Index(
+                fields=["Country", "Jurisdiction"], name="results_location_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resultsmodel",
+            index=models.Index(
+                fields=["Jurisdiction"], name="results_jurisdiction_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resultsmodel",
+            index=models.Index(
+                fields=["Year_start", "Year_stop"], name="results_years_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="studiesmodel",
+            index=models.Index(
+                condition=models.Q(("Approved_by__isnull", False)),
+                fields=["Study_group", "-Paper_title", "-id"],
+                name="studies_approved_order_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="studiesmodel",
+            index=models.Index(
+                condition=models.Q(("Approved_by__isnull", False)),
+                fields=["Disease", "Year"],
+                name="studies_approved_disease_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="studiesmodel",
+            index=models.Index(
+                condition=models.Q(("Approved_by__isnull", False)),
+                fields=["Year"],
+                name="studies_approved_year_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,80 @@
+from django.db import migrations
+
+# columns with interval indexes as of this migration (see database.intervals.INTERVAL_INDEX_COLUMNS)
+INTERVAL_INDEX_COLUMNS = {
+    "database_results": (
+        ("Year_start", "Year_stop"),
+        ("Age_min", "Age_max"),
+    ),
+}
+
+
+def create_interval_index(schema_editor, table, start, stop):
+    # as of this migration, on PostgreSQL a GiST index on a numrange of the columns,
+    # on SQLite an R*Tree table kept in sync by triggers (see database.intervals)
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.quote_name
+    name = "%s_%s_%s_interval" % (table, start.lower(), stop.lower())
+
+    if vendor == "postgresql":
+        start_sql, stop_sql = "%s.%s" % (qn(table), qn(start)), "%s.%s" % (qn(table), qn(stop))
+        schema_editor.execute("CREATE INDEX %s ON %s USING GIST ((numrange(LEAST(%s, %s), GREATEST(%s, %s), '[]')))" % (
+            qn(name), qn(table), start_sql, stop_sql, start_sql, stop_sql))
+
+    elif vendor == "sqlite":
+        def select_interval(row, source=""):
+            # rows without a start or stop are only indexed by the other end, and not at all without both
+            start_sql, stop_sql = "%s.%s" % (row, qn(start)), "%s.%s" % (row, qn(stop))
+            return (
+                "SELECT %(row)s.id, coalesce(min(%(start)s, %(stop)s), %(start)s, %(stop)s), "
+                "coalesce(max(%(start)s, %(stop)s), %(start)s, %(stop)s)%(source)s "
+                "WHERE %(start)s IS NOT NULL OR %(stop)s IS NOT NULL"
+            ) % {"row": row, "start": start_sql, "stop": stop_sql, "source": source}
+        insert_new = "INSERT INTO %s %s;" % (qn(name), select_interval("new"))
+        delete_old = "DELETE FROM %s WHERE id = old.id;" % qn(name)
+
+        schema_editor.execute("CREATE VIRTUAL TABLE %s USING rtree(id, start, stop)" % qn(name))
+        schema_editor.execute("CREATE TRIGGER %s AFTER INSERT ON %s BEGIN %s END" % (
+            qn(name + "_insert"), qn(table), insert_new))
+        schema_editor.execute("CREATE TRIGGER %s AFTER DELETE ON %s BEGIN %s END" % (
+            qn(name + "_delete"), qn(table), delete_old))
+        schema_editor.execute("CREATE TRIGGER %s AFTER UPDATE ON %s BEGIN %s %s END" % (
+            qn(name + "_update"), qn(table), delete_old, insert_new))
+        # index the existing rows
+        schema_editor.execute("INSERT INTO %s %s" % (qn(name), select_interval(qn(table), " FROM %s" % qn(table))))
+
+
+def drop_interval_index(schema_editor, table, start, stop):
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.quote_name
+    name = "%s_%s_%s_interval" % (table, start.lower(), stop.lower())
+
+    if vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS %s" % qn(name))
+    elif vendor == "sqlite":
+        for suffix in ("_insert", "_delete", "_update"):
+            schema_editor.execute("DROP TRIGGER IF EXISTS %s" % qn(name + suffix))
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % qn(name))
+
+
+def create_interval_indexes(apps, schema_editor):
+    for table, intervals in INTERVAL_INDEX_COLUMNS.items():
+        for start, stop in intervals:
+            create_interval_index(schema_editor, table, start, stop)
+
+
+def drop_interval_indexes(apps, schema_editor):
+    for table, intervals in INTERVAL_INDEX_COLUMNS.items():
+        for start, stop in intervals:
+            drop_interval_index(schema_editor, table, start, stop)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0009_admin_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_interval_indexes, drop_interval_indexes),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.1 on 2026-10-19 05:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_data_versions(apps, schema_editor):
+    # the version of all data, and of each dataset (see database.versioning)
+    DataVersion = apps.get_model("database", "DataVersion")
+    Dataset = apps.get_model("database", "Dataset")
+    using = schema_editor.connection.alias
+    DataVersion.objects.using(using).create(Dataset=None)
+    DataVersion.objects.using(using).bulk_create(
+        DataVersion(Dataset=dataset) for dataset in Dataset.objects.using(using).all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0010_interval_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DataVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("Version", models.PositiveBigIntegerField(default=0)),
+                (
+                    "Updated_time",
+                    models.DateTimeField(auto_now=True, verbose_name="Last modified"),
+                ),
+                (
+                    "Dataset",
+                    models.OneToOneField(
+                        blank=True,
+                        help_text="Dataset counted by this version, or empty for the version of all data",
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="database.dataset",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Data version",
+            },
+        ),
+        migrations.RunPython(create_data_versions, migrations.RunPython.noop),
+    ]
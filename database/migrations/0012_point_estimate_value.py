@@ -0,0 +1,53 @@
+# Generated by Django 4.2.1 on 2026-10-19 05:18
+
+import re
+
+from django.db import migrations, models
+
+# as of this migration (see database.models.results.parse_point_estimate)
+POINT_ESTIMATE_NUMBER = re.compile(r"[-+]?(?:\d[\d,]*(?:\.\d*)?|\.\d+)")
+
+
+def parse_point_estimate(text):
+    match = POINT_ESTIMATE_NUMBER.search(text or "")
+    if match is None:
+        return None
+    return float(match.group().replace(",", ""))
+
+
+def set_point_estimate_values(apps, schema_editor):
+    # the value is set on save from then on (see ResultsModel.save)
+    ResultsModel = apps.get_model("database", "ResultsModel")
+    results = ResultsModel.objects.using(schema_editor.connection.alias).exclude(Point_estimate=None)
+    rows = []
+    for row in results.only("Point_estimate").iterator():
+        row.Point_estimate_value = parse_point_estimate(row.Point_estimate)
+        rows.append(row)
+    ResultsModel.objects.using(schema_editor.connection.alias).bulk_update(
+        rows, ["Point_estimate_value"], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0011_data_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="resultsmodel",
+            name="Point_estimate_value",
+            field=models.FloatField(
+                blank=True,
+                editable=False,
+                help_text="Number at the start of the Point estimate (set on save), used to sort results by their point estimate.",
+                null=True,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="resultsmodel",
+            index=models.Index(
+                fields=["Point_estimate_value"], name="results_point_estimate_idx"
+            ),
+        ),
+        migrations.RunPython(set_point_estimate_values, migrations.RunPython.noop),
+    ]
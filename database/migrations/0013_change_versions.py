@@ -0,0 +1,42 @@
+# Generated by Django 4.2.1 on 2026-10-19 05:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0012_point_estimate_value"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deletedrecord",
+            name="Version",
+            field=models.PositiveBigIntegerField(
+                db_index=True,
+                default=0,
+                help_text="Data version of the deletion, used by the change feed (see changes.py)",
+            ),
+        ),
+        migrations.AddField(
+            model_name="resultsmodel",
+            name="Change_version",
+            field=models.PositiveBigIntegerField(
+                db_index=True,
+                editable=False,
+                help_text="Data version of the last change, used by the change feed (see changes.py)",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="studiesmodel",
+            name="Change_version",
+            field=models.PositiveBigIntegerField(
+                db_index=True,
+                editable=False,
+                help_text="Data version of the last change, used by the change feed (see changes.py)",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.1 on 2026-10-19 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("database", "0013_change_versions"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="studiesmodel",
+            index=models.Index(
+                condition=models.Q(("Approved_by__isnull", False)),
+                fields=["Coverage", "Climate", "id"],
+                name="studies_approved_geography_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="studiesmodel",
+            index=models.Index(
+                condition=models.Q(("Approved_by__isnull", False)),
+                fields=["Data_source", "Diagnosis_method", "id"],
+                name="studies_approved_method_idx",
+            ),
+        ),
+    ]
@@ -1,4 +1,4 @@
 from .users import Users
-from .base import Document, ImportSource, DataRequest, Dataset
+from .base import Document, ImportSource, DataRequest, Dataset, DeletedRecord, DataVersion
 from .methods import StudiesModel, Studies, My_Drafts
 from .results import ResultsModel, Results
\ No newline at end of file
@@ -132,6 +132,38 @@ class DataRequest(models.Model):
     def owner_id(self):
         return self.Created_by_id
 
+class DeletedRecord(models.Model):
+    """
+    Tombstone left behind when an approved study or result is deleted, or a study is withdrawn (reverted to draft),
+    so that the change feed can report deletions
+    """
+    class Meta:
+        verbose_name = 'Deleted record'
+
+    Model_name = models.CharField(max_length=30, help_text='Model of the deleted row (ie. study or result)')
+    Object_id = models.BigIntegerField()
+    Version = models.PositiveBigIntegerField(default=0, db_index=True,
+        help_text='Data version of the deletion, used by the change feed (see changes.py)')
+    Deleted_time = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '%s %d (deleted at %s)' % (
+            self.Model_name, self.Object_id,
+            timezone.localtime(self.Deleted_time).strftime('%d/%m/%Y %T %Z'))
+
+class DataVersion(models.Model):
+    """ Counter bumped on every write to the studies/results of a Dataset, or of any dataset (see versioning.py) """
+    class Meta:
+        verbose_name = 'Data version'
+
+    Dataset = models.OneToOneField(Dataset, on_delete=models.CASCADE, null=True, blank=True,
+        help_text='Dataset counted by this version, or empty for the version of all data')
+    Version = models.PositiveBigIntegerField(default=0)
+    Updated_time = models.DateTimeField(auto_now=True, verbose_name='Last modified')
+
+    def __str__(self):
+        return 'Version %d of %s' % (self.Version, self.Dataset or 'all data')
+
 class FilteredManager(models.Manager):
     filter_args = None
     def __init__(self, filter_args=None, select_related=None):
@@ -140,5 +172,9 @@ class FilteredManager(models.Manager):
         super().__init__()
     
     def get_queryset(self):
-        return super().get_queryset().select_related(*self.select_related).filter(**self.filter_args)
+        qs = super().get_queryset()
+        if self.select_related:
+            # note: select_related() without arguments would follow every non-null foreign key
+            qs = qs.select_related(*self.select_related)
+        return qs.filter(**self.filter_args)
      
\ No newline at end of file
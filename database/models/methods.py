@@ -16,6 +16,31 @@ class StudiesModel(models.Model):
         db_table = 'database_studies'
         verbose_name = 'Study'
         verbose_name_plural = 'Studies'
+        # indexes for the admin ordering and list_filters, partial indexes cover the approved studies
+        # which are listed everywhere (see the Studies proxy manager), Dataset/Import_source use the FK indexes
+        indexes = [
+            models.Index(
+                fields=['Study_group', '-Paper_title', '-id'], condition=models.Q(Approved_by__isnull=False),
+                name='studies_approved_order_idx',
+            ),
+            models.Index(
+                fields=['Disease', 'Year'], condition=models.Q(Approved_by__isnull=False),
+                name='studies_approved_disease_idx',
+            ),
+            models.Index(
+                fields=['Year'], condition=models.Q(Approved_by__isnull=False),
+                name='studies_approved_year_idx',
+            ),
+            # the sorted composite columns of the studies (and the study columns of the results)
+            models.Index(
+                fields=['Coverage', 'Climate', 'id'], condition=models.Q(Approved_by__isnull=False),
+                name='studies_approved_geography_idx',
+            ),
+            models.Index(
+                fields=['Data_source', 'Diagnosis_method', 'id'], condition=models.Q(Approved_by__isnull=False),
+                name='studies_approved_method_idx',
+            ),
+        ]
 
     IMPORT_FIELDS = [
         'Unique_identifier',
@@ -46,10 +71,22 @@ class StudiesModel(models.Model):
     Created_time = models.DateTimeField(auto_now_add=True, verbose_name='Contribution date')
     Created_by = models.ForeignKey(Users, on_delete=models.SET_NULL, 
         null=True, blank=True, verbose_name='Contributed by', related_name='studies')
-    Updated_time = models.DateTimeField(auto_now=True, verbose_name='Last modified')
+    Updated_time = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Last modified')
     Approved_time = models.DateTimeField(null=True, blank=True, verbose_name='Approval date')
     Approved_by = models.ForeignKey(Users, on_delete=models.SET_NULL, 
         null=True, blank=True, verbose_name='Approved by', related_name='approved_studies')
+    # nullable, so that adding the column doesn't rebuild the table (and drop its search/interval triggers),
+    # rows written since are always given a version
+    Change_version = models.PositiveBigIntegerField(null=True, db_index=True, editable=False,
+        help_text='Data version of the last change, used by the change feed (see changes.py)')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the stored dataset, which is bumped together with the new one on a move (see versioning.py)
+        if 'Dataset_id' in field_names:
+            instance._stored_dataset_id = values[field_names.index('Dataset_id')]
+        return instance
 
     @property
     def owner_id(self):
@@ -59,6 +96,10 @@ class StudiesModel(models.Model):
     def pending(self):
         return self.Approved_by is None
 
+    def get_row_version(self):
+        """ Version stamp for the cached changelist row cells (see admin/rendering.py) """
+        return self.Updated_time.isoformat() if self.Updated_time else None
+
     @property
     def change_url(self):
         return reverse('admin:%s_%s_change' % (self._meta.app_label, self._meta.model_name), args=[self.id])
@@ -353,7 +394,7 @@ class StudiesModel(models.Model):
     )
 
     def get_export_id(self):
-        return self.Unique_identifier or self.id
+        return self.Import_row_id or self.id
 
     @classmethod
     def get_view_study_results_url(cls, study_id_list):
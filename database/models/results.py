@@ -1,3 +1,5 @@
+import re
+
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
@@ -11,11 +13,28 @@ from django.utils import timezone
 from .base import FilteredManager
 from .methods import StudiesModel
 
+POINT_ESTIMATE_NUMBER = re.compile(r'[-+]?(?:\d[\d,]*(?:\.\d*)?|\.\d+)')
+
+def parse_point_estimate(text):
+    """ The first number in a point estimate (eg. 1.5 for "1.5%" or "<1.5"), or None """
+    match = POINT_ESTIMATE_NUMBER.search(text or '')
+    if match is None:
+        return None
+    return float(match.group().replace(',', ''))
+
 class ResultsModel(models.Model):
     class Meta:
         db_table = 'database_results'
         verbose_name = 'Result'
         verbose_name_plural = 'Results'
+        # indexes for the admin list_filters and sortable columns, and the rows of each study in changelist order
+        indexes = [
+            models.Index(fields=['Study', '-id'], name='results_study_order_idx'),
+            models.Index(fields=['Country', 'Jurisdiction'], name='results_location_idx'),
+            models.Index(fields=['Jurisdiction'], name='results_jurisdiction_idx'),
+            models.Index(fields=['Year_start', 'Year_stop'], name='results_years_idx'),
+            models.Index(fields=['Point_estimate_value'], name='results_point_estimate_idx'),
+        ]
 
     IMPORT_FIELDS = [
         'Study_ID',
@@ -59,6 +78,12 @@ class ResultsModel(models.Model):
         help_text = 'Row number from spreadsheet (only if imported from Excel)',
     )
 
+    Updated_time = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Last modified')
+    # nullable, so that adding the column doesn't rebuild the table (and drop its search/interval triggers),
+    # rows written since are always given a version
+    Change_version = models.PositiveBigIntegerField(null=True, db_index=True, editable=False,
+        help_text='Data version of the last change, used by the change feed (see changes.py)')
+
     AGE_CHOICES = [
         (x, x) for x in (
             'Infants',
@@ -210,6 +235,13 @@ class ResultsModel(models.Model):
         help_text = 'Must be interpreted together with Measure to provide the point estimate reported by the study within the correct '
             'measurement context. For example: 2020KATZ reports a point estimate of “4.6” and measure of “per 100,000 population”.'
     )
+
+    Point_estimate_value = models.FloatField(
+        null = True,
+        blank = True,
+        editable = False,
+        help_text = 'Number at the start of the Point estimate (set on save), used to sort results by their point estimate.'
+    )
     
     Measure = models.TextField(
         blank = True,
@@ -263,11 +295,22 @@ class ResultsModel(models.Model):
         help_text = 'Point estimate includes data of school children',
     )
     
+    _flag_fields = None
+
+    @classmethod
+    def get_flag_fields(cls):
+        """ Boolean fields shown as row flags (worked out once per model, not per row) """
+        if cls._flag_fields is None:
+            cls._flag_fields = [
+                field for field in cls._meta.get_fields()
+                if isinstance(field, models.BooleanField) and field.name != 'is_approved'
+            ]
+        return cls._flag_fields
+
     def get_flags(self):
         return (
             {'field': field, 'value': getattr(self, field.name)}
-            for field in self._meta.get_fields()
-            if isinstance(field, models.BooleanField) and field.name != 'is_approved'
+            for field in self.get_flag_fields()
         )
 
     @property
@@ -297,6 +340,28 @@ class ResultsModel(models.Model):
             return '%d year%s %d month%s' % (years, years_pl, months, months_pl)
         return '%d month%s' % (months, months_pl)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the stored study, whose dataset is bumped together with the new one on a move (see versioning.py)
+        if 'Study_id' in field_names:
+            instance._stored_study_id = values[field_names.index('Study_id')]
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.Point_estimate_value = parse_point_estimate(self.Point_estimate)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'Point_estimate' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'Point_estimate_value'}
+        super().save(*args, **kwargs)
+
+    def get_row_version(self):
+        """ Version stamp for the cached changelist row cells, the rows also show details of the study """
+        return '%s/%s' % (
+            self.Updated_time.isoformat() if self.Updated_time else None,
+            self.Study.get_row_version() if self.Study_id else None,
+        )
+
     @property
     def view_results_studies_url(self):
         return reverse('admin:database_studies_change', args=[self.Study_id])
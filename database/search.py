@@ -0,0 +1,140 @@
+"""
+Full text search index for the Studies and Results changelists.
+
+On PostgreSQL each table has a generated tsvector column (search_vector) with a GIN index,
+on SQLite each table has an FTS5 external content table (<table>_search) kept in sync by triggers.
+Either way the index is maintained by the database itself, so it stays up to date for saves,
+imports (bulk_create) and bulk updates alike. The index is created by migration 0007, and SQLite migrations
+which rebuild these tables drop the triggers, so such migrations need to drop and re-create the index.
+"""
+import re
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest
+from django.utils.text import smart_split, unescape_string_literal
+
+from database.fuzzy import FUZZY_SEARCH_COLUMNS, get_fuzzy_match
+
+# columns covered by the search index for each table
+# (the Results changelist also matches its Study's columns, see search_queryset)
+SEARCH_INDEX_COLUMNS = {
+    'database_studies': (
+        'Study_group',
+        'Paper_title',
+        'Year',
+        'Study_description',
+        'Disease',
+        'Study_design',
+        'Diagnosis_method',
+        'Data_source',
+        'Data_source_name',
+        'Surveillance_setting',
+        'Clinical_definition_category',
+        'Coverage',
+        'Climate',
+        'Urban_rural_coverage',
+        'Limitations_identified',
+        'Other_points',
+    ),
+    'database_results': (
+        'Age_general',
+        'Age_specific',
+        'Population_gender',
+        'Indigenous_status',
+        'Indigenous_population',
+        'Country',
+        'Jurisdiction',
+        'Specific_location',
+        'Year_start',
+        'Year_stop',
+        'Observation_time_years',
+        'Point_estimate',
+        'Measure',
+    ),
+}
+
+SEARCH_VECTOR_COLUMN = 'search_vector'
+SEARCH_RANK = 'search_rank'
+FUZZY_PREFIX = '~'
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+def has_search_index(using):
+    return connections[using].vendor in ('postgresql', 'sqlite')
+
+def get_fts_table(table):
+    return '%s_search' % table
+
+def parse_search_terms(search_term):
+    """
+    Splits the search into terms the same way as the default admin search (quoted phrases are kept together),
+    yields (tokens, is_phrase, is_fuzzy) for each term. Fuzzy terms are prefixed with ~ (see fuzzy.py).
+    """
+    for bit in smart_split(search_term):
+        is_fuzzy = bit.startswith(FUZZY_PREFIX)
+        if is_fuzzy:
+            bit = bit[len(FUZZY_PREFIX):]
+        is_phrase = bit.startswith(('"', "'")) and bit[0] == bit[-1] and len(bit) > 1
+        if is_phrase:
+            bit = unescape_string_literal(bit)
+        tokens = SEARCH_TOKEN_RE.findall(bit.lower())
+        if tokens:
+            yield tokens, is_phrase, is_fuzzy
+
+def get_match_sql(model, tokens, is_phrase, using):
+    """
+    SQL selecting the ids of the rows which match the term: phrases must match exactly,
+    keywords match the start of a word (eg. 'strep' finds 'Streptococcal').
+    """
+    table = model._meta.concrete_model._meta.db_table
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    if connection.vendor == 'postgresql':
+        query = ' <-> '.join(tokens) + ('' if is_phrase else ':*')
+        return "SELECT id FROM %s WHERE %s @@ to_tsquery('simple'::regconfig, %%s)" % (
+            qn(table), qn(SEARCH_VECTOR_COLUMN)), [query]
+
+    fts_table = get_fts_table(table)
+    query = '"%s"%s' % (' '.join(tokens), '' if is_phrase else '*')
+    return 'SELECT rowid FROM %s WHERE %s MATCH %%s' % (qn(fts_table), qn(fts_table)), [query]
+
+def search_queryset(queryset, search_term, related=()):
+    """
+    Filters the queryset to rows matching every term of the search in the full text index,
+    a term also matches when it is found in the index of one of the related (foreign key) models.
+
+    Fuzzy terms are matched against the FUZZY_SEARCH_COLUMNS instead, and the queryset is annotated
+    with their total similarity as SEARCH_RANK (used to order the changelist, see MyChangeList).
+    """
+    model, using = queryset.model, queryset.db
+    fuzzy_related = [
+        field_name for field_name in related
+        if model._meta.get_field(field_name).related_model._meta.db_table in FUZZY_SEARCH_COLUMNS
+    ]
+    ranks = []
+
+    for tokens, is_phrase, is_fuzzy in parse_search_terms(search_term):
+        if is_fuzzy:
+            term = ' '.join(tokens)
+            term_query, rank = get_fuzzy_match(model, term, using)
+            for field_name in fuzzy_related:
+                related_query, related_rank = get_fuzzy_match(model, term, using, field_name)
+                term_query |= related_query
+                rank = Greatest(rank, related_rank)
+            ranks.append(rank)
+            queryset = queryset.filter(term_query)
+            continue
+
+        term_query = Q(pk__in=RawSQL(*get_match_sql(model, tokens, is_phrase, using)))
+        for field_name in related:
+            related_model = model._meta.get_field(field_name).related_model
+            term_query |= Q(**{
+                '%s__in' % field_name: RawSQL(*get_match_sql(related_model, tokens, is_phrase, using))
+            })
+        queryset = queryset.filter(term_query)
+
+    if ranks:
+        queryset = queryset.annotate(**{SEARCH_RANK: sum(ranks[1:], ranks[0])})
+    return queryset
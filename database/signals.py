@@ -0,0 +1,60 @@
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from database.models import StudiesModel, Studies, My_Drafts, ResultsModel, Results
+from database.admin.rendering import invalidate_row_cache
+from database.changes import get_change_model_name, record_deletions
+from database.versioning import bump_instance_data_version, get_data_version_batch
+
+# proxy models send signals with themselves as the sender (eg. deleted through the admin),
+# cascaded deletions send them with the concrete model
+DATA_MODELS = (StudiesModel, Studies, My_Drafts, ResultsModel, Results)
+
+def data_receiver(signals):
+    """ receiver() for the signals of the studies/results models only, other models can still be fast deleted """
+    def connect(func):
+        for model in DATA_MODELS:
+            receiver(signals, sender=model)(func)
+        return func
+    return connect
+
+def is_deleted_with_study(instance, origin):
+    """ whether the result is deleted because its study (or the study's dataset) is """
+    return isinstance(instance, ResultsModel) and origin is not None and \
+        not issubclass(getattr(origin, 'model', type(origin)), ResultsModel)
+
+@data_receiver([pre_save, pre_delete])
+def bump_version(sender, instance, using, origin=None, **kwargs):
+    # bumped before the write, so that the row is written at the new version (see changes.py),
+    # the results deleted with their study are covered by the bump for the study
+    if not is_deleted_with_study(instance, origin):
+        instance.Change_version = bump_instance_data_version(instance, using)
+
+def is_approved_study(pk, using):
+    # looked up once per study in a data_version_batch() (eg. deleting the selected results)
+    batch = get_data_version_batch(using)
+    if batch is not None:
+        study = batch.get_study(pk)
+        return bool(study and study[1])
+    return Studies.objects.using(using).filter(pk=pk).exists()
+
+@data_receiver(pre_delete)
+def record_result_deletions(sender, instance, using, **kwargs):
+    # the results of a deleted study are recorded together, rather than by record_deletion() for each of them
+    if isinstance(instance, StudiesModel) and instance.Approved_by_id is not None:
+        record_deletions('result', instance.results.using(using).values_list('pk', flat=True), instance.Change_version, using)
+
+@data_receiver(post_delete)
+def record_deletion(sender, instance, using, origin=None, **kwargs):
+    # drafts aren't in the change feed
+    if isinstance(instance, StudiesModel) and instance.Approved_by_id is None:
+        return
+    if isinstance(instance, ResultsModel):
+        # the results deleted with their study are recorded by record_result_deletions()
+        if is_deleted_with_study(instance, origin) or not is_approved_study(instance.Study_id, using):
+            return
+    record_deletions(get_change_model_name(instance), [instance.pk], instance.Change_version, using)
+
+@data_receiver([post_save, post_delete])
+def invalidate_rendered_row(sender, instance, **kwargs):
+    invalidate_row_cache(instance)
@@ -0,0 +1,152 @@
+import os, shutil, sqlite3, tempfile, decimal, datetime
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.http import FileResponse
+
+from database.models import Dataset, StudiesModel, ResultsModel
+from database.exporter import get_export_filename
+
+CHUNK_SIZE = 2000
+
+def get_snapshot_columns(model):
+    """ list of (column name, SQLite type) for a model's importable fields """
+    columns = []
+    for field_name in model.IMPORT_FIELDS:
+        try:
+            field = model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            continue # eg. Study_ID, which is only used by the import
+        if field.is_relation:
+            continue
+        if isinstance(field, (models.BooleanField, models.IntegerField)):
+            col_type = 'INTEGER'
+        elif isinstance(field, (models.DecimalField, models.FloatField)):
+            col_type = 'REAL'
+        else:
+            col_type = 'TEXT'
+        columns.append((field.name, col_type))
+    return columns
+
+STUDY_COLUMNS = [
+    ('id', 'INTEGER PRIMARY KEY'),
+    ('Dataset_id', 'INTEGER REFERENCES datasets (id)'),
+    ('Import_row_id', 'TEXT'),
+    ('Approved_time', 'TEXT'),
+    ('Updated_time', 'TEXT'),
+] + get_snapshot_columns(StudiesModel)
+
+RESULT_COLUMNS = [
+    ('id', 'INTEGER PRIMARY KEY'),
+    ('Study_id', 'INTEGER REFERENCES studies (id)'),
+] + get_snapshot_columns(ResultsModel)
+
+DATASET_COLUMNS = [
+    ('id', 'INTEGER PRIMARY KEY'),
+    ('Dataset_name', 'TEXT'),
+    ('Description', 'TEXT'),
+]
+
+SNAPSHOT_INDEXES = [
+    ('studies_dataset', 'studies', ('Dataset_id', )),
+    ('studies_group_disease', 'studies', ('Study_group', 'Disease')),
+    ('studies_year', 'studies', ('Year', )),
+    ('results_study', 'results', ('Study_id', )),
+    ('results_location', 'results', ('Country', 'Jurisdiction')),
+    ('results_years', 'results', ('Year_start', 'Year_stop')),
+]
+
+def get_view_sql():
+    study_cols = ', '.join(
+        's.%s AS study_%s' % (name, name) for name, _ in STUDY_COLUMNS if name != 'id'
+    )
+    result_cols = ', '.join('r.%s' % name for name, _ in RESULT_COLUMNS)
+    return [
+        'CREATE VIEW results_with_studies AS SELECT %s, %s, d.Dataset_name AS Dataset_name '
+        'FROM results r JOIN studies s ON s.id = r.Study_id JOIN datasets d ON d.id = s.Dataset_id' % (
+            result_cols, study_cols),
+        'CREATE VIEW studies_with_counts AS SELECT s.*, d.Dataset_name AS Dataset_name, '
+        '(SELECT COUNT(*) FROM results r WHERE r.Study_id = s.id) AS Results_count '
+        'FROM studies s JOIN datasets d ON d.id = s.Dataset_id',
+    ]
+
+def to_sqlite_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def insert_rows(conn, table, columns, queryset):
+    names = [ name for name, _ in columns ]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(names), ', '.join('?' * len(names)))
+    rows = queryset.values_list(*names).iterator(chunk_size=CHUNK_SIZE)
+    batch = []
+    for row in rows:
+        batch.append([ to_sqlite_value(v) for v in row ])
+        if len(batch) >= CHUNK_SIZE:
+            conn.executemany(sql, batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+
+def write_sqlite_snapshot(path, studies_qs, results_qs):
+    """
+    Writes the given studies/results (and their datasets) into a new SQLite database at path,
+    with indexes and views joining results to studies. All rows are bulk inserted in one transaction.
+    The database is written to a temporary file which is only moved to path once it is complete
+    (there is no rollback journal to undo a failed write), so an error never leaves a partial snapshot behind.
+    """
+    partial_path = '%s.part' % path
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    try:
+        conn = sqlite3.connect(partial_path, isolation_level=None)
+        try:
+            write_snapshot_tables(conn, studies_qs, results_qs)
+        finally:
+            conn.close()
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+def write_snapshot_tables(conn, studies_qs, results_qs):
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('BEGIN')
+    for table, columns in (('datasets', DATASET_COLUMNS), ('studies', STUDY_COLUMNS), ('results', RESULT_COLUMNS)):
+        conn.execute('CREATE TABLE %s (%s)' % (table, ', '.join('%s %s' % col for col in columns)))
+
+    insert_rows(conn, 'datasets', DATASET_COLUMNS,
+        Dataset.objects.filter(pk__in=studies_qs.values('Dataset_id')).order_by('pk'))
+    insert_rows(conn, 'studies', STUDY_COLUMNS, studies_qs.order_by('pk'))
+    insert_rows(conn, 'results', RESULT_COLUMNS, results_qs.order_by('pk'))
+
+    # indexes are built after loading, which is faster than maintaining them per row
+    for name, table, columns in SNAPSHOT_INDEXES:
+        conn.execute('CREATE INDEX %s ON %s (%s)' % (name, table, ', '.join(columns)))
+    for sql in get_view_sql():
+        conn.execute(sql)
+    conn.execute('COMMIT')
+
+def download_sqlite_snapshot(studies_qs, results_qs):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'snapshot.sqlite3')
+        write_sqlite_snapshot(path, studies_qs, results_qs)
+
+        # copy into an anonymous temporary file which is cleaned up when the response is closed
+        output = tempfile.TemporaryFile()
+        with open(path, 'rb') as snapshot:
+            shutil.copyfileobj(snapshot, output)
+        output.seek(0)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return FileResponse(
+        output,
+        as_attachment=True,
+        filename=get_export_filename('sqlite3'),
+        content_type='application/vnd.sqlite3',
+    )
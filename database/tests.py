@@ -1,3 +1,1491 @@
+import base64, csv, hashlib, io, json, os, re, shutil, sqlite3, tempfile, zipfile
+from unittest import mock, skipUnless
+
+import openpyxl
+from django_admin_listfilter_dropdown.filters import DropdownFilter
+
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.utils import get_fields_from_path
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.deletion import Collector
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from database.admin.counting import COUNT_ESTIMATE_THRESHOLD, get_count, get_count_cache_key, get_estimated_count
+from database.admin.rendering import get_row_cache_key
+from database.admin_site import admin_site
+from database import columnar, fuzzy
+from database.changes import get_changes
+from database.columnar import schedule_update, update_columnar_index
+from database.filters import FacetCountsMixin, get_filter_specs
+from database.fuzzy import FUZZY_SEARCH_THRESHOLD, TrigramIndex, get_trigrams
+from database.intervals import INTERVAL_INDEX_COLUMNS, get_interval_index_name
+from database.search import SEARCH_INDEX_COLUMNS, get_match_sql, has_search_index
+from database.models import Users, Dataset, DataRequest, Studies, StudiesModel, Results, ResultsModel
+from database.versioning import data_version_batch, get_data_version, get_data_version_stamp
+
+def create_studies(user, dataset, num_studies, results_per_study):
+    for i in range(num_studies):
+        study = StudiesModel.objects.create(
+            Dataset=dataset, Created_by=user, Approved_by=user, Approved_time=timezone.now(),
+            Study_group='ARF', Disease='ARF', Paper_title='Paper %d' % i, Year=2000 + i % 20,
+            Study_design='Prospective', Climate='Tropical', Coverage='State',
+        )
+        for j in range(results_per_study):
+            ResultsModel.objects.create(
+                Study=study, Jurisdiction='WA', Year_start=2000, Year_stop=2001 + j,
+                Point_estimate='%d' % j, Interpolated_from_graph=False, Proportion=False,
+            )
+
+def get_sqlite_triggers(table):
+    """ names of the triggers on the table (which SQLite drops when a migration rebuilds it) """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [table])
+        return { row[0] for row in cursor.fetchall() }
+
+
+class DataTestCase(TestCase):
+    """ A logged in read-only user, and num_studies approved studies with results_per_study results each """
+    num_studies = 0
+    results_per_study = 0
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Users.objects.create_user(
+            'reader@example.com', 'Read', 'Only', 'password', access_level=Users.ACCESS_READONLY)
+        cls.dataset = Dataset.objects.create(Dataset_name='Test')
+        create_studies(cls.user, cls.dataset, cls.num_studies, cls.results_per_study)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def get_changelist(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+
+@override_settings(BACKUP_MAX_WORKERS=1)
+class BackupTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_dataset = Dataset.objects.create(Dataset_name='Other')
+        create_studies(cls.user, cls.other_dataset, 1, 1)
+        cls.admin = Users.objects.create_user(
+            'admin@example.com', 'Ad', 'Min', 'password', access_level=Users.ACCESS_ADMIN)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        self.backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.backup_dir)
+        settings_override = self.settings(BACKUP_ROOT=self.backup_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_backup(self, filename='backup.zip'):
+        from database.backup import write_backup_zip
+        write_backup_zip([self.dataset.pk, self.other_dataset.pk], '%s/%s' % (self.backup_dir, filename))
+        return '%s/%s' % (self.backup_dir, filename)
+
+    def test_workbooks_and_manifest(self):
+        with zipfile.ZipFile(self.write_backup()) as backup:
+            manifest = json.loads(backup.read('manifest.json'))
+            self.assertEqual([ (item['dataset'], item['studies'], item['results']) for item in manifest['datasets'] ],
+                [('Other', 1, 1), ('Test', 2, 6)])
+            for item in manifest['datasets']:
+                data = backup.read(item['file'])
+                self.assertEqual(hashlib.sha256(data).hexdigest(), item['sha256'])
+                workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+                # a header row, then a row per study/result
+                self.assertEqual(len(list(workbook['Methods'].rows)), item['studies'] + 1)
+                self.assertEqual(len(list(workbook['Results'].rows)), item['results'] + 1)
+
+    @mock.patch('database.backup.threading.Thread', lambda target, daemon: mock.Mock(start=target))
+    @mock.patch('database.backup.subprocess.Popen')
+    def test_admin_starts_job(self, popen):
+        response = self.client.post(reverse('admin:database_dataset_changelist'), {
+            'action': 'backup_datasets_zip', ACTION_CHECKBOX_NAME: [self.dataset.pk],
+        })
+        self.assertEqual(response.status_code, 302)
+        args = popen.call_args[0][0]
+        self.assertEqual(args[2:3] + args[4:], ['backup_datasets', '--dataset-id', str(self.dataset.pk)])
+        # the process is reaped when it exits
+        popen.return_value.wait.assert_called_once_with()
+
+    @mock.patch('database.backup.subprocess.Popen')
+    def test_admin_requires_backup_root(self, popen):
+        with self.settings(BACKUP_ROOT=None):
+            response = self.client.post(reverse('admin:database_dataset_changelist'), {
+                'action': 'backup_datasets_zip', ACTION_CHECKBOX_NAME: [self.dataset.pk],
+            }, follow=True)
+            self.assertEqual(self.client.get(reverse('admin:database_dataset_backups')).status_code, 200)
+        self.assertFalse(popen.called)
+        self.assertIn('BACKUP_ROOT', [ str(message) for message in response.context['messages'] ][0])
+
+    def test_admin_downloads(self):
+        self.write_backup()
+        # unfinished backups aren't listed
+        open('%s/unfinished.zip.part' % self.backup_dir, 'wb').close()
+        response = self.client.get(reverse('admin:database_dataset_backups'))
+        self.assertEqual([ name for name, _, _ in response.context['backups'] ], ['backup.zip'])
+
+        response = self.client.get(reverse('admin:database_dataset_backup', args=['backup.zip']))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="backup.zip"')
+        self.assertEqual(self.client.get(reverse('admin:database_dataset_backup', args=['unfinished.zip.part'])).status_code, 404)
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('admin:database_dataset_backups')).status_code, 403)
+
+
+class SnapshotTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 3
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'snapshot.sqlite3')
+
+    def write_snapshot(self):
+        from database.models import Studies, Results
+        from database.snapshot import write_sqlite_snapshot
+        write_sqlite_snapshot(self.path, Studies.objects.all(), Results.objects.all())
+
+    def test_snapshot(self):
+        # drafts aren't exported
+        StudiesModel.objects.filter(pk=StudiesModel.objects.first().pk).update(Approved_by=None)
+        self.write_snapshot()
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name").fetchall(), [
+            ('table', 'datasets'), ('table', 'results'), ('view', 'results_with_studies'),
+            ('table', 'studies'), ('view', 'studies_with_counts'),
+        ])
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM studies').fetchone(), (1, ))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM results_with_studies WHERE Dataset_name = ?', ['Test']).fetchone(), (3, ))
+        self.assertEqual(conn.execute('SELECT Results_count FROM studies_with_counts').fetchall(), [(3, )])
+
+    def test_failed_snapshot_removed(self):
+        with mock.patch('database.snapshot.get_view_sql', return_value=['CREATE VIEW broken AS SELEKT 1']):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.write_snapshot()
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+
+class ExportTests(DataTestCase):
+    num_studies = 6
+    results_per_study = 2
+    queries = {'studies': '?Disease__in=ARF&q=kimberley', 'results': '?Study__Disease__in=ARF&q=kimberley'}
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i, study in enumerate(StudiesModel.objects.order_by('pk')):
+            StudiesModel.objects.filter(pk=study.pk).update(
+                Disease=('ARF', 'APSGN')[i % 2], Paper_title='Paper %d%s' % (i, ' in the Kimberley' if i % 3 else ''))
+        # drafts are never exported
+        cls.draft = StudiesModel.objects.filter(Disease='ARF', Paper_title__contains='Kimberley').order_by('pk').first()
+        StudiesModel.objects.filter(pk=cls.draft.pk).update(Approved_by=None)
+        cls.study_pks = list(Studies.objects.filter(Disease='ARF', Paper_title__contains='Kimberley').order_by('pk').values_list('pk', flat=True))
+        cls.result_pks = list(ResultsModel.objects.filter(Study__in=cls.study_pks).order_by('pk').values_list('pk', flat=True))
+
+    def export(self, model_name, export_format, query):
+        """ Returns (study pks, result pks or the study pks of the results for CSV) of the exported rows """
+        response = self.client.get(reverse('admin:database_%s_export' % model_name, args=[export_format]) + query)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        if export_format == 'csv':
+            rows = list(csv.reader(io.StringIO(content.decode())))[1:]
+            return sorted(int(row[0]) for row in rows)
+        if export_format == 'xlsx':
+            workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True)
+            return [
+                sorted(row[0] for row in workbook[sheet].iter_rows(min_row=2, max_col=1, values_only=True))
+                for sheet in ('Methods', 'Results')
+            ]
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as snapshot:
+            snapshot.write(content)
+            snapshot.flush()
+            conn = sqlite3.connect(snapshot.name)
+            try:
+                return [ [ row[0] for row in conn.execute('SELECT id FROM %s ORDER BY id' % table) ] for table in ('studies', 'results') ]
+            finally:
+                conn.close()
+
+    def get_result_study_pks(self):
+        return sorted(ResultsModel.objects.filter(pk__in=self.result_pks).values_list('Study_id', flat=True))
+
+    def test_formats(self):
+        self.assertEqual(len(self.study_pks), 1)
+        for model_name in ('studies', 'results'):
+            # sorted by a composite column too, the rows are exported in pk order
+            for query in (self.queries[model_name], self.queries[model_name] + '&o=-1'):
+                msg = '%s %s' % (model_name, query)
+                self.assertEqual(self.export(model_name, 'xlsx', query), [self.study_pks, self.get_result_study_pks()], msg)
+                self.assertEqual(self.export(model_name, 'sqlite', query), [self.study_pks, self.result_pks], msg)
+        self.assertEqual(self.export('studies', 'csv', self.queries['studies']), self.study_pks)
+        self.assertEqual(self.export('results', 'csv', self.queries['results'] + '&o=2'), self.get_result_study_pks())
+
+    def test_unfiltered(self):
+        study_pks = list(Studies.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(self.export('studies', 'csv', ''), study_pks)
+        self.assertEqual(len(self.export('results', 'sqlite', '')[1]), len(study_pks) * self.results_per_study)
+
+    def test_invalid_filters(self):
+        for model_name in ('studies', 'results'):
+            response = self.client.get(reverse('admin:database_%s_export' % model_name, args=['csv']) + '?Not_a_field=1')
+            self.assertRedirects(
+                response, reverse('admin:database_%s_changelist' % model_name) + '?e=1', fetch_redirect_response=False)
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get(reverse('admin:database_studies_export', args=['pdf'])).status_code, 404)
+
+    def test_permissions(self):
+        url = reverse('admin:database_studies_export', args=['csv'])
+        with mock.patch.object(type(admin_site._registry[Studies]), 'has_view_permission', return_value=False):
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.logout()
+        self.assertRedirects(
+            self.client.get(url), reverse('admin:login') + '?' + urlencode({'next': url}), fetch_redirect_response=False)
+
+
+class ApiTests(DataTestCase):
+    num_studies = 5
+    results_per_study = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.draft = StudiesModel.objects.order_by('pk').first()
+        StudiesModel.objects.filter(pk=cls.draft.pk).update(Approved_by=None)
+        cls.approved_pks = list(StudiesModel.objects.exclude(pk=cls.draft.pk).order_by('pk').values_list('pk', flat=True))
+
+    def get_pages(self, url):
+        pks = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            pks += [ row['id'] for row in page['results'] ]
+            url = page['next']
+        return pks
+
+    def test_pages(self):
+        # the filters are kept by the next page links, and drafts are never listed
+        self.assertEqual(self.get_pages(reverse('api_list', args=['studies']) + '?limit=3&Disease__in=ARF'), self.approved_pks)
+        self.assertEqual(self.get_pages(reverse('api_list', args=['studies']) + '?limit=3&Disease__in=APSGN'), [])
+        self.assertEqual(len(self.get_pages(reverse('api_list', args=['results']) + '?limit=3')), 4)
+
+    def test_ndjson(self):
+        response = self.client.get(reverse('api_list', args=['studies']) + '?format=ndjson&cursor=%d' % self.approved_pks[0])
+        rows = [ json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines() ]
+        self.assertEqual([ row['id'] for row in rows ], self.approved_pks[1:])
+
+    def test_invalid_parameters(self):
+        url = reverse('api_list', args=['studies'])
+        self.assertEqual(self.client.get(url + '?cursor=abc').status_code, 400)
+        self.assertEqual(self.client.get(url + '?limit=abc').status_code, 400)
+        self.assertEqual(self.client.get(url + '?Year__gte=abc').status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_list', args=['users'])).status_code, 404)
+
+    def test_permissions(self):
+        url = reverse('api_list', args=['studies'])
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.client.force_login(Users.objects.create_user(
+            'disabled@example.com', 'Dis', 'Abled', 'password', access_level=Users.ACCESS_DISABLED))
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.client.force_login(self.user)
+        model_admin = type(admin_site._registry[Studies])
+        with mock.patch.object(model_admin, 'has_view_permission', return_value=False):
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class ChangeFeedTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.admin = Users.objects.create_user(
+            'admin@example.com', 'Ad', 'Min', 'password', access_level=Users.ACCESS_SUPER)
+
+    def get_changes(self, since):
+        changes = get_changes(since)
+        return {
+            'studies': list(changes['studies'].values_list('pk', flat=True)),
+            'results': list(changes['results'].values_list('pk', flat=True)),
+            'deleted': [ (item['model'], item['id']) for item in changes['deleted'] ],
+        }, changes['cursor']
+
+    def assertChanges(self, since, studies=(), results=(), deleted=()):
+        changes, cursor = self.get_changes(since)
+        self.assertEqual(changes, {'studies': list(studies), 'results': list(results), 'deleted': list(deleted)})
+        return cursor
+
+    def post_action(self, url_name, action, study):
+        self.client.force_login(self.admin)
+        self.client.post(reverse(url_name), {'action': action, ACTION_CHECKBOX_NAME: [study.pk]})
+
+    def test_cursor(self):
+        study, other = StudiesModel.objects.order_by('pk')
+        cursor = self.assertChanges(None,
+            studies=[study.pk, other.pk], results=ResultsModel.objects.order_by('pk').values_list('pk', flat=True))
+        cursor = self.assertChanges(cursor)
+
+        result = study.results.first()
+        result.save()
+        study.save()
+        cursor = self.assertChanges(cursor, studies=[study.pk], results=[result.pk])
+        self.assertChanges(cursor)
+
+        with self.assertRaises(ValidationError):
+            get_changes('2023-06-01T02:00:00+00:00')
+
+    def test_deletion(self):
+        study = StudiesModel.objects.order_by('pk').first()
+        study_pk, result_pks = study.pk, list(study.results.order_by('pk').values_list('pk', flat=True))
+        cursor = self.get_changes(None)[1]
+        ResultsModel.objects.get(pk=result_pks[0]).delete()
+        cursor = self.assertChanges(cursor, deleted=[('result', result_pks[0])])
+        study.delete()
+        self.assertChanges(cursor, deleted=[('result', result_pks[1]), ('study', study_pk)])
+
+    def test_deletion_queries(self):
+        # the results deleted with their study are recorded together, not with a query each
+        create_studies(self.user, self.dataset, 1, 6)
+        studies = StudiesModel.objects.order_by('pk')[::2]
+        result_pks = sorted(ResultsModel.objects.filter(Study__in=studies).values_list('pk', flat=True))
+        cursor = self.get_changes(None)[1]
+        queries = []
+        for study in studies:
+            with CaptureQueriesContext(connection) as ctx:
+                study.delete()
+            queries.append(len(ctx.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(sorted(pk for model, pk in self.get_changes(cursor)[0]['deleted'] if model == 'result'), result_pks)
+
+    def test_draft_deletion(self):
+        # drafts were never in the change feed
+        draft = StudiesModel.objects.order_by('pk').first()
+        StudiesModel.objects.filter(pk=draft.pk).update(Approved_by=None)
+        draft.refresh_from_db()
+        cursor = self.get_changes(None)[1]
+        draft.save()
+        draft.delete()
+        self.assertChanges(cursor)
+
+    def test_withdrawal(self):
+        study = StudiesModel.objects.order_by('pk').first()
+        cursor = self.get_changes(None)[1]
+        self.post_action('admin:database_studies_changelist', 'revert_to_draft', study)
+        withdrawn = self.assertChanges(cursor, deleted=[('study', study.pk)])
+
+        # editing the draft doesn't withdraw it again
+        study.refresh_from_db()
+        study.save()
+        self.assertChanges(withdrawn)
+
+        StudiesModel.objects.filter(pk=study.pk).update(Created_by=self.admin)
+        self.post_action('admin:database_my_drafts_changelist', 'approve_study', study)
+        self.assertChanges(withdrawn, studies=[study.pk], results=study.results.order_by('pk').values_list('pk', flat=True))
+        # approved again within the same window
+        self.assertChanges(cursor, studies=[study.pk], results=study.results.order_by('pk').values_list('pk', flat=True))
+
+    def test_fast_delete(self):
+        # the signals are only connected for the studies/results models
+        self.assertTrue(Collector('default').can_fast_delete(DataRequest.objects.all()))
+        self.assertFalse(Collector('default').can_fast_delete(ResultsModel.objects.all()))
+
+    def test_api(self):
+        cursor = self.get_changes(None)[1]
+        result = ResultsModel.objects.order_by('pk').first()
+        result.save()
+        url = reverse('api_changes') + '?since=' + cursor
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        changes = response.json()
+        self.assertEqual([ row['id'] for row in changes['results'] ], [result.pk])
+        self.assertEqual(changes['cursor'], self.get_changes(None)[1])
+
+        response = self.client.get(url + '&format=ndjson')
+        lines = [ json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines() ]
+        self.assertEqual(lines, [
+            {'model': 'result', 'op': 'upsert', 'data': changes['results'][0]},
+            {'cursor': changes['cursor']},
+        ])
+        self.assertEqual(response['X-Change-Cursor'], changes['cursor'])
+        self.assertEqual(self.client.get(reverse('api_changes') + '?since=abc').status_code, 400)
+
+    def test_export_command(self):
+        output = tempfile.NamedTemporaryFile(suffix='.ndjson', delete=False).name
+        cursor_file = output + '.cursor'
+        self.addCleanup(os.remove, output)
+        self.addCleanup(os.remove, cursor_file)
+
+        def export():
+            call_command('export_changes', output, cursor_file=cursor_file, stdout=io.StringIO())
+            with open(output) as f:
+                return [ json.loads(line) for line in f ]
+
+        self.assertEqual(len(export()), 2 + 4 + 1)
+        result = ResultsModel.objects.order_by('pk').first()
+        result_pk = result.pk
+        result.delete()
+        lines = export()
+        self.assertEqual(lines[:-1], [{'op': 'delete', 'model': 'result', 'id': result_pk}])
+        with open(cursor_file) as f:
+            self.assertEqual(f.read(), lines[-1]['cursor'])
+        self.assertEqual(len(export()), 1)
+
+
+# the SQL queries of the changelists (rather than the in-memory columnar index)
+@override_settings(COLUMNAR_FILTERS=False)
+class ChangelistQueryCountTests(DataTestCase):
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url, results_per_study):
+        create_studies(self.user, self.dataset, 5, results_per_study)
+        num_queries = self.count_queries(url)
+        # a full page of rows, each with a different study
+        create_studies(self.user, self.dataset, 100, results_per_study)
+        self.assertEqual(self.count_queries(url), num_queries)
+
+    def test_results_changelist(self):
+        self.assertConstantQueries(reverse('admin:database_results_changelist'), 2)
+
+    def test_studies_changelist(self):
+        self.assertConstantQueries(reverse('admin:database_studies_changelist'), 1)
+
+    def test_results_relations_planned(self):
+        request = self.client.get(reverse('admin:database_results_changelist')).wsgi_request
+        select_related, prefetch_related = admin_site._registry[Results].get_list_relations(request)
+        self.assertEqual(select_related, ['Study'])
+        self.assertEqual(prefetch_related, [])
+
+
+@override_settings(COLUMNAR_FILTERS=False)
+class FilterOptionCacheTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 1
+
+    def test_filter_options_cached(self):
+        url = reverse('admin:database_results_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+        self.assertEqual([ query['sql'] for query in ctx.captured_queries if 'DISTINCT' in query['sql'] ], [])
+
+        # options are refreshed when the data changes
+        ResultsModel.objects.create(
+            Study=StudiesModel.objects.first(), Year_start=2000, Year_stop=2001, Point_estimate='1',
+            Interpolated_from_graph=False, Proportion=True)
+        proportion_filter, = [
+            spec for spec in self.get_changelist(url).filter_specs if getattr(spec, 'field_path', None) == 'Proportion'
+        ]
+        self.assertEqual(list(proportion_filter.lookup_choices), [False, True])
+
+    def test_default_option_values(self):
+        ResultsModel.objects.create(
+            Study=StudiesModel.objects.first(), Year_start=2000, Year_stop=2001, Point_estimate='1',
+            Interpolated_from_graph=False, Proportion=True)
+        request = self.client.get(reverse('admin:database_results_changelist')).wsgi_request
+        filter_class = type('Filter', (FacetCountsMixin, DropdownFilter), {})
+        def get_filter(field_path):
+            field = get_fields_from_path(Results, field_path)[-1]
+            return filter_class(field, request, {}, Results, admin_site._registry[Results], field_path)
+
+        # the same options as the filter itself (without the empty value)
+        spec = get_filter('Proportion')
+        self.assertEqual(spec.get_option_values(), [False, True])
+        self.assertEqual(spec.get_option_values(), [ value for value in spec.lookup_choices if value is not None ])
+        spec = get_filter('Study__Study_design')
+        self.assertEqual(spec.get_option_values(), list(spec.lookup_choices))
+
+
+@override_settings(COLUMNAR_FILTERS=False)
+class CountCacheTests(DataTestCase):
+    num_studies = 3
+    results_per_study = 1
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def estimate(self, rows):
+        """ counts as on PostgreSQL, with the query planner estimating the number of rows """
+        patchers = [
+            mock.patch('database.admin.counting.connections', {connection.alias: mock.Mock(vendor='postgresql')}),
+            mock.patch('database.admin.counting.get_estimated_count', return_value=rows),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_cache_key(self):
+        queryset = Studies.objects.filter(Disease='ARF')
+        key = get_count_cache_key(queryset)
+        self.assertEqual(get_count_cache_key(Studies.objects.filter(Disease='ARF')), key)
+        self.assertNotEqual(get_count_cache_key(Studies.objects.filter(Disease='APSGN')), key)
+
+        # cached until the data version changes
+        self.assertEqual(get_count(queryset), (3, True))
+        with self.assertNumQueries(1): # the data version
+            self.assertEqual(get_count(queryset), (3, True))
+        create_studies(self.user, self.dataset, 1, 0)
+        self.assertNotEqual(get_count_cache_key(queryset), key)
+        self.assertEqual(get_count(queryset), (4, True))
+
+    def test_estimated(self):
+        self.estimate(50000)
+        url = reverse('admin:database_studies_changelist')
+        cl = self.get_changelist(url)
+        self.assertEqual((cl.result_count, cl.count_is_exact), (50000, False))
+        self.assertIn('exact=1', cl.exact_count_url)
+
+        cl = self.get_changelist(url + '?exact=1')
+        self.assertEqual((cl.result_count, cl.count_is_exact), (3, True))
+        # the exact count is cached (for the unfiltered query only)
+        self.assertEqual(get_count(Studies.objects.all()), (3, True))
+        cl = self.get_changelist(url + '?Disease__in=ARF')
+        self.assertEqual((cl.result_count, cl.count_is_exact), (50000, False))
+
+    def test_small_estimates_counted(self):
+        self.estimate(COUNT_ESTIMATE_THRESHOLD)
+        self.assertEqual(get_count(Studies.objects.all()), (3, True))
+
+    @skipUnless(connection.vendor == 'postgresql', 'counts are only estimated on PostgreSQL')
+    def test_planner_estimate(self):
+        self.assertIsInstance(get_estimated_count(Studies.objects.filter(Disease='ARF')), int)
+
+
+@override_settings(COLUMNAR_FILTERS=False)
+class PageCacheTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 1
+
+    def test_pages_cached(self):
+        url = reverse('admin:database_results_changelist')
+        self.client.get(url + '?Proportion__exact=0&o=1')
+        # the same page with the parameters in a different order isn't counted again
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url + '?o=1&Proportion__exact=0')
+        self.assertEqual([ query['sql'] for query in ctx.captured_queries if 'COUNT(*)' in query['sql'] ], [])
+        self.assertEqual(response.context['cl'].result_count, 2)
+
+        # counts are refreshed when the data changes
+        ResultsModel.objects.create(
+            Study=StudiesModel.objects.first(), Year_start=2000, Year_stop=2001, Point_estimate='1',
+            Interpolated_from_graph=False, Proportion=False)
+        self.assertEqual(self.get_changelist(url + '?o=1&Proportion__exact=0').result_count, 3)
+
+
+@override_settings(COLUMNAR_FILTERS=False)
+class ListOnlyFieldsTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 1
+
+    def test_results_fields_planned(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('admin:database_results_changelist'))
+        page_sql, = [ query['sql'] for query in ctx.captured_queries if query['sql'].startswith('SELECT "database_results"."id"') ]
+        self.assertIn('"Paper_title"', page_sql)
+        self.assertNotIn('"Other_points"', page_sql)
+
+    @override_settings(DEBUG=True)
+    def test_deferred_loads_flagged(self):
+        from database.admin.results import AllResultsView
+        with mock.patch.object(AllResultsView, 'list_only_fields', ()):
+            with self.assertWarnsRegex(RuntimeWarning, r'database\.Results\.Age_min'):
+                self.client.get(reverse('admin:database_results_changelist'))
+
+
+@override_settings(ROW_CACHE_TIMEOUT=0)
+class RowRendererTests(DataTestCase):
+    num_studies = 3
+    results_per_study = 2
+
+    def assertCellsRendered(self, model, url):
+        """ the cells rendered for the page are the same as the template_column()s render on their own """
+        model_admin = admin_site._registry[model]
+        cl = self.get_changelist(url)
+        columns = [ getattr(model_admin, name) for name in cl.list_display
+            if getattr(getattr(model_admin, name, None), 'row_template', None) ]
+        self.assertTrue(columns)
+        for row in cl.result_list:
+            cells = [ column(row) for column in columns ]
+            del row._rendered_cells
+            self.assertEqual(cells, [ column(row) for column in columns ])
+
+    def test_studies(self):
+        self.assertCellsRendered(Studies, reverse('admin:database_studies_changelist'))
+
+    def test_results(self):
+        self.assertCellsRendered(Results, reverse('admin:database_results_changelist'))
+
+    def test_import_identifier(self):
+        study = StudiesModel.objects.order_by('pk').first()
+        self.assertEqual(study.get_export_id(), study.pk)
+        StudiesModel.objects.filter(pk=study.pk).update(Import_row_id='WA-2001')
+        study.refresh_from_db()
+        self.assertEqual(study.get_export_id(), 'WA-2001')
+        for url_name in ('admin:database_studies_changelist', 'admin:database_results_changelist'):
+            self.assertContains(self.client.get(reverse(url_name)), '(WA-2001)')
+
+
+class RowCacheTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 2
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def get_page(self, url_name):
+        response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def replace_cached_cells(self, row):
+        """ replaces the row's cached cells with a marker, which is shown for as long as they are used """
+        key = get_row_cache_key(row)
+        entry = cache.get(key)
+        self.assertEqual(entry['version'], row.get_row_version())
+        entry['cells'] = { name: 'cached-cell-%d' % row.pk for name in entry['cells'] }
+        cache.set(key, entry)
+        return 'cached-cell-%d' % row.pk
+
+    def test_cached_cells(self):
+        self.get_page('admin:database_results_changelist')
+        result = ResultsModel.objects.order_by('pk').first()
+        marker = self.replace_cached_cells(result)
+        self.assertIn(marker, self.get_page('admin:database_results_changelist'))
+
+        result.save()
+        self.assertIsNone(cache.get(get_row_cache_key(result)))
+        self.assertNotIn(marker, self.get_page('admin:database_results_changelist'))
+
+    def test_row_version(self):
+        # updates which bypass the signals still change the row version, as do changes to the study
+        self.get_page('admin:database_results_changelist')
+        result = ResultsModel.objects.order_by('pk').first()
+        marker = self.replace_cached_cells(result)
+        StudiesModel.objects.filter(pk=result.Study_id).update(Updated_time=timezone.now())
+        self.assertNotIn(marker, self.get_page('admin:database_results_changelist'))
+
+    def test_user_cells_not_cached(self):
+        contributor = Users.objects.create_user(
+            'contributor@example.com', 'Con', 'Tributor', 'password', access_level=Users.ACCESS_CONTRIB)
+        StudiesModel.objects.update(Created_by=contributor, Approved_by=None)
+        self.client.force_login(contributor)
+        self.assertIn('Con Tributor', self.get_page('admin:database_my_drafts_changelist'))
+
+        Users.objects.filter(pk=contributor.pk).update(first_name='Renamed')
+        page = self.get_page('admin:database_my_drafts_changelist')
+        self.assertIn('Renamed Tributor', page)
+        self.assertNotIn('Con Tributor', page)
+
+    def test_cache_size(self):
+        # the configured cache keeps the other entries while it is filled with rows
+        # (the default in-memory cache culls a third of them every 300 entries)
+        self.get_page('admin:database_results_changelist')
+        cache.set('database.page:test', 'page')
+        cache.set_many({ 'database.row:test:%d' % i: i for i in range(5000) })
+        self.assertEqual(cache.get('database.page:test'), 'page')
+        self.assertIsNotNone(cache.get(get_row_cache_key(ResultsModel.objects.order_by('pk').first())))
+
+
+@skipUnless(has_search_index(connection.alias), 'the full text index is only available on PostgreSQL and SQLite')
+class SearchIndexTests(DataTestCase):
+    num_studies = 1
+    results_per_study = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.study = StudiesModel.objects.get()
+        cls.result = ResultsModel.objects.get()
+
+    def get_indexed(self, model, term):
+        """ pks of the rows the index has for the keyword (read from the index itself) """
+        sql, params = get_match_sql(model, [term], False, connection.alias)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [ row[0] for row in cursor.fetchall() ]
+
+    def search(self, url_name, term):
+        cl = self.get_changelist(reverse(url_name) + '?' + urlencode({'q': term}))
+        return [ row.pk for row in cl.result_list ]
+
+    def test_insert(self):
+        self.assertEqual(self.get_indexed(StudiesModel, 'paper'), [self.study.pk])
+        self.assertEqual(self.get_indexed(ResultsModel, 'wa'), [self.result.pk])
+
+    def test_update(self):
+        self.study.Paper_title = 'Streptococcal pharyngitis'
+        self.study.save()
+        self.assertEqual(self.get_indexed(StudiesModel, 'paper'), [])
+        self.assertEqual(self.get_indexed(StudiesModel, 'pharyngitis'), [self.study.pk])
+
+        # bulk updates bypass the signals, but not the database
+        ResultsModel.objects.update(Jurisdiction='NT')
+        self.assertEqual(self.get_indexed(ResultsModel, 'wa'), [])
+        self.assertEqual(self.get_indexed(ResultsModel, 'nt'), [self.result.pk])
+
+    def test_delete(self):
+        self.study.delete()
+        self.assertEqual(self.get_indexed(StudiesModel, 'paper'), [])
+        self.assertEqual(self.get_indexed(ResultsModel, 'wa'), [])
+
+    @skipUnless(connection.vendor == 'sqlite', 'the index is kept up to date by triggers on SQLite')
+    def test_triggers(self):
+        # still there after the later migrations
+        for table in SEARCH_INDEX_COLUMNS:
+            triggers = { '%s_search_%s' % (table, event) for event in ('insert', 'delete', 'update') }
+            self.assertEqual(triggers - get_sqlite_triggers(table), set())
+
+    def test_matches_start_of_words(self):
+        StudiesModel.objects.update(Paper_title='Streptococcal pharyngitis')
+        self.assertEqual(self.search('admin:database_studies_changelist', 'strep'), [self.study.pk])
+        self.assertEqual(self.search('admin:database_studies_changelist', 'coccal'), [])
+        self.assertEqual(self.search('admin:database_studies_changelist', '"streptococcal pharyngitis"'), [self.study.pk])
+        self.assertEqual(self.search('admin:database_studies_changelist', '"strep pharyngitis"'), [])
+        # results also match their study
+        self.assertEqual(self.search('admin:database_results_changelist', 'strep wa'), [self.result.pk])
+
+
+class FuzzySearchTests(DataTestCase):
+    num_studies = 3
+    results_per_study = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.kimberley, cls.kimberly, cls.perth = StudiesModel.objects.order_by('pk')
+        for study, title in ((cls.kimberley, 'Kimberley region'), (cls.kimberly, 'Kimberly'), (cls.perth, 'Perth')):
+            study.Paper_title = title
+            study.save()
+
+    def setUp(self):
+        super().setUp()
+        # the data versions of the indexes are rolled back with each test
+        fuzzy._trigram_indexes.clear()
+
+    def search(self, url_name, term):
+        cl = self.get_changelist(reverse(url_name) + '?' + urlencode({'q': term}))
+        return [ row.pk for row in cl.result_list ]
+
+    def test_trigrams(self):
+        # padded like pg_trgm
+        self.assertEqual(get_trigrams('Kim'), {'  k', ' ki', 'kim', 'im '})
+        self.assertEqual(get_trigrams('a-b'), {'  a', ' a ', '  b', ' b '})
+
+    def test_trigram_index(self):
+        index = TrigramIndex([(1, 'Kimberley region', None), (2, 'Perth', None), (3, None, 'Kimberly')])
+        matches = index.search('Kimberly')
+        self.assertEqual([ pk for pk, _ in matches ], [3, 1])
+        self.assertEqual(matches[0][1], 1.0)
+        self.assertGreaterEqual(matches[1][1], FUZZY_SEARCH_THRESHOLD)
+        self.assertEqual(index.search('Sydney'), [])
+
+        postings = index.postings['rly']
+        index.update([(2, 'Kimberly', None)])
+        index.remove([3])
+        self.assertEqual([ pk for pk, _ in index.search('Kimberly') ], [2, 1])
+        self.assertEqual(postings, {3})
+
+    def test_ranked(self):
+        # the best match first
+        self.assertEqual(self.search('admin:database_studies_changelist', '~Kimberly'), [self.kimberly.pk, self.kimberley.pk])
+        self.assertEqual(self.search('admin:database_studies_changelist', '~Kimberley'), [self.kimberley.pk, self.kimberly.pk])
+        # other terms still narrow down the matches
+        self.assertEqual(self.search('admin:database_studies_changelist', '~Kimberly region'), [self.kimberley.pk])
+
+    def test_related(self):
+        # results match the title of their study, and their own location
+        results = { result.Study_id: result.pk for result in ResultsModel.objects.all() }
+        self.assertEqual(self.search('admin:database_results_changelist', '~Kimberly'),
+            [results[self.kimberly.pk], results[self.kimberley.pk]])
+        result = ResultsModel.objects.get(pk=results[self.perth.pk])
+        result.Specific_location = 'Kimberly'
+        result.save()
+        self.assertIn(results[self.perth.pk], self.search('admin:database_results_changelist', '~Kimberly'))
+
+    def test_index_follows_changes(self):
+        self.assertEqual(self.search('admin:database_studies_changelist', '~Broome'), [])
+        index = fuzzy.get_trigram_index(StudiesModel, 'default')
+        self.perth.Paper_title = 'Broome'
+        self.perth.save()
+        self.assertEqual(self.search('admin:database_studies_changelist', '~Brome'), [self.perth.pk])
+        self.perth.delete()
+        self.assertEqual(self.search('admin:database_studies_changelist', '~Brome'), [])
+        # updated rather than rebuilt
+        self.assertIs(fuzzy.get_trigram_index(StudiesModel, 'default'), index)
+
+    def test_drafts_indexed(self):
+        StudiesModel.objects.filter(pk=self.perth.pk).update(Approved_by=None)
+        self.perth.refresh_from_db()
+        self.search('admin:database_studies_changelist', '~Perth')
+        self.perth.Paper_title = 'Broome'
+        self.perth.save()
+        self.assertIn(self.perth.pk, [ pk for pk, _ in fuzzy.get_trigram_index(StudiesModel, 'default').search('Brome') ])
+
+
+class KeysetPaginationTests(DataTestCase):
+    num_studies = 7
+    results_per_study = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # ties in the ordering, which are broken by the pk
+        for study in StudiesModel.objects.all():
+            study.Paper_title = 'Paper %d' % (study.pk % 3)
+            study.save()
+
+    def setUp(self):
+        super().setUp()
+        for model in (Studies, Results):
+            patcher = mock.patch.object(type(admin_site._registry[model]), 'list_per_page', 2)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def follow(self, url, link):
+        """ ([pks of the rows of each page], last changelist, its url) following the next_url/previous_url links """
+        base, pages = url.split('?')[0], []
+        while url:
+            cl = self.get_changelist(url)
+            self.assertIsNotNone(cl.keyset_ordering)
+            pages.append([ row.pk for row in cl.result_list ])
+            last_url, url = url, getattr(cl, link) and base + getattr(cl, link)
+        return pages, cl, last_url
+
+    def assertSeekPages(self, url):
+        """ the pages have every row once, in the changelist ordering, both forwards and backwards """
+        expected = list(self.get_changelist(url).queryset.values_list('pk', flat=True))
+        pages, cl, last_url = self.follow(url, 'next_url')
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(len(pages), 4)
+        pages, _, _ = self.follow(last_url, 'previous_url')
+        self.assertEqual(sum(pages[::-1], []), expected)
+        return cl.keyset_ordering
+
+    def test_default_ordering(self):
+        # mixed ascending/descending keys
+        keyset_ordering = self.assertSeekPages(reverse('admin:database_studies_changelist'))
+        self.assertIn(('Paper_title', True), keyset_ordering)
+
+    def test_descending(self):
+        keyset_ordering = self.assertSeekPages(reverse('admin:database_studies_changelist') + '?o=-3')
+        self.assertEqual(keyset_ordering, [('Coverage', True), ('Climate', True), ('pk', True)])
+
+    def test_results(self):
+        self.assertSeekPages(reverse('admin:database_results_changelist'))
+
+    def test_fallback(self):
+        # sorted by a nullable field (Year), or an expression (the number of results): numbered pages instead
+        for query in ('?o=1', '?o=-5'):
+            cl = self.get_changelist(reverse('admin:database_studies_changelist') + query)
+            self.assertIsNone(cl.keyset_ordering)
+            self.assertIsNone(cl.next_url)
+            self.assertEqual(len(cl.result_list), 2)
+            self.assertEqual(cl.paginator.num_pages, 4)
+
+    def test_invalid_cursor(self):
+        url = reverse('admin:database_studies_changelist')
+        cl = self.get_changelist(url)
+        valid = json.loads(base64.urlsafe_b64decode(cl.encode_cursor('next', cl.result_list[-1])))
+
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+        for cursor in (
+            'not a cursor', encode({'next': 1}), encode(['sideways', valid[1]]),
+            encode(['next', valid[1][:-1]]), encode(['next', [*valid[1][:-1], 'not a pk']]),
+            encode(['next', [*valid[1][:-1], None]]),
+        ):
+            response = self.client.get(url + '?' + urlencode({'cursor': cursor}))
+            self.assertRedirects(response, url + '?e=1', fetch_redirect_response=False, msg_prefix=cursor)
+
+
+class ColumnarUpdatesMixin:
+    """ Updates the columnar indexes in the request (the background thread can't see the data of the test's transaction) """
+    def setUp(self):
+        super().setUp()
+        for patcher in (
+            mock.patch('database.columnar.schedule_update', update_columnar_index),
+            mock.patch.dict('database.columnar._indexes', clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class ColumnarIndexTests(ColumnarUpdatesMixin, DataTestCase):
+    num_studies = 6
+    results_per_study = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i, study in enumerate(StudiesModel.objects.order_by('pk')):
+            StudiesModel.objects.filter(pk=study.pk).update(
+                Disease=('ARF', 'APSGN')[i % 2], Study_design=('Prospective', 'Retrospective', 'Case series')[i % 3])
+        for i, result in enumerate(ResultsModel.objects.order_by('pk')):
+            ResultsModel.objects.filter(pk=result.pk).update(
+                Country=('Australia', 'New Zealand')[i % 2], Proportion=i % 3 == 0,
+                Age_min=i if i % 4 else None, Age_max=i + 10 if i % 4 else None)
+
+    def setUp(self):
+        super().setUp()
+        for model in (Studies, Results):
+            patcher = mock.patch.object(type(admin_site._registry[model]), 'list_per_page', 4)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_state(self, url, columnar_filters):
+        """ counts, rows and facet counts of the changelist, with or without the columnar index """
+        cache.clear() # pages and counts from the other path
+        with self.settings(COLUMNAR_FILTERS=columnar_filters):
+            cl = self.get_changelist(url)
+            self.assertEqual(cl.columnar_query is not None, columnar_filters, url)
+            facet_counts = {
+                spec.field_path: cl.get_facet_counts(spec)
+                for spec in get_filter_specs(cl.filter_specs) if getattr(spec, 'field_path', None)
+            }
+        return cl.result_count, cl.full_result_count, [ row.pk for row in cl.result_list ], facet_counts, cl.next_url
+
+    def assertMatchesSQL(self, url):
+        self.get_state(url, True) # builds the index
+        self.assertEqual(self.get_state(url, True), self.get_state(url, False), url)
+
+    def test_filters(self):
+        url = reverse('admin:database_results_changelist')
+        for query in (
+            '', '?Study__Disease__in=APSGN', '?Study__Disease__in=ARF,APSGN&Proportion=True',
+            '?Study__Study_design__exact=Prospective', '?Country=New+Zealand&Study__Disease__in=ARF',
+            '?Year_start__range__gte=2002&Year_stop__range__lte=2010', '?Age_min__range__gte=3',
+            '?Study__Year__range__gte=2002&Study__Year__range__lte=2004', '?Age_max__range__lte=15&o=-1',
+        ):
+            self.assertMatchesSQL(url + query)
+
+        url = reverse('admin:database_studies_changelist')
+        for query in ('', '?Disease__in=APSGN', '?Study_design__exact=Retrospective&o=3', '?Year__range__gte=2003'):
+            self.assertMatchesSQL(url + query)
+
+    @override_settings(COLUMNAR_FILTERS=True)
+    def test_built_outside_request(self):
+        url = reverse('admin:database_results_changelist')
+        with mock.patch('database.columnar.schedule_update') as schedule_update:
+            self.assertIsNone(self.get_changelist(url).columnar_query)
+        # the request uses SQL until the update has run
+        update_columnar_index(*schedule_update.call_args.args)
+        self.assertIsNotNone(self.get_changelist(url + '?Proportion=True').columnar_query)
+
+        # a later data version schedules a refresh
+        ResultsModel.objects.order_by('pk').first().save()
+        with mock.patch('database.columnar.schedule_update') as schedule_update:
+            self.assertIsNone(self.get_changelist(url + '?Proportion=False').columnar_query)
+        schedule_update.assert_called_once()
+
+    def test_update_queued_once(self):
+        args = ('key', Results.objects.all(), [], ['pk'])
+        with mock.patch.object(columnar, '_executor') as executor, mock.patch.object(columnar, '_pending', set()):
+            for _ in range(2):
+                schedule_update(*args)
+            executor.submit.assert_called_once_with(columnar.run_update, *args)
+
+            # queued again once it has run (the worker thread closes its connections)
+            with mock.patch.object(columnar, 'update_columnar_index') as update, mock.patch.object(columnar, 'connections'):
+                columnar.run_update(*args)
+            update.assert_called_once_with(*args)
+            schedule_update(*args)
+            self.assertEqual(executor.submit.call_count, 2)
+
+    def test_seek_pages(self):
+        url = reverse('admin:database_results_changelist') + '?Study__Disease__in=ARF,APSGN'
+        self.get_state(url, True)
+        base = url.split('?')[0]
+        pages = {}
+        for columnar_filters in (True, False):
+            cache.clear()
+            next_url, pages[columnar_filters] = url, []
+            with self.settings(COLUMNAR_FILTERS=columnar_filters):
+                while next_url:
+                    cl = self.get_changelist(next_url)
+                    self.assertEqual(cl.columnar_query is not None, columnar_filters)
+                    pages[columnar_filters].append([ row.pk for row in cl.result_list ])
+                    next_url = cl.next_url and base + cl.next_url
+        self.assertEqual(len(pages[True]), 3)
+        self.assertEqual(pages[True], pages[False])
+
+    def test_refresh(self):
+        url = reverse('admin:database_results_changelist')
+        self.get_state(url, True)
+        (key, index), = columnar._indexes.items()
+
+        # changed, deleted and withdrawn rows are refreshed in place
+        result = ResultsModel.objects.order_by('pk').first()
+        result.Proportion, result.Country = not result.Proportion, 'Fiji'
+        result.save()
+        ResultsModel.objects.order_by('pk').last().delete()
+        self.client.force_login(Users.objects.create_user(
+            'admin@example.com', 'Ad', 'Min', 'password', access_level=Users.ACCESS_ADMIN))
+        study = StudiesModel.objects.order_by('pk')[2]
+        response = self.client.post(reverse('admin:database_studies_changelist'), {
+            'action': 'revert_to_draft', ACTION_CHECKBOX_NAME: [study.pk],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.client.force_login(self.user)
+
+        refreshed = index.refresh()
+        self.assertIsNotNone(refreshed)
+        self.assertEqual(refreshed.cursor, get_data_version_stamp()[0])
+        rebuilt = columnar.ColumnarIndex(index.queryset, index.field_paths, key[-1])
+        self.assertEqual(self.get_rows(refreshed), self.get_rows(rebuilt))
+        for query in ('', '?Country=Fiji', '?Proportion=False&Study__Disease__in=APSGN'):
+            self.assertMatchesSQL(url + query)
+        self.assertIsNot(columnar._indexes[key], index)
+
+        # a new row has to be rebuilt
+        index = columnar._indexes[key]
+        create_studies(self.user, self.dataset, 1, 1)
+        self.assertIsNone(index.refresh())
+        self.assertMatchesSQL(url)
+
+    def get_rows(self, index):
+        """ pk and column values of the rows in the index, in its ordering """
+        columns = []
+        for path in index.field_paths:
+            column = index.columns[path]
+            if isinstance(column, columnar.ChoiceColumn):
+                values = [ column.values[code] if code >= 0 else None for code in column.codes ]
+            else:
+                values = [ None if value != value else value for value in column.data.tolist() ] # NaN is null
+            columns.append(values)
+        return [ (pk, *row) for pk, alive, *row in zip(index.pks.tolist(), index.alive, *columns) if alive ]
+
+
+class QueryPlanMixin:
+    def get_page_plan(self, url):
+        """ query plan of the query selecting the page of rows """
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        table = 'database_results' if 'results' in url else 'database_studies'
+        page_sql = [
+            query['sql'] for query in ctx.captured_queries
+            if query['sql'].startswith('SELECT "%s"."id"' % table)
+        ][0]
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + page_sql)
+            return ' | '.join(row[3] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, url, index_name):
+        plan = self.get_page_plan(url)
+        self.assertIn('INDEX %s' % index_name, plan)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked with SQLite EXPLAIN QUERY PLAN')
+@override_settings(COLUMNAR_FILTERS=False)
+class ChangelistQueryPlanTests(QueryPlanMixin, DataTestCase):
+    num_studies = 20
+    results_per_study = 2
+
+    def test_studies_ordering(self):
+        self.assertUsesIndex(reverse('admin:database_studies_changelist'), 'studies_approved_order_idx')
+
+    def test_studies_disease_filter(self):
+        self.assertUsesIndex(
+            reverse('admin:database_studies_changelist') + '?Disease__in=ARF', 'studies_approved_disease_idx')
+
+    def test_studies_year_filter(self):
+        self.assertUsesIndex(
+            reverse('admin:database_studies_changelist') + '?Year__gte=2005&Year__lte=2006', 'studies_approved_year_idx')
+
+    def test_results_ordering(self):
+        self.assertUsesIndex(reverse('admin:database_results_changelist'), 'studies_approved_order_idx')
+
+    def test_results_location_filters(self):
+        url = reverse('admin:database_results_changelist')
+        self.assertUsesIndex(url + '?Country=Australia', 'results_location_idx')
+        self.assertUsesIndex(url + '?Jurisdiction=WA', 'results_jurisdiction_idx')
+
+    def test_results_years_filter(self):
+        self.assertUsesIndex(
+            reverse('admin:database_results_changelist') + '?Year_start__gte=2005&Year_stop__lte=2010', 'results_years_idx')
+
+
+class IntervalFilterTests(ColumnarUpdatesMixin, QueryPlanMixin, DataTestCase):
+    # results observed over 2000-2001, 2000-2002 and 2000-2003
+    num_studies = 2
+    results_per_study = 3
+
+    def get_result_count(self, query):
+        return self.get_changelist(reverse('admin:database_results_changelist') + query).result_count
+
+    def assertOverlapCounts(self):
+        self.assertEqual(self.get_result_count('?Year_start__range__gte=2002&Year_stop__range__lte=2010'), 4)
+        self.assertEqual(self.get_result_count('?Year_start__range__gte=2001&Year_stop__range__lte=2001'), 6)
+        self.assertEqual(self.get_result_count('?Year_start__range__gte=1990&Year_stop__range__lte=1999'), 0)
+        self.assertEqual(self.get_result_count('?Year_start__range__gte=2003'), 2)
+        self.assertEqual(self.get_result_count('?Year_stop__range__lte=2000'), 6)
+
+    @override_settings(COLUMNAR_FILTERS=False)
+    def test_overlap(self):
+        self.assertOverlapCounts()
+
+    @override_settings(COLUMNAR_FILTERS=True)
+    def test_overlap_columnar(self):
+        self.assertOverlapCounts()
+
+    @skipUnless(connection.vendor == 'sqlite', 'the index is kept up to date by triggers on SQLite')
+    def test_triggers(self):
+        # still there after the later migrations
+        for table, intervals in INTERVAL_INDEX_COLUMNS.items():
+            triggers = {
+                '%s_%s' % (get_interval_index_name(table, start, stop), event)
+                for start, stop in intervals for event in ('insert', 'delete', 'update')
+            }
+            self.assertEqual(triggers - get_sqlite_triggers(table), set())
+
+    @skipUnless(connection.vendor == 'sqlite', 'query plans are checked with SQLite EXPLAIN QUERY PLAN')
+    @override_settings(COLUMNAR_FILTERS=False)
+    def test_overlap_plan(self):
+        plan = self.get_page_plan(
+            reverse('admin:database_results_changelist') + '?Year_start__range__gte=2005&Year_stop__range__lte=2010')
+        self.assertIn('SCAN database_results_year_start_year_stop_interval VIRTUAL TABLE', plan)
+
+
+class HierarchicalFilterTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        first, second = ResultsModel.objects.order_by('pk')
+        ResultsModel.objects.filter(pk=first.pk).update(Country='Australia', Jurisdiction='WA')
+        ResultsModel.objects.filter(pk=second.pk).update(Country='New Zealand', Jurisdiction='Auckland')
+
+    def get_jurisdictions(self, query=''):
+        location_filter, = [
+            spec for spec in self.get_changelist(reverse('admin:database_results_changelist') + query).filter_specs
+            if [ level.field_path for level in getattr(spec, 'filter_specs', ()) ] == ['Country', 'Jurisdiction']
+        ]
+        return list(location_filter.filter_specs[1].lookup_choices)
+
+    def test_child_options(self):
+        self.assertEqual(self.get_jurisdictions(), ['Auckland', 'WA'])
+        self.assertEqual(self.get_jurisdictions('?Country=Australia'), ['WA'])
+
+    def test_related_levels_allowed(self):
+        self.assertEqual(self.get_changelist(reverse('admin:database_results_changelist') + '?Study__Disease__in=ARF').result_count, 2)
+
+
+class DataVersionTests(DataTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_dataset = Dataset.objects.create(Dataset_name='Other')
+
+    def get_versions(self):
+        return [ get_data_version(), get_data_version(dataset=self.dataset.pk), get_data_version(dataset=self.other_dataset.pk) ]
+
+    def assertBumped(self, change, expected):
+        before = self.get_versions()
+        change()
+        self.assertEqual([ a != b for a, b in zip(before, self.get_versions()) ], expected)
+
+    def test_writes_bump_versions(self):
+        self.assertBumped(lambda: create_studies(self.user, self.dataset, 1, 1), [True, True, False])
+        self.assertBumped(lambda: ResultsModel.objects.get().save(), [True, True, False])
+        self.assertBumped(lambda: ResultsModel.objects.get().delete(), [True, True, False])
+        self.assertBumped(lambda: StudiesModel.objects.get().delete(), [True, True, False])
+
+    def test_bulk_updates_bump_versions(self):
+        create_studies(self.user, self.other_dataset, 1, 1)
+        self.client.force_login(Users.objects.create_user(
+            'admin@example.com', 'Ad', 'Min', 'password', access_level=Users.ACCESS_SUPER))
+        study = StudiesModel.objects.get()
+        self.assertBumped(lambda: self.client.post(reverse('admin:database_studies_changelist'), {
+            'action': 'revert_to_draft', ACTION_CHECKBOX_NAME: [study.pk],
+        }), [True, False, True])
+        self.assertFalse(StudiesModel.objects.filter(Approved_by__isnull=False).exists())
+
+    def test_moves_bump_both_datasets(self):
+        create_studies(self.user, self.dataset, 1, 1)
+        create_studies(self.user, self.other_dataset, 1, 0)
+        study = StudiesModel.objects.get(Dataset=self.dataset)
+        other_study = StudiesModel.objects.get(Dataset=self.other_dataset)
+
+        def move_result():
+            result = ResultsModel.objects.get()
+            result.Study = other_study
+            result.save()
+
+        def move_study():
+            study.Dataset = self.dataset
+            study.save()
+
+        self.assertBumped(move_result, [True, True, True])
+        study.Dataset = self.other_dataset
+        self.assertBumped(study.save, [True, True, True])
+        self.assertBumped(move_study, [True, True, True])
+
+    def get_counters(self):
+        return [ get_data_version_stamp(dataset=dataset)[0] for dataset in (None, self.dataset.pk, self.other_dataset.pk) ]
+
+    def test_batch_bumps_once(self):
+        before = self.get_counters()
+        with data_version_batch():
+            create_studies(self.user, self.dataset, 2, 2)
+            create_studies(self.user, self.other_dataset, 1, 1)
+        self.assertEqual(self.get_counters(), [ version + 1 for version in before ])
+        self.assertEqual(
+            set(ResultsModel.objects.values_list('Change_version', flat=True)) | set(StudiesModel.objects.values_list('Change_version', flat=True)),
+            {before[0] + 1})
+
+    def test_batch_queries(self):
+        # only the writes themselves are repeated for each row of a batch
+        create_studies(self.user, self.dataset, 1, 6)
+        queries = []
+        for results in (ResultsModel.objects.all()[:2], ResultsModel.objects.all()[2:]):
+            with CaptureQueriesContext(connection) as ctx, data_version_batch():
+                for result in results:
+                    result.save()
+            queries.append(len(ctx.captured_queries))
+        self.assertEqual(queries[1] - queries[0], 2)
+
+    def test_action_bumps_once(self):
+        create_studies(self.user, self.dataset, 2, 2)
+        self.client.force_login(Users.objects.create_user(
+            'admin@example.com', 'Ad', 'Min', 'password', access_level=Users.ACCESS_SUPER))
+        before = self.get_counters()
+        response = self.client.post(reverse('admin:database_results_changelist'), {
+            'action': 'delete_selected', 'post': 'yes',
+            ACTION_CHECKBOX_NAME: list(ResultsModel.objects.values_list('pk', flat=True)),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(ResultsModel.objects.exists())
+        self.assertEqual(self.get_counters(), [before[0] + 1, before[1] + 1, before[2]])
+
+
+class ConditionalRequestTests(DataTestCase):
+    num_studies = 2
+    results_per_study = 1
+
+    def assertNotModified(self, url):
+        etag = self.client.get(url)['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # only the session, the user and the data version are looked up
+        self.assertEqual(len(ctx.captured_queries), 3)
+        return etag
+
+    def test_changelist(self):
+        url = reverse('admin:database_results_changelist') + '?Study__Disease__in=ARF'
+        self.client.get(url) # sets the CSRF cookie
+        etag = self.assertNotModified(url)
+        self.assertEqual(self.client.get(url)['Cache-Control'], 'private, no-cache')
+
+        ResultsModel.objects.first().save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_new_build(self):
+        url = reverse('admin:database_studies_changelist')
+        self.client.get(url)
+        etag = self.assertNotModified(url)
+        with self.settings(BUILD_ID='next'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_export(self):
+        response = self.client.get(reverse('admin:database_studies_export', args=['csv']))
+        # like the changelist, which the export follows
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertNotModified(reverse('admin:database_studies_export', args=['csv']))
+
+    def test_home(self):
+        self.assertNotModified(reverse('home'))
+
+
+class ResultsInlineTests(DataTestCase):
+    num_studies = 1
+    results_per_study = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.study = StudiesModel.objects.get()
+
+    @mock.patch('database.admin.results.ReadonlyResultsInline.per_page', 2)
+    def test_pages(self):
+        response = self.client.get(reverse('admin:database_studies_change', args=[self.study.pk]))
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual(formset.total_count, 5)
+        self.assertEqual(len(formset.get_queryset()), 2)
+
+        pks = [ row.pk for row in formset.get_queryset() ]
+        url = formset.next_url
+        while url:
+            page = self.client.get(url).json()
+            pks += [ int(pk) for pk in re.findall(r'data-pk="(\d+)"', page['html']) ]
+            url = page['next']
+        self.assertEqual(pks, list(self.study.results.order_by('-pk').values_list('pk', flat=True)))
+
+    def get_count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [ query['sql'] for query in ctx.captured_queries if 'COUNT(' in query['sql'] ], response
+
+    @mock.patch('database.admin.results.ReadonlyResultsInline.per_page', 2)
+    def test_counted_by_inline_only(self):
+        # the study is loaded without counting its results, which are counted for the inline's total
+        count_queries, response = self.get_count_queries(reverse('admin:database_studies_change', args=[self.study.pk]))
+        self.assertEqual(len(count_queries), 1)
+        self.assertIn('Showing <span class="results-shown">2</span> of 5 results', response.content.decode())
+
+        next_url = response.context['inline_admin_formsets'][0].formset.next_url
+        count_queries, _ = self.get_count_queries(next_url)
+        self.assertEqual(count_queries, [])
+
+    def test_single_page_not_counted(self):
+        count_queries, response = self.get_count_queries(reverse('admin:database_studies_change', args=[self.study.pk]))
+        self.assertEqual(count_queries, [])
+        self.assertEqual(response.context['inline_admin_formsets'][0].formset.total_count, 5)
+
+
+@override_settings(COLUMNAR_FILTERS=False)
+class AggregateColumnTests(DataTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for results_per_study in (1, 3, 2):
+            create_studies(cls.user, cls.dataset, 1, results_per_study)
+
+    def test_sorted_by_results_count(self):
+        url = reverse('admin:database_studies_changelist')
+        column = self.get_changelist(url).list_display.index('get_results_count')
+        for columnar_filters in (False, True):
+            with self.settings(COLUMNAR_FILTERS=columnar_filters):
+                changelist = self.get_changelist(url + '?o=-%d' % column)
+            self.assertEqual([ row.results_count for row in changelist.result_list ], [3, 2, 1])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked with SQLite EXPLAIN QUERY PLAN')
+@override_settings(COLUMNAR_FILTERS=False)
+class SortedColumnTests(QueryPlanMixin, DataTestCase):
+    num_studies = 20
+    results_per_study = 2
+
+    def test_sorted_columns(self):
+        # ?o= is the index of the column in list_display (after the action checkbox)
+        self.assertUsesIndex(reverse('admin:database_studies_changelist') + '?o=-1', 'studies_approved_disease_idx')
+        url = reverse('admin:database_results_changelist')
+        self.assertUsesIndex(url + '?o=4', 'results_location_idx')
+        self.assertUsesIndex(url + '?o=-6', 'results_point_estimate_idx')
+
+    def test_composite_columns(self):
+        url = reverse('admin:database_studies_changelist')
+        self.assertUsesIndex(url + '?o=2', 'studies_approved_method_idx')
+        self.assertUsesIndex(url + '?o=-3', 'studies_approved_geography_idx')
+
+        # the study columns of the results read the studies in index order, only each study's results are sorted
+        url = reverse('admin:database_results_changelist')
+        for query, index_name in (('?o=1', 'studies_approved_disease_idx'), ('?o=-2', 'studies_approved_method_idx')):
+            plan = self.get_page_plan(url + query)
+            self.assertIn('SCAN database_studies USING INDEX %s' % index_name, plan)
+            self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+
+
+@override_settings(COLUMNAR_FILTERS=False)
+class SortedRowsTests(DataTestCase):
+    num_studies = 4
+    point_estimates = ['<1.5', '1,000', '2.5%', 'n/a', '0.5 (0.1-0.9)', '-3', '1000', None]
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i, study in enumerate(StudiesModel.objects.order_by('pk')):
+            StudiesModel.objects.filter(pk=study.pk).update(
+                Coverage=('State', 'National/multi-jurisdictional')[i % 2], Climate=('Tropical', 'Arid')[i // 2 % 2],
+                Data_source=('Medical records only', 'Multiple sources')[i % 2],
+                Diagnosis_method=('ICD codes', 'Clinical diagnosis only')[i // 2 % 2])
+        studies = list(StudiesModel.objects.order_by('pk'))
+        for i, point_estimate in enumerate(cls.point_estimates):
+            ResultsModel.objects.create(
+                Study=studies[i % len(studies)], Year_start=2000, Year_stop=2001, Point_estimate=point_estimate,
+                Interpolated_from_graph=False, Proportion=False)
+
+    def get_pks(self, url):
+        return [ row.pk for row in self.get_changelist(url).result_list ]
+
+    def test_point_estimate_values(self):
+        values = dict(ResultsModel.objects.values_list('Point_estimate', 'Point_estimate_value'))
+        self.assertEqual(values, {
+            '<1.5': 1.5, '1,000': 1000.0, '2.5%': 2.5, 'n/a': None, '0.5 (0.1-0.9)': 0.5, '-3': -3.0, '1000': 1000.0, None: None,
+        })
+
+    def test_point_estimate_order(self):
+        url = reverse('admin:database_results_changelist')
+        results = ResultsModel.objects.order_by('pk')
+        numbers = sorted((row for row in results if row.Point_estimate_value is not None), key=lambda row: row.Point_estimate_value)
+        nulls = [ row for row in results if row.Point_estimate_value is None ]
+        # ties (1,000 and 1000) by pk, null values wherever the database sorts them
+        expected = numbers + nulls if connection.features.nulls_order_largest else nulls + numbers
+        self.assertEqual(self.get_pks(url + '?o=6'), [ row.pk for row in expected ])
+        self.assertEqual(self.get_pks(url + '?o=-6'), [ row.pk for row in expected ][::-1])
+
+    def test_composite_order(self):
+        studies = StudiesModel.objects.all()
+        url = reverse('admin:database_studies_changelist')
+        self.assertEqual(self.get_pks(url + '?o=3'), [
+            row.pk for row in sorted(studies, key=lambda row: (row.Coverage, row.Climate, row.pk))])
+        self.assertEqual(self.get_pks(url + '?o=-2'), [
+            row.pk for row in sorted(studies, key=lambda row: (row.Data_source, row.Diagnosis_method, row.pk), reverse=True)])
+
+        results = ResultsModel.objects.select_related('Study')
+        url = reverse('admin:database_results_changelist')
+        self.assertEqual(self.get_pks(url + '?o=2'), [
+            row.pk for row in sorted(results, key=lambda row: (row.Study.Data_source, row.Study.Diagnosis_method, row.Study_id, row.pk))])
 
-# Create your tests here.
+    def test_sorted_exports(self):
+        # the export links and the API keep the changelist's ?o=, which can sort the composite columns
+        for model, model_name in ((Studies, 'studies'), (Results, 'results')):
+            model_admin = admin_site._registry[model]
+            columns = [
+                i for i, name in enumerate(model_admin.list_display)
+                if isinstance(getattr(getattr(model_admin, name, None), 'admin_order_field', None), (list, tuple))
+            ]
+            self.assertGreaterEqual(len(columns), 2)
+            export_url = reverse('admin:database_%s_export' % model_name, args=['csv'])
+            api_url = reverse('api_list', args=[model_name])
+            expected = list(model.objects.order_by('pk').values_list('pk', flat=True))
+            for column in columns:
+                for query in ('?o=%d' % column, '?o=-%d' % column):
+                    response = self.client.get(export_url + query)
+                    self.assertEqual(response.status_code, 200, export_url + query)
+                    lines = b''.join(response.streaming_content).decode().splitlines()
+                    self.assertEqual(len(lines), len(expected) + 1) # and the header
+                    response = self.client.get(api_url + query)
+                    self.assertEqual(response.status_code, 200, api_url + query)
+                    self.assertEqual([ row['id'] for row in response.json()['results'] ], expected)
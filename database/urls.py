@@ -1,5 +1,5 @@
 from django.urls import path, include
-from  . import views
+from  . import views, api
 from django.contrib.auth import views as auth_views
 
 urlpatterns = [
@@ -23,4 +23,8 @@ urlpatterns = [
 	path('reset/sent/', auth_views.PasswordResetDoneView.as_view(template_name='database/password/password_reset_done.html'), name='password_reset_done'),
 	path('reset/confirm/<uidb64>/<token>/', auth_views.PasswordResetConfirmView.as_view(template_name='database/password/password_reset_change.html'), name='password_reset_confirm'),  
 	path('reset/done/', auth_views.PasswordResetCompleteView.as_view(template_name='database/password/password_reset_complete.html'), name='password_reset_complete'),
+
+	# Read-only data API
+	path('api/changes/', api.api_changes, name='api_changes'),
+	path('api/<str:model_name>/', api.api_list, name='api_list'),
 ]
@@ -0,0 +1,172 @@
+"""
+Data version of the studies/results tables, used to key caches of derived data (eg. changelist counts).
+
+Each Dataset has a version counter, and there is one more for all of the data (DataVersion with no Dataset).
+The counters are bumped by bump_data_version() on every write: saves and deletes of studies/results
+(see signals.py), as well as bulk updates which bypass the signals (eg. approving or reverting studies).
+
+The version of all data is also the cursor of the change feed (see changes.py): the written rows record the
+version they were written at. The bump locks the counter until the transaction ends, so versions are committed
+in order, and once a version can be read every write at or below it has been committed.
+Writes of many rows (eg. admin actions and imports) are made in a data_version_batch(), which bumps the counters
+once for all of its writes.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import IntegrityError, transaction
+from django.db.models import DEFERRED, F, Q
+from django.utils import timezone
+
+from database.models import DataVersion, Dataset, StudiesModel, ResultsModel
+
+_batches = threading.local()
+
+class DataVersionBatch:
+    """
+    The version of the writes of a data_version_batch(), the datasets which have been bumped for it,
+    and the (dataset, approved) of the studies which its writes have looked up
+    """
+    def __init__(self, using):
+        self.using = using
+        self.version = None
+        self.datasets = set()
+        self.studies = {}
+
+    def bump(self, datasets=None):
+        versions = DataVersion.objects.using(self.using)
+        dataset_ids = set()
+        if isinstance(datasets, (list, set)):
+            dataset_ids = set(datasets) - self.datasets
+        elif datasets is not None:
+            dataset_ids = set(versions.filter(Dataset__in=datasets).exclude(
+                Dataset__in=self.datasets).values_list('Dataset', flat=True))
+        if self.version is None:
+            self.version = bump_counters(self.using, list(dataset_ids))
+        elif dataset_ids:
+            versions.filter(Dataset__in=dataset_ids).update(Version=F('Version') + 1, Updated_time=timezone.now())
+        self.datasets |= dataset_ids
+        return self.version
+
+    def get_study(self, pk):
+        """ (dataset id, approved) of the study, or None if there is no such study """
+        if pk not in self.studies:
+            study = StudiesModel.objects.using(self.using).filter(pk=pk).values_list('Dataset', 'Approved_by').first()
+            self.studies[pk] = study and (study[0], study[1] is not None)
+        return self.studies[pk]
+
+@contextmanager
+def data_version_batch(using='default'):
+    """
+    Makes the writes of the block in one transaction at one data version: the first write bumps the version
+    of all data, and each dataset is bumped once, by the first write to it. Nested batches join the outer one.
+    """
+    batches = _batches.__dict__.setdefault('batches', {})
+    if using in batches:
+        yield batches[using]
+        return
+    with transaction.atomic(using=using):
+        batches[using] = DataVersionBatch(using)
+        try:
+            yield batches[using]
+        finally:
+            del batches[using]
+
+def get_data_version_batch(using='default'):
+    """ Returns the data_version_batch() which is open for the database, or None """
+    return getattr(_batches, 'batches', {}).get(using)
+
+def bump_data_version(using='default', datasets=None):
+    """
+    Increments the version of all data, and of the datasets (a list of ids, or a values() queryset of ids).
+    Called within the transaction of the write, so the new version is only seen together with the new data.
+    The time of the write is kept too: a rolled back bump may have been read (and cached) before the rollback,
+    and the next bump reuses its counter, but not its time.
+    Returns the new version of all data, which the written rows are recorded at (see changes.py).
+    Within a data_version_batch() the version of the batch is returned instead, without bumping it again.
+    """
+    batch = get_data_version_batch(using)
+    if batch is not None:
+        return batch.bump(datasets)
+    return bump_counters(using, datasets)
+
+def bump_counters(using, datasets):
+    query = Q(Dataset__isnull=True)
+    if datasets is not None:
+        query |= Q(Dataset__in=datasets)
+    versions = DataVersion.objects.using(using)
+    versions.filter(query).update(Version=F('Version') + 1, Updated_time=timezone.now())
+    version = versions.filter(Dataset__isnull=True).values_list('Version', flat=True).first()
+    if version is None:
+        # there was no counter to bump yet
+        get_data_version_stamp(using)
+        return bump_counters(using, datasets)
+    return version
+
+def bump_instance_data_version(instance, using='default'):
+    """
+    bump_data_version() for a study/result which is about to be saved or deleted, returns the new version.
+    Both the dataset it is saved to and the dataset of the stored row are bumped, as it may be moved from
+    one dataset (or study) to another. The stored dataset/study is known without a query for rows which
+    were loaded with it (see StudiesModel.from_db()), and in a data_version_batch() the datasets of the
+    studies are looked up once for the batch, so that its writes don't make a query per row.
+    """
+    batch = get_data_version_batch(using)
+    if isinstance(instance, StudiesModel):
+        stored = getattr(instance, '_stored_dataset_id', DEFERRED)
+        instance._stored_dataset_id = instance.Dataset_id
+        if batch is not None and instance.pk is not None:
+            batch.studies[instance.pk] = (instance.Dataset_id, instance.Approved_by_id is not None)
+        if stored is DEFERRED and instance.pk is not None:
+            stored = StudiesModel.objects.using(using).filter(pk=instance.pk).values('Dataset')
+            return bump_data_version(using, Dataset.objects.using(using).filter(
+                Q(pk=instance.Dataset_id) | Q(pk__in=stored)).values('pk'))
+        return bump_data_version(using, list({instance.Dataset_id, stored} - {None, DEFERRED}))
+    elif isinstance(instance, ResultsModel):
+        stored = getattr(instance, '_stored_study_id', DEFERRED)
+        instance._stored_study_id = instance.Study_id
+        if stored is DEFERRED and instance.pk is not None:
+            stored = ResultsModel.objects.using(using).filter(pk=instance.pk).values('Study')
+            return bump_data_version(using, StudiesModel.objects.using(using).filter(
+                Q(pk=instance.Study_id) | Q(pk__in=stored)).values('Dataset'))
+        study_ids = {instance.Study_id, stored} - {None, DEFERRED}
+        if batch is not None:
+            return batch.bump(list({ study[0] for study in map(batch.get_study, study_ids) if study }))
+        return bump_data_version(using, StudiesModel.objects.using(using).filter(pk__in=study_ids).values('Dataset'))
+
+def get_data_version_stamp(using='default', dataset=None):
+    """
+    Returns (version, last modified time) of the studies/results data of the dataset id, or of all datasets,
+    with one lookup of the counter. Counters are created when first read, so a version which has been
+    handed out is always bumped by later writes.
+    """
+    versions = DataVersion.objects.using(using).filter(Dataset=dataset).order_by('pk').values_list('Version', 'Updated_time')
+    stamp = versions.first()
+    if stamp is None:
+        try:
+            with transaction.atomic(using=using):
+                created = DataVersion.objects.using(using).create(Dataset_id=dataset)
+                stamp = (created.Version, created.Updated_time)
+        except IntegrityError:
+            # created by a concurrent request
+            stamp = versions.first()
+    return stamp
+
+def format_data_version(stamp, dataset=None):
+    version, updated_time = stamp
+    return '%s:%d:%s' % (dataset or 'all', version, updated_time.timestamp())
+
+def get_data_version(using='default', dataset=None):
+    """ Returns a short string which changes whenever the studies/results data (of the dataset id, or of all datasets) changes """
+    return format_data_version(get_data_version_stamp(using, dataset), dataset)
+
+def get_request_data_version_stamp(request, using='default', dataset=None):
+    """ get_data_version_stamp(), looked up once per request """
+    stamps = request.__dict__.setdefault('_data_versions', {})
+    if (using, dataset) not in stamps:
+        stamps[using, dataset] = get_data_version_stamp(using, dataset)
+    return stamps[using, dataset]
+
+def get_request_data_version(request, using='default', dataset=None):
+    """ get_data_version(), looked up once per request """
+    return format_data_version(get_request_data_version_stamp(request, using, dataset), dataset)
@@ -21,6 +21,7 @@ from django.contrib.sites.shortcuts import get_current_site
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_str
 from .tokens import account_activation_token
+from .conditional import conditional_page, get_user_key, is_conditional, make_etag
 from django.contrib.auth.models import User
 from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
@@ -31,13 +32,22 @@ import logging, time
 
 logger = logging.getLogger(__name__)
 
-def home(request):
+def get_home_documents(request):
     docs_filter = Q(minimum_access_level__isnull=True)
     if request.user.is_authenticated:
         docs_filter |= Q(minimum_access_level__lte=request.user.access_level)
+    return Document.objects.filter(docs_filter)
+
+def get_home_etag(request):
+    if not is_conditional(request):
+        return None
+    documents = get_home_documents(request).values_list('pk', 'title', 'upload_file', 'minimum_access_level')
+    return make_etag(get_user_key(request), list(documents))
 
+@conditional_page(get_home_etag)
+def home(request):
     return render(request, 'database/home.html', context={
-        'documents': Document.objects.filter(docs_filter),
+        'documents': get_home_documents(request),
     })
 
 def get_base_url(request):
@@ -0,0 +1,20 @@
+/** Loads further pages of a study's results into the results inline (see ReadonlyResultsInline) */
+function loadMoreResults(container, tbody) {
+    let button = $(container).find('button');
+    let shown = $(container).find('.results-shown');
+
+    button.on('click', function (e) {
+        button.prop('disabled', true);
+        $.getJSON(button.data('url'), function (page) {
+            $(tbody).append(page.html);
+            shown.text($(tbody).find('tr.has_original').length);
+            if (page.next) {
+                button.data('url', page.next).prop('disabled', false);
+            } else {
+                button.remove();
+            }
+        }).fail(function () {
+            button.prop('disabled', false);
+        });
+    });
+}